@@ -0,0 +1,89 @@
+# benchmark_backends.py
+#
+# Compares the inference backends on the CPU: rows/sec for batched
+# inference, single-row latency, and how far the predictions drift from the
+# eager model. Run after training (which exports the models), e.g.
+#   python benchmark_backends.py --rows 200000
+
+import argparse
+import os
+import time
+import numpy as np
+import torch
+from export import BACKENDS, load_backend
+from config import DATA_FILE, FEATURES, NUM_FEATURES, PREDICT_BATCH_SIZE
+
+
+def load_rows(num_rows, seed):
+    # Labelled rows from the feature cache if there is one, random rows otherwise
+    if os.path.exists(DATA_FILE):
+        from feature_cache import load_feature_cache
+        cache = load_feature_cache(DATA_FILE, FEATURES)
+        features = torch.from_numpy(np.array(cache.features_for("train")[:num_rows]))
+        labels = torch.from_numpy(np.array(cache.labels[:num_rows]))
+        return features, labels
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(num_rows, NUM_FEATURES, generator=generator), None
+
+
+def run_batched(model, features, batch_size):
+    with torch.no_grad():
+        return torch.cat([model(features[start:start + batch_size])
+                          for start in range(0, features.shape[0], batch_size)])
+
+
+def benchmark(model, features, batch_size, single_calls):
+    run_batched(model, features[:batch_size], batch_size)  # warm up
+    start = time.perf_counter()
+    logits = run_batched(model, features, batch_size)
+    rows_per_sec = features.shape[0] / (time.perf_counter() - start)
+
+    latencies = []
+    with torch.no_grad():
+        for i in range(single_calls):
+            row = features[i % features.shape[0]].unsqueeze(0)
+            start = time.perf_counter()
+            model(row)
+            latencies.append(time.perf_counter() - start)
+    latencies = np.array(latencies) * 1e6
+    return logits, rows_per_sec, np.percentile(latencies, [50, 95, 99])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the inference backends on the CPU")
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--batch-size", type=int, default=PREDICT_BATCH_SIZE)
+    parser.add_argument("--single-calls", type=int, default=2000, help="batch-of-one calls for the latency")
+    parser.add_argument("--backends", nargs="+", default=BACKENDS, choices=BACKENDS)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    features, labels = load_rows(args.rows, args.seed)
+    print(f"{features.shape[0]} rows, batch size {args.batch_size}, {args.threads} threads\n")
+    print(f"{'backend':<18}{'rows/s':>12}{'p50 us':>10}{'p95 us':>10}{'p99 us':>10}"
+          f"{'agree':>9}{'max |dlogit|':>14}{'accuracy':>10}")
+
+    reference = None
+    for backend in args.backends:
+        try:
+            model, _ = load_backend(backend, torch.device("cpu"))
+        except Exception as e:
+            print(f"{backend:<18}unavailable: {e}")
+            continue
+        model.eval()
+        logits, rows_per_sec, (p50, p95, p99) = benchmark(model, features, args.batch_size, args.single_calls)
+        logits = logits.float()
+        preds = torch.argmax(logits, 1)
+        if reference is None:
+            reference = (logits, preds)
+        agree = (preds == reference[1]).float().mean().item()
+        drift = (logits - reference[0]).abs().max().item()
+        accuracy = f"{(preds == labels).float().mean().item():.4f}" if labels is not None else "-"
+        print(f"{backend:<18}{rows_per_sec:>12.0f}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}"
+              f"{agree:>9.4f}{drift:>14.5f}{accuracy:>10}")
+
+
+if __name__ == "__main__":
+    main()
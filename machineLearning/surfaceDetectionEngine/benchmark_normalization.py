@@ -0,0 +1,62 @@
+# benchmark_normalization.py
+#
+# Trains the classifier twice on the same split, once on the raw features and
+# once with the normalization from the feature statistics, and reports how
+# many epochs each needs to reach a target validation accuracy, e.g.
+#   python benchmark_normalization.py --epochs 20
+
+import argparse
+import time
+import numpy as np
+import torch
+from feature_cache import load_feature_cache
+from model import SimpleClassifier
+from train import fit
+from config import DATA_FILE, FEATURES, NUM_FEATURES, BATCH_SIZE, LEARNING_RATE, VALIDATION_SPLIT, SEED
+
+
+def epochs_to(history, target):
+    # First epoch (1-based) reaching target, None if never
+    return next((epoch for epoch, acc in enumerate(history, start=1) if acc >= target), None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Epochs to a target accuracy with and without normalization")
+    parser.add_argument("--csv", default=DATA_FILE)
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--lr", type=float, default=LEARNING_RATE)
+    parser.add_argument("--target", type=float, default=None,
+                        help="validation accuracy to reach (default: 99%% of the best seen by either run)")
+    parser.add_argument("--seed", type=int, default=SEED)
+    args = parser.parse_args()
+
+    cache = load_feature_cache(args.csv, FEATURES)
+    features = torch.from_numpy(cache.features_for("train"))
+    labels = torch.from_numpy(cache.labels)
+    order = torch.from_numpy(np.random.RandomState(args.seed).permutation(cache.num_labelled))
+    val_size = int(VALIDATION_SPLIT * cache.num_labelled)
+    val_idx, train_idx = order[:val_size], order[val_size:]
+
+    histories = {}
+    for name in ("raw", "normalized"):
+        torch.manual_seed(args.seed)
+        model = SimpleClassifier(num_features=NUM_FEATURES, num_classes=len(cache.label2idx))
+        if name == "normalized":
+            model.set_normalization(cache.feature_stats.mean, cache.feature_stats.std())
+        start = time.time()
+        histories[name] = []
+        fit(model, features, labels, train_idx, val_idx, args.epochs, args.batch_size, args.lr,
+            torch.device("cpu"), history=histories[name])
+        print(f"{name:<11} {time.time() - start:6.1f}s  val acc per epoch: "
+              f"{' '.join(f'{acc:.3f}' for acc in histories[name])}")
+
+    target = args.target if args.target is not None else 0.99 * max(max(h) for h in histories.values())
+    print(f"\nEpochs to reach validation accuracy {target:.4f}:")
+    for name, history in histories.items():
+        epochs = epochs_to(history, target)
+        print(f"  {name:<11} {epochs if epochs is not None else f'not within {args.epochs}'}")
+
+
+if __name__ == "__main__":
+    main()
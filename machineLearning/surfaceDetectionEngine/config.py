@@ -15,6 +15,94 @@ VALIDATION_SPLIT = 0.2
 TEST_SPLIT = 0.1
 SEED = 42
 
+# Keep the train/val/test splits as tensors on the device and batch them by
+# index slicing instead of going through DataLoaders
+TRAIN_ON_TENSORS = os.environ.get("TRAIN_ON_TENSORS", "true").lower() == "true"
+# Rows per forward pass when evaluating the validation and test splits
+EVAL_BATCH_SIZE = 65536
+
+# Training state saved after every epoch, so an interrupted run can carry on
+# with TRAIN_RESUME=true (or python main.py --resume)
+TRAIN_CHECKPOINT_PATH = os.path.join(DATA_DIR, "train_checkpoint.pth")
+TRAIN_RESUME = os.environ.get("TRAIN_RESUME", "false").lower() == "true"
+# Stop once the validation accuracy has not improved for this many epochs (0 = never)
+EARLY_STOPPING_PATIENCE = int(os.environ.get("EARLY_STOPPING_PATIENCE", "0"))
+
+# Number of CSV rows parsed per chunk when loading the dataset
+CSV_CHUNK_SIZE = 100000
+
+# Number of CSV rows read, predicted and written per batch in predict mode
+PREDICT_BATCH_SIZE = 8192
+
+# Keep a binary copy of the parsed CSV next to DATA_FILE and reuse it while
+# the CSV and FEATURES are unchanged
+USE_FEATURE_CACHE = os.environ.get("USE_FEATURE_CACHE", "true").lower() == "true"
+
+# MODE=enrich fetches the unpredicted documents from Elasticsearch, predicts
+# them and writes the predictions back in one process, without CSV files
+ELASTIC_HOST = os.environ.get("ELASTIC_HOST", "https://elastic.mcmogens.dk")
+ELASTIC_INDEX = ".ds-bikehero-data-stream-2024.11.22-000001"
+ENRICH_PAGE_SIZE = int(os.environ.get("ENRICH_PAGE_SIZE", "1000"))
+# Pages that may wait between two stages before the earlier stage blocks
+ENRICH_QUEUE_SIZE = int(os.environ.get("ENRICH_QUEUE_SIZE", "4"))
+# Concurrent bulk update requests
+ENRICH_WRITERS = int(os.environ.get("ENRICH_WRITERS", "2"))
+# Retries (with exponential backoff) of updates rejected with 429
+ENRICH_MAX_RETRIES = 5
+
+# MODE=continue fine-tunes the saved model on the labelled rows added since
+# it was trained, plus a replay sample of REPLAY_SIZE older rows, for
+# CONTINUE_EPOCHS epochs. Rows are split into train/validation/test by a hash
+# of their _id, so the evaluation sets never churn between runs. Without a
+# usable checkpoint it trains from scratch on the same split.
+CONTINUE_EPOCHS = int(os.environ.get("CONTINUE_EPOCHS", "3"))
+CONTINUE_LR = 0.0003
+REPLAY_SIZE = int(os.environ.get("REPLAY_SIZE", "50000"))
+
+# MODE=sweep searches BATCH_SIZE, LEARNING_RATE and NUM_EPOCHS with k-fold
+# cross-validation, running the trials in a pool of SWEEP_WORKERS processes.
+# The search is read from SWEEP_SPEC_FILE if it exists, e.g.
+# {"search": "random", "trials": 20, "folds": 5,
+#  "params": {"batch_size": [32, 64, 128], "lr": {"min": 0.0001, "max": 0.01, "log": true}, "num_epochs": [10]}}
+SWEEP_SPEC_FILE = os.path.join(DATA_DIR, "sweep.json")
+DEFAULT_SWEEP_SPEC = {
+    "search": "grid",
+    "folds": 5,
+    "params": {"batch_size": [32, 128, 512], "lr": [0.0003, 0.001, 0.003], "num_epochs": [NUM_EPOCHS]}
+}
+SWEEP_WORKERS = int(os.environ.get("SWEEP_WORKERS") or os.cpu_count() or 1)
+SWEEP_RESULTS_FILE = os.path.join(DATA_DIR, "sweep_results.json")
+SWEEP_SUMMARY_FILE = os.path.join(DATA_DIR, "sweep_results.csv")
+
+# MODE=daemon keeps the model loaded and predicts every CSV that appears in
+# DAEMON_INPUT_DIR into DAEMON_OUTPUT_DIR, reloading the model when it changes
+DAEMON_INPUT_DIR = os.path.join(DATA_DIR, "incoming")
+DAEMON_OUTPUT_DIR = os.path.join(DATA_DIR, "predictions")
+DAEMON_POLL_SECONDS = float(os.environ.get("DAEMON_POLL_SECONDS", "1.0"))
+# A file is only picked up once it has not been modified for this long
+DAEMON_SETTLE_SECONDS = 1.0
+
+# MODE=serve answers POST /predict over HTTP. Concurrent requests are merged
+# into one forward pass of at most SERVE_MAX_BATCH samples, waiting at most
+# SERVE_MAX_WAIT_MS for more to arrive after the first.
+SERVE_HOST = os.environ.get("SERVE_HOST", "0.0.0.0")
+SERVE_PORT = int(os.environ.get("SERVE_PORT", "8000"))
+SERVE_MAX_BATCH = int(os.environ.get("SERVE_MAX_BATCH", "256"))
+SERVE_MAX_WAIT_MS = float(os.environ.get("SERVE_MAX_WAIT_MS", "2"))
+# Largest batch one request may send
+SERVE_MAX_REQUEST_SAMPLES = 1024
+# Latencies kept for the percentiles in GET /metrics
+SERVE_LATENCY_WINDOW = 10000
+
+# MODE=tiles bins the predictions (predictions.csv and DAEMON_OUTPUT_DIR)
+# into slippy-map tiles at each of TILE_ZOOMS, with the sample count, the
+# count per predicted surface type and the mean rmsAcceleration per tile.
+# Only new or changed prediction files are read again. With UPDATE_TILES,
+# predict and daemon mode update the tiles after predicting.
+TILES_DIR = os.path.join(DATA_DIR, "tiles")
+TILE_ZOOMS = [int(zoom) for zoom in os.environ.get("TILE_ZOOMS", "12,15,18").split(",")]
+UPDATE_TILES = os.environ.get("UPDATE_TILES", "false").lower() == "true"
+
 # Note: do NOT include "_id" in the features.
 FEATURES = [
     "rmsAcceleration",
@@ -27,10 +115,45 @@ FEATURES = [
     "gyroscope_y",
     "gyroscope_z"
 ]
+
+# MODE=windows groups the rows of DATA_FILE into trips, sorts each trip by
+# @timestamp and adds rolling-window features over the last WINDOW_SIZE
+# samples of each signal: RMS, variance, peak-to-peak and the energy in
+# WINDOW_BANDS frequency bands. A trip ends at a gap of more than
+# TRIP_GAP_SECONDS or, if the CSV has a TRIP_DEVICE_COLUMN, a new device.
+# With USE_WINDOW_FEATURES the other modes read the result and use the
+# window features too.
+WINDOWED_DATA_FILE = os.path.join(DATA_DIR, "training_data.windows.csv")
+USE_WINDOW_FEATURES = os.environ.get("USE_WINDOW_FEATURES", "false").lower() == "true"
+TRIP_GAP_SECONDS = 30.0
+TRIP_DEVICE_COLUMN = "deviceId"
+WINDOW_SIZE = int(os.environ.get("WINDOW_SIZE", "32"))
+WINDOW_BANDS = 3
+# Each signal is the magnitude of these columns
+WINDOW_SIGNALS = {
+    "accelerometer": ["accelerometer_x", "accelerometer_y", "accelerometer_z"],
+    "gyroscope": ["gyroscope_x", "gyroscope_y", "gyroscope_z"],
+}
+WINDOW_STATS = ["rms", "var", "p2p"] + [f"band{b}" for b in range(WINDOW_BANDS)]
+WINDOW_FEATURES = [f"{signal}_window_{stat}" for signal in WINDOW_SIGNALS for stat in WINDOW_STATS]
+FETCHED_DATA_FILE = DATA_FILE
+if USE_WINDOW_FEATURES:
+    DATA_FILE = WINDOWED_DATA_FILE
+    FEATURES = FEATURES + WINDOW_FEATURES
 NUM_FEATURES = len(FEATURES)
 
 MODEL_SAVE_PATH = os.path.join(DATA_DIR, "best_model.pth")
 PREDICTION_OUTPUT_FILE = os.path.join(DATA_DIR, "predictions.csv")
+# Exported copies of the best model, written after training
+LABELS_PATH = os.path.join(DATA_DIR, "best_model.labels.json")
+TORCHSCRIPT_PATH = os.path.join(DATA_DIR, "best_model.ts")
+TORCHSCRIPT_INT8_PATH = os.path.join(DATA_DIR, "best_model.int8.ts")
+ONNX_PATH = os.path.join(DATA_DIR, "best_model.onnx")
+ONNX_INT8_PATH = os.path.join(DATA_DIR, "best_model.int8.onnx")
+EXPORT_MODELS = os.environ.get("EXPORT_MODELS", "true").lower() == "true"
+# Model used in predict, enrich, daemon and serve mode:
+# eager || torchscript || torchscript_int8 || onnx || onnx_int8
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "eager")
 TRAIN_STAT_FILE = os.path.join(DATA_DIR, "train_stat.txt")
 PREDICTION_STAT_FILE = os.path.join(DATA_DIR, "prediction_stat.txt")
 
@@ -0,0 +1,121 @@
+# continual.py
+
+import os
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from dataset import hash_splits, TRAIN, VALIDATION, TEST
+from model import SimpleClassifier, load_classifier
+from train import fit, predict_all, save_and_report, tensor_batches
+from config import (NUM_FEATURES, BATCH_SIZE, NUM_EPOCHS, LEARNING_RATE, VALIDATION_SPLIT, TEST_SPLIT, SEED,
+                    MODEL_SAVE_PATH, EVAL_BATCH_SIZE, CONTINUE_EPOCHS, CONTINUE_LR, REPLAY_SIZE)
+
+def load_warm_start(cache, model_save_path):
+    # The saved checkpoint if the rows it was trained on are still the first
+    # labelled rows of the cache, otherwise None
+    if not os.path.exists(model_save_path):
+        print(f"No model at {model_save_path}, training from scratch")
+        return None
+    checkpoint = torch.load(model_save_path, map_location="cpu")
+    trained_rows = checkpoint.get('trained_rows')
+    if trained_rows is None or trained_rows > cache.num_labelled \
+            or cache.trained_rows_marker(trained_rows) != {"trained_rows": trained_rows,
+                                                           "trained_ids_sha256": checkpoint.get('trained_ids_sha256')}:
+        print(f"{model_save_path} was not trained on a prefix of this data, training from scratch")
+        return None
+    return checkpoint
+
+
+def align_labels(checkpoint_label2idx, cache):
+    # The checkpoint's label maps, grown by the labels only the cache has,
+    # and a lookup translating the cache's label codes into them
+    label2idx = dict(checkpoint_label2idx)
+    for i in range(len(cache.idx2label)):
+        label2idx.setdefault(cache.idx2label[i], len(label2idx))
+    idx2label = {i: label for label, i in label2idx.items()}
+    lookup = np.array([label2idx[cache.idx2label[i]] for i in range(len(cache.idx2label))], dtype=np.int64)
+    return label2idx, idx2label, lookup
+
+
+def grow_output_layer(model, num_classes):
+    # Add output units for new classes, keeping the trained ones
+    old = model.fc2
+    if old.out_features == num_classes:
+        return
+    fc2 = nn.Linear(old.in_features, num_classes).to(old.weight.device)
+    with torch.no_grad():
+        fc2.weight[:old.out_features] = old.weight
+        fc2.bias[:old.out_features] = old.bias
+    model.fc2 = fc2
+
+
+def _accuracy(model, features, labels, idx, device):
+    preds, targets = predict_all(model, tensor_batches(features.index_select(0, idx), labels.index_select(0, idx),
+                                                       EVAL_BATCH_SIZE, shuffle=False), device)
+    return torch.sum(preds == targets).item() / max(targets.numel(), 1)
+
+
+def run_continual(cache, device, model_save_path=MODEL_SAVE_PATH, epochs=CONTINUE_EPOCHS, lr=CONTINUE_LR,
+                  replay_size=REPLAY_SIZE, batch_size=BATCH_SIZE, seed=SEED):
+    # Fine-tune the saved model on the labelled rows added since it was
+    # trained plus a random replay sample of the older training rows, or
+    # train from scratch if there is no usable checkpoint. Returns the test
+    # accuracy, or None if there was nothing new to train on.
+    start = time.time()
+    torch.manual_seed(seed)
+    splits = hash_splits(cache.ids[:cache.num_labelled], VALIDATION_SPLIT, TEST_SPLIT)
+    checkpoint = load_warm_start(cache, model_save_path)
+
+    if checkpoint is not None:
+        trained_rows = checkpoint['trained_rows']
+        label2idx, idx2label, lookup = align_labels(checkpoint['label2idx'], cache)
+        # The model keeps the normalization it was trained with
+        model = load_classifier(checkpoint, NUM_FEATURES)
+        grow_output_layer(model, len(label2idx))
+        new_labels = [idx2label[i] for i in range(len(checkpoint['label2idx']), len(label2idx))]
+        if new_labels:
+            print(f"New surface types: {', '.join(new_labels)}")
+    else:
+        trained_rows = 0
+        label2idx, idx2label = dict(cache.label2idx), dict(cache.idx2label)
+        lookup = np.arange(len(label2idx), dtype=np.int64)
+        model = SimpleClassifier(num_features=NUM_FEATURES, num_classes=len(label2idx))
+        model.set_normalization(cache.feature_stats.mean, cache.feature_stats.std())
+        epochs, lr = NUM_EPOCHS, LEARNING_RATE
+    model.to(device)
+
+    features = torch.from_numpy(cache.features_for("train"))
+    labels = torch.from_numpy(lookup[np.asarray(cache.labels)])
+    train_rows = np.flatnonzero(splits == TRAIN)
+    new_rows = train_rows[train_rows >= trained_rows]
+    if checkpoint is not None:
+        if cache.num_labelled == trained_rows:
+            print(f"No new labelled rows since the model was trained on {trained_rows} rows")
+            return None
+        old_rows = train_rows[train_rows < trained_rows]
+        replay = np.random.RandomState(seed).choice(old_rows, size=min(replay_size, len(old_rows)), replace=False)
+        train_rows = np.concatenate([new_rows, np.sort(replay)])
+        print(f"Fine-tuning on {len(new_rows)} new and {len(replay)} replayed rows for {epochs} epochs")
+    else:
+        print(f"Training on {len(train_rows)} rows for {epochs} epochs")
+
+    val_idx = torch.from_numpy(np.flatnonzero(splits == VALIDATION))
+    test_idx = torch.from_numpy(np.flatnonzero(splits == TEST))
+    start_acc = _accuracy(model, features, labels, val_idx, device) if checkpoint is not None else 0.0
+    start_state = {k: v.clone() for k, v in model.state_dict().items()}
+    best_acc, best_state = fit(model, features, labels, torch.from_numpy(train_rows), val_idx, epochs, batch_size,
+                               lr, device)
+    if best_acc >= start_acc:
+        model.load_state_dict(best_state)
+    else:
+        # Keep the previous model rather than a worse one
+        model.load_state_dict(start_state)
+    print(f"Validation accuracy {start_acc:.4f} -> {max(best_acc, start_acc):.4f}, "
+          f"trained in {time.time() - start:.1f}s")
+
+    test_preds, test_targets = predict_all(model, tensor_batches(features.index_select(0, test_idx),
+                                                                 labels.index_select(0, test_idx),
+                                                                 EVAL_BATCH_SIZE, shuffle=False), device)
+    return save_and_report(model, test_preds.cpu().numpy(), test_targets.cpu().numpy(), label2idx, idx2label,
+                           model_save_path, extra=cache.trained_rows_marker())
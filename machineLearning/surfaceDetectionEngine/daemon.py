@@ -0,0 +1,113 @@
+# daemon.py
+
+import os
+import time
+from dataset import iter_predict_batches
+from export import BACKEND_PATHS, load_backend
+from predict import predict_and_save
+from config import (FEATURES, PREDICT_BATCH_SIZE, DAEMON_INPUT_DIR, DAEMON_OUTPUT_DIR, DAEMON_POLL_SECONDS,
+                    DAEMON_SETTLE_SECONDS, UPDATE_TILES)
+
+
+class WarmModel:
+    # Holds the model and label map of a backend, reloading them when the
+    # backend's model file changes on disk
+    def __init__(self, backend, device):
+        self.backend = backend
+        self.device = device
+        self.path = BACKEND_PATHS[backend]
+        self.model = None
+        self.idx2label = None
+        self.mtime_ns = None
+
+    def reload_if_changed(self):
+        # Returns True if a (new) model was loaded. A failed reload keeps the
+        # model already in memory and is tried again on the next poll.
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime_ns == self.mtime_ns or time.time() - mtime_ns / 1e9 < DAEMON_SETTLE_SECONDS:
+            return False
+        start = time.time()
+        try:
+            model, idx2label = load_backend(self.backend, self.device)
+        except Exception as e:
+            print(f"Could not load {self.path}, keeping the current model: {e}")
+            return False
+        model.eval()
+        self.model, self.idx2label, self.mtime_ns = model, idx2label, mtime_ns
+        print(f"Loaded {self.backend} model from {self.path} in {time.time() - start:.2f}s")
+        return True
+
+
+def pending_inputs(input_dir):
+    # CSVs in input_dir that are no longer being written, oldest first
+    now = time.time()
+    files = []
+    for entry in os.scandir(input_dir):
+        if entry.is_file() and entry.name.endswith(".csv"):
+            mtime = entry.stat().st_mtime
+            if now - mtime >= DAEMON_SETTLE_SECONDS:
+                files.append((mtime, entry.path))
+    return [path for _, path in sorted(files)]
+
+
+def process_file(warm, input_path, output_dir, processed_dir):
+    # Predict one input CSV into output_dir/<name> (plus <name>.stat.txt) and
+    # move the input to processed_dir
+    name = os.path.basename(input_path)
+    output_file = os.path.join(output_dir, name)
+    stat_file = os.path.join(output_dir, os.path.splitext(name)[0] + ".stat.txt")
+    start = time.time()
+    try:
+        pred_count, total_samples = predict_and_save(
+            model=warm.model,
+            batches=iter_predict_batches(input_path, FEATURES, PREDICT_BATCH_SIZE),
+            idx2label=warm.idx2label,
+            device=warm.device,
+            output_file=output_file + ".tmp",
+            stat_file=stat_file
+        )
+    except Exception:
+        if os.path.exists(output_file + ".tmp"):
+            os.remove(output_file + ".tmp")
+        raise
+    os.replace(output_file + ".tmp", output_file)
+    os.replace(input_path, os.path.join(processed_dir, name))
+    print(f"Predicted {pred_count}/{total_samples} documents of {name} in {time.time() - start:.2f}s")
+    return pred_count
+
+
+def run_daemon(backend, device, input_dir=DAEMON_INPUT_DIR, output_dir=DAEMON_OUTPUT_DIR,
+               poll_seconds=DAEMON_POLL_SECONDS, max_polls=None):
+    # Poll input_dir for new CSVs until stopped (or for max_polls polls)
+    processed_dir = os.path.join(input_dir, "processed")
+    for directory in (input_dir, output_dir, processed_dir):
+        os.makedirs(directory, exist_ok=True)
+
+    warm = WarmModel(backend, device)
+    if not warm.reload_if_changed():
+        print(f"Waiting for a model at {warm.path}")
+    print(f"Watching {input_dir} for CSV files, predictions go to {output_dir}")
+    polls = 0
+    while max_polls is None or polls < max_polls:
+        polls += 1
+        warm.reload_if_changed()
+        if warm.model is None:
+            time.sleep(poll_seconds)
+            continue
+        predicted = 0
+        for input_path in pending_inputs(input_dir):
+            try:
+                process_file(warm, input_path, output_dir, processed_dir)
+                predicted += 1
+            except Exception as e:
+                # Leave it out of the way so it is not retried every poll
+                print(f"Failed to predict {input_path}: {e}")
+                os.replace(input_path, input_path + ".failed")
+        if predicted and UPDATE_TILES:
+            from tiles import update_tiles
+            # Only the new prediction files are read
+            update_tiles()
+        time.sleep(poll_seconds)
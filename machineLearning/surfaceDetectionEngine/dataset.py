@@ -1,75 +1,212 @@
 # dataset.py
 
-import csv
+import zlib
+import numpy as np
+import pandas as pd
 import torch
 from torch.utils.data import Dataset
+from config import CSV_CHUNK_SIZE
+
+TRAIN, VALIDATION, TEST = 0, 1, 2
+
+
+def _parse_feature_column(values):
+    # Blank cells arrive as NaN. Text columns are converted with float(), the
+    # old per-cell loader's rule, which gives the same doubles as the C
+    # parser's round_trip (to_numeric can be off by one ulp). The whole column
+    # goes at once unless some cell is not a number. Only finite values are
+    # valid: "nan" and "inf" cells reject the row for training and prediction
+    # alike, as they would poison the normalization statistics.
+    if values.dtype.kind in "fiu":
+        parsed = values.to_numpy(dtype=np.float64)
+    else:
+        text = values.to_numpy(dtype=object)
+        try:
+            parsed = text.astype(np.float64)
+        except (TypeError, ValueError):
+            parsed = np.full(len(text), np.nan)
+            for i, cell in enumerate(text):
+                try:
+                    parsed[i] = float(cell)
+                except (TypeError, ValueError):
+                    pass
+    return parsed, np.isfinite(parsed)
+
+
+def read_filtered_chunks(csv_file, feature_cols, mode, chunk_size, start_offset=0):
+    # Parse the CSV column-wise in chunks and yield (chunk, keep, features),
+    # where keep masks the rows that pass the mode's filtering rules. Training
+    # only needs the features and the label, and leaves the features to the
+    # C parser. The other modes keep every column as the original text and
+    # parse the features from it, so predictions.csv repeats the input
+    # byte for byte. start_offset skips to a byte offset (a row boundary)
+    # past the header.
+    header = pd.read_csv(csv_file, nrows=0, encoding="utf-8").columns
+    text_cols = {col: str for col in header if mode != "train" or col not in feature_cols}
+    usecols = list(feature_cols) + ["surfaceType", "_id"] if mode == "train" else None
+    with open(csv_file, "rb") as f:
+        if start_offset:
+            f.seek(start_offset)
+        reader = pd.read_csv(f, header=None if start_offset else "infer",
+                             names=list(header) if start_offset else None,
+                             usecols=usecols, dtype=text_cols,
+                             keep_default_na=False, na_values={col: [""] for col in feature_cols},
+                             float_precision="round_trip", chunksize=chunk_size, low_memory=False,
+                             encoding="utf-8")
+        for chunk in reader:
+            # Blank feature cells stay NaN, they reject the row anyway
+            chunk = chunk.fillna({col: "" for col in chunk.columns if col in text_cols and col not in feature_cols})
+            st = chunk["surfaceType"]
+            keep = (st.str.strip() != "").to_numpy(dtype=bool, copy=True)
+            if mode == "train":
+                keep &= (st != "none").to_numpy()
+            elif mode == "predict":
+                keep &= (st == "none").to_numpy()
+
+            features = np.empty((len(chunk), len(feature_cols)), dtype=np.float32)
+            for j, col in enumerate(feature_cols):
+                parsed, valid = _parse_feature_column(chunk[col])
+                features[:, j] = parsed
+                keep &= valid
+            yield chunk, keep, features
+
+
+def hash_splits(ids, val_split, test_split):
+    # The split of every row (TRAIN, VALIDATION or TEST) from a hash of its
+    # _id (as bytes), so a row stays in its split however much data is added
+    # around it, and MODE=train and MODE=continue agree on it
+    fractions = np.fromiter((zlib.crc32(doc_id) for doc_id in ids), dtype=np.float64, count=len(ids)) / 2 ** 32
+    splits = np.full(len(ids), TRAIN, dtype=np.int8)
+    splits[fractions < test_split + val_split] = VALIDATION
+    splits[fractions < test_split] = TEST
+    return splits
+
+
+class RunningStats:
+    # Per-feature mean and variance, merged in chunk by chunk (the parallel
+    # form of Welford's algorithm), so one streaming pass over the data is
+    # enough and a later pass over appended rows can continue from it.
+    def __init__(self, num_features, count=0, mean=None, m2=None):
+        self.count = count
+        self.mean = np.zeros(num_features) if mean is None else np.array(mean, dtype=np.float64)
+        self.m2 = np.zeros(num_features) if m2 is None else np.array(m2, dtype=np.float64)
+
+    def update(self, values):
+        if len(values) == 0:
+            return
+        values = values.astype(np.float64)
+        mean = values.mean(axis=0)
+        m2 = ((values - mean) ** 2).sum(axis=0)
+        total = self.count + len(values)
+        delta = mean - self.mean
+        self.mean = self.mean + delta * len(values) / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * len(values) / total
+        self.count = total
+
+    def std(self):
+        # Constant (or unseen) features get 1, so they pass through unscaled
+        std = np.sqrt(self.m2 / self.count) if self.count else np.ones_like(self.mean)
+        return np.where(std > 0, std, 1.0)
+
+    def to_dict(self):
+        return {"count": self.count, "mean": self.mean.tolist(), "m2": self.m2.tolist()}
+
+    @classmethod
+    def from_dict(cls, stats):
+        return cls(len(stats["mean"]), stats["count"], stats["mean"], stats["m2"])
+
+
+def encode_labels(labels, label2idx, idx2label):
+    # Map a column of surface types to int64 codes, growing the label maps in
+    # order of first appearance.
+    codes, uniques = pd.factorize(labels, sort=False)
+    for label in uniques:
+        if label not in label2idx:
+            label2idx[label] = len(label2idx)
+            idx2label[label2idx[label]] = label
+    lookup = np.array([label2idx[label] for label in uniques], dtype=np.int64)
+    return lookup[codes]
+
+
+def iter_predict_batches(csv_file, feature_cols, batch_size):
+    # Stream the rows to predict as (features, rows) pairs, reading batch_size
+    # CSV rows at a time, so memory stays flat regardless of the file size.
+    for chunk, keep, features in read_filtered_chunks(csv_file, feature_cols, "predict", batch_size):
+        if keep.any():
+            yield torch.from_numpy(features[keep]), chunk[keep]
+
 
 class RoadSurfaceDataset(Dataset):
-    def __init__(self, csv_file, feature_cols, mode="train"):
+    def __init__(self, csv_file, feature_cols, mode="train", chunk_size=CSV_CHUNK_SIZE, cache=None):
         self.feature_cols = feature_cols
         self.mode = mode
-        self.samples = []
-        self.labels = []
         self.label2idx = {}
         self.idx2label = {}
-        
-        # We'll store rows for predict mode to output predictions later
-        # For training mode, we just store features and labels
-        with open(csv_file, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                st = row["surfaceType"]
-                if not st.strip():
-                    continue
-                if self.mode == "train":
-                    if st == "none":
-                        continue
-                elif self.mode == "predict":
-                    if st != "none":
-                        continue
-
-                # Extract features
-                skip_row = False
-                feature_values = []
-                for col in feature_cols:
-                    val_str = row[col].strip()
-                    if val_str == "":
-                        skip_row = True
-                        break
-                    try:
-                        val = float(val_str)
-                        feature_values.append(val)
-                    except ValueError:
-                        skip_row = True
-                        break
-                if skip_row:
-                    continue
-
-                if self.mode == "train":
-                    label = st
-                    if label not in self.label2idx:
-                        self.label2idx[label] = len(self.label2idx)
-                        self.idx2label[self.label2idx[label]] = label
-                    self.samples.append((feature_values, label))
-                else:
-                    # For predict mode, store entire row for final output
-                    self.samples.append((feature_values, row))
+        # Mean/std of the training features, for the model's normalization
+        self.feature_stats = None
+        # The _id of every training row (bytes), for hash_splits
+        self.ids = None
+
+        if cache is not None:
+            # Zero-copy views into the memory-mapped feature cache
+            self.features = torch.from_numpy(cache.features_for(mode))
+            if self.mode == "train":
+                self.label2idx.update(cache.label2idx)
+                self.idx2label.update(cache.idx2label)
+                self.labels = torch.from_numpy(cache.labels)
+                self.feature_stats = cache.feature_stats
+                self.ids = cache.ids[:cache.num_labelled]
+                self.rows = None
+            else:
+                self.labels = None
+                self.rows = cache.rows_for(mode)
+        else:
+            self._load_csv(csv_file, chunk_size)
 
         if self.mode == "train":
             self.num_classes = len(self.label2idx)
         else:
             self.num_classes = None
 
+    def _load_csv(self, csv_file, chunk_size):
+        feature_chunks = []
+        label_chunks = []
+        row_chunks = []
+        id_chunks = []
+        stats = RunningStats(len(self.feature_cols))
+
+        for chunk, keep, features in read_filtered_chunks(csv_file, self.feature_cols, self.mode, chunk_size):
+            st = chunk["surfaceType"]
+            features = features[keep]
+            if self.mode == "train":
+                label_chunks.append(encode_labels(st[keep], self.label2idx, self.idx2label))
+                id_chunks.append(chunk["_id"][keep].to_numpy(dtype=object).astype("S"))
+                stats.update(features)
+            else:
+                # For predict mode, keep the original rows for the final output
+                row_chunks.append(chunk[keep])
+            feature_chunks.append(features)
+
+        if feature_chunks:
+            self.features = torch.from_numpy(np.ascontiguousarray(np.concatenate(feature_chunks)))
+        else:
+            self.features = torch.empty((0, len(self.feature_cols)), dtype=torch.float32)
+
+        if self.mode == "train":
+            labels = np.concatenate(label_chunks) if label_chunks else np.empty(0, dtype=np.int64)
+            self.labels = torch.from_numpy(labels)
+            self.rows = None
+            self.feature_stats = stats
+            self.ids = np.concatenate(id_chunks) if id_chunks else np.empty(0, dtype="S1")
+        else:
+            self.labels = None
+            self.rows = pd.concat(row_chunks, ignore_index=True) if row_chunks else pd.DataFrame()
+
     def __len__(self):
-        return len(self.samples)
+        return self.features.shape[0]
 
     def __getitem__(self, idx):
         if self.mode == "train":
-            features, lbl = self.samples[idx]
-            features = torch.tensor(features, dtype=torch.float32)
-            label_idx = self.label2idx[lbl]
-            return features, label_idx
+            return self.features[idx], self.labels[idx]
         else:
-            features, row = self.samples[idx]
-            features = torch.tensor(features, dtype=torch.float32)
-            return features, row
+            return self.features[idx], self.rows.iloc[idx].to_dict()
@@ -0,0 +1,277 @@
+# enrich.py
+
+import math
+import os
+import queue
+import threading
+import time
+import numpy as np
+import torch
+from dotenv import load_dotenv
+from elasticsearch import Elasticsearch, helpers
+from config import (ELASTIC_HOST, ELASTIC_INDEX, ENRICH_PAGE_SIZE, ENRICH_QUEUE_SIZE, ENRICH_WRITERS,
+                    ENRICH_MAX_RETRIES)
+
+# The "none" documents nobody predicted yet (FETCH_MODE=unpredicted in the fetcher)
+UNPREDICTED_QUERY = {
+    "bool": {
+        "filter": [{"term": {"surfaceType": "none"}}],
+        "must_not": [{"exists": {"field": "predicted_surfaceType"}}]
+    }
+}
+
+STAGES = ["fetch", "predict", "write", "end_to_end"]
+
+# Marks the end of a queue
+_DONE = object()
+
+
+def connect(host=ELASTIC_HOST):
+    load_dotenv()
+    return Elasticsearch(hosts=[host], api_key=os.getenv("ELASTIC_API_KEY"))
+
+
+# Feature column -> _source field, undoing the fetcher's flatten_hit
+SOURCE_PATHS = {
+    "rmsAcceleration": "rmsAcceleration",
+    "location_lat": "location.lat",
+    "location_lon": "location.lon",
+    "accelerometer_x": "accelerometer.x",
+    "accelerometer_y": "accelerometer.y",
+    "accelerometer_z": "accelerometer.z",
+    "gyroscope_x": "gyroscope.x",
+    "gyroscope_y": "gyroscope.y",
+    "gyroscope_z": "gyroscope.z",
+}
+
+
+def source_paths(feature_cols):
+    # The _source field of every feature column. Features computed from
+    # other documents (the window features) are not in any single document.
+    missing = [col for col in feature_cols if col not in SOURCE_PATHS]
+    if missing:
+        raise ValueError(f"MODE=enrich reads each document on its own and has no _source field for "
+                         f"{', '.join(missing)}; run it with USE_WINDOW_FEATURES=false")
+    return [SOURCE_PATHS[col] for col in feature_cols]
+
+
+def _source_value(source, path):
+    value = source
+    for part in path.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def page_features(hits, paths):
+    # Return (features, ids) for the hits whose features are all finite
+    # numbers. Like blank or "inf" CSV cells, a missing, unparsable or
+    # non-finite feature drops the document.
+    rows = []
+    ids = []
+    for hit in hits:
+        source = hit.get("_source", {})
+        try:
+            row = [float(_source_value(source, path)) for path in paths]
+        except (TypeError, ValueError):
+            continue
+        if not all(math.isfinite(value) for value in row):
+            continue
+        rows.append(row)
+        ids.append(hit["_id"])
+    return np.array(rows, dtype=np.float32).reshape(len(rows), len(paths)), ids
+
+
+class StageStats:
+    # Latency samples per pipeline stage, added to from all threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {stage: [] for stage in STAGES}
+        self.counts = {"fetched": 0, "skipped": 0, "updated": 0, "failed": 0}
+        self.start = time.time()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.samples[stage].append(seconds)
+
+    def count(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.counts[key] += value
+
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            summary = {
+                "seconds": round(elapsed, 3),
+                "docs_per_second": round(self.counts["fetched"] / elapsed, 1) if elapsed > 0 else 0.0,
+                **self.counts,
+            }
+            for stage, samples in self.samples.items():
+                if samples:
+                    ms = np.array(samples) * 1000
+                    summary[stage] = {
+                        "pages": len(samples),
+                        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+                        "p95_ms": round(float(np.percentile(ms, 95)), 2),
+                        "max_ms": round(float(ms.max()), 2),
+                    }
+            return summary
+
+    def report(self):
+        summary = self.summary()
+        print(f"Enriched {summary['updated']} documents ({summary['failed']} failed, {summary['skipped']} skipped "
+              f"with missing features) of {summary['fetched']} fetched in {summary['seconds']:.1f}s "
+              f"({summary['docs_per_second']:.0f} docs/s)")
+        for stage in STAGES:
+            if stage in summary:
+                s = summary[stage]
+                print(f"  {stage:<10} p50 {s['p50_ms']:8.1f} ms  p95 {s['p95_ms']:8.1f} ms  max {s['max_ms']:8.1f} ms"
+                      f"  ({s['pages']} pages)")
+        return summary
+
+
+def _put(q, item, stop):
+    # Blocking put that gives up once another stage has failed
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+def fetch_pages(elastic, index_name, paths, page_size, pages, stats, stop, scroll="2m"):
+    # Scroll through the unpredicted documents, putting (started, hits) on pages
+    started = time.time()
+    response = elastic.search(index=index_name, query=UNPREDICTED_QUERY, _source=paths, scroll=scroll,
+                              size=page_size)
+    scroll_id = response.get("_scroll_id")
+    try:
+        while not stop.is_set():
+            hits = response["hits"]["hits"]
+            if not hits:
+                break
+            stats.add("fetch", time.time() - started)
+            stats.count(fetched=len(hits))
+            if not _put(pages, (started, hits), stop):
+                break
+            started = time.time()
+            response = elastic.scroll(scroll_id=scroll_id, scroll=scroll)
+            scroll_id = response.get("_scroll_id")
+    finally:
+        if scroll_id:
+            elastic.clear_scroll(scroll_id=scroll_id)
+
+
+def predict_pages(model, label_names, paths, index_name, device, pages, updates, stats, stop):
+    # One forward pass per fetched page; the page becomes a list of update actions
+    with torch.no_grad():
+        while True:
+            page = _get(pages, stop)
+            if page is _DONE:
+                break
+            started, hits = page
+            predict_start = time.time()
+            features, ids = page_features(hits, paths)
+            stats.count(skipped=len(hits) - len(ids))
+            if not ids:
+                stats.add("end_to_end", time.time() - started)
+                continue
+            preds = torch.argmax(model(torch.from_numpy(features).to(device)), 1).cpu().numpy()
+            actions = [
+                {"_op_type": "update", "_index": index_name, "_id": doc_id,
+                 "doc": {"predicted_surfaceType": label_names[pred]}}
+                for doc_id, pred in zip(ids, preds)
+            ]
+            stats.add("predict", time.time() - predict_start)
+            if not _put(updates, (started, actions), stop):
+                break
+
+
+def write_pages(elastic, updates, stats, stop, max_retries):
+    # Send each predicted page as one bulk request
+    while True:
+        page = _get(updates, stop)
+        if page is _DONE:
+            break
+        started, actions = page
+        write_start = time.time()
+        updated = 0
+        failed = 0
+        for ok, info in helpers.streaming_bulk(elastic, actions, chunk_size=len(actions), max_retries=max_retries,
+                                               raise_on_error=False, raise_on_exception=False):
+            if ok:
+                updated += 1
+            else:
+                failed += 1
+                if stats.counts["failed"] + failed <= 10:
+                    item = info.get("update", info)
+                    print(f"Failed to update {item.get('_id')}: status {item.get('status')}, "
+                          f"{str(item.get('error'))[:200]}")
+        stats.count(updated=updated, failed=failed)
+        now = time.time()
+        stats.add("write", now - write_start)
+        stats.add("end_to_end", now - started)
+
+
+def run_enrich(elastic, model, idx2label, feature_cols, device, index_name=ELASTIC_INDEX,
+               page_size=ENRICH_PAGE_SIZE, queue_size=ENRICH_QUEUE_SIZE, writers=ENRICH_WRITERS,
+               max_retries=ENRICH_MAX_RETRIES):
+    # Fetch, predict and write overlap: a fetch thread and `writers` bulk
+    # threads around inference on this thread, joined by queues of at most
+    # queue_size pages. Returns the stage summary.
+    model.eval()
+    label_names = [idx2label[i] for i in range(len(idx2label))]
+    paths = source_paths(feature_cols)
+    pages = queue.Queue(maxsize=queue_size)
+    updates = queue.Queue(maxsize=queue_size)
+    stats = StageStats()
+    stop = threading.Event()
+    errors = []
+
+    def guarded(target, *args, then=None):
+        # Run target on a thread; an error stops the other stages and is re-raised here
+        def run():
+            try:
+                target(*args)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                if then is not None:
+                    then()
+        return threading.Thread(target=run, daemon=True)
+
+    fetch_thread = guarded(fetch_pages, elastic, index_name, paths, page_size, pages, stats, stop,
+                           then=lambda: _put(pages, _DONE, stop))
+    write_threads = [guarded(write_pages, elastic, updates, stats, stop, max_retries) for _ in range(writers)]
+
+    fetch_thread.start()
+    for thread in write_threads:
+        thread.start()
+    try:
+        predict_pages(model, label_names, paths, index_name, device, pages, updates, stats, stop)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for _ in write_threads:
+            _put(updates, _DONE, stop)
+        fetch_thread.join()
+        for thread in write_threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return stats.report()
@@ -0,0 +1,92 @@
+# export.py
+
+import copy
+import inspect
+import json
+import numpy as np
+import torch
+import torch.nn as nn
+from model import load_classifier
+from config import (NUM_FEATURES, MODEL_SAVE_PATH, LABELS_PATH, TORCHSCRIPT_PATH, TORCHSCRIPT_INT8_PATH,
+                    ONNX_PATH, ONNX_INT8_PATH)
+
+BACKENDS = ["eager", "torchscript", "torchscript_int8", "onnx", "onnx_int8"]
+# The file each backend loads its model from
+BACKEND_PATHS = {
+    "eager": MODEL_SAVE_PATH,
+    "torchscript": TORCHSCRIPT_PATH,
+    "torchscript_int8": TORCHSCRIPT_INT8_PATH,
+    "onnx": ONNX_PATH,
+    "onnx_int8": ONNX_INT8_PATH,
+}
+
+
+def save_labels(idx2label, path=LABELS_PATH):
+    # The exported models only hold the network, the label map goes next to them
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump([idx2label[i] for i in range(len(idx2label))], f)
+
+
+def load_labels(path=LABELS_PATH):
+    with open(path, "r", encoding="utf-8") as f:
+        return dict(enumerate(json.load(f)))
+
+
+def export_onnx(model, path):
+    # torch >= 2.9 defaults to the dynamo exporter; keep the TorchScript-based one
+    kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(model, torch.zeros(1, NUM_FEATURES), path, input_names=["features"], output_names=["logits"],
+                      dynamic_axes={"features": {0: "batch"}, "logits": {0: "batch"}}, **kwargs)
+
+
+def export_models(model, idx2label):
+    # Write the label map plus TorchScript and ONNX copies of the model, each
+    # also dynamically quantized to int8. ONNX needs the onnx (and for int8
+    # onnxruntime) packages and is skipped without them.
+    model = copy.deepcopy(model).cpu().eval()
+    save_labels(idx2label)
+    example = torch.zeros(1, NUM_FEATURES)
+
+    torch.jit.save(torch.jit.trace(model, example), TORCHSCRIPT_PATH)
+    quantized = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    torch.jit.save(torch.jit.trace(quantized, example), TORCHSCRIPT_INT8_PATH)
+    exported = [TORCHSCRIPT_PATH, TORCHSCRIPT_INT8_PATH]
+
+    try:
+        export_onnx(model, ONNX_PATH)
+        exported.append(ONNX_PATH)
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(ONNX_PATH, ONNX_INT8_PATH, weight_type=QuantType.QInt8)
+        exported.append(ONNX_INT8_PATH)
+    except Exception as e:
+        print(f"Skipped part of the ONNX export: {e}")
+    print(f"Exported model to {', '.join(exported)}")
+    return exported
+
+
+class OnnxModel:
+    # Makes an ONNX Runtime session look like the torch models to predict_and_save
+    def __init__(self, path):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+    def eval(self):
+        return self
+
+    def __call__(self, features):
+        logits, = self.session.run(["logits"], {"features": np.ascontiguousarray(features.cpu().numpy())})
+        return torch.from_numpy(logits)
+
+
+def load_backend(backend, device):
+    # Return (model, idx2label) for an inference backend. Only eager reads
+    # best_model.pth; the others run on the CPU from the exported files.
+    if backend == "eager":
+        checkpoint = torch.load(MODEL_SAVE_PATH, map_location=device)
+        idx2label = checkpoint['idx2label']
+        return load_classifier(checkpoint, NUM_FEATURES).to(device), idx2label
+    elif backend in ("torchscript", "torchscript_int8"):
+        return torch.jit.load(BACKEND_PATHS[backend], map_location="cpu"), load_labels()
+    elif backend in ("onnx", "onnx_int8"):
+        return OnnxModel(BACKEND_PATHS[backend]), load_labels()
+    raise ValueError(f"INFERENCE_BACKEND must be one of {', '.join(BACKENDS)}.")
@@ -0,0 +1,261 @@
+# feature_cache.py
+
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+import torch
+from dataset import RunningStats, read_filtered_chunks, encode_labels
+from config import CSV_CHUNK_SIZE
+
+# Bump when the on-disk layout changes so old caches are rebuilt
+CACHE_VERSION = 5
+META_FILE = "meta.json"
+
+
+def cache_dir_for(csv_file):
+    # training_data.csv -> training_data.cache/ in the same directory
+    return os.path.splitext(csv_file)[0] + ".cache"
+
+
+def _file_sha256(path, limit=None, digest=None, start=0):
+    # Hash the file (or its first `limit` bytes), optionally continuing an
+    # existing digest from byte `start`. Returns the digest object.
+    digest = digest or hashlib.sha256()
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = limit - start if limit is not None else None
+        while remaining is None or remaining > 0:
+            block = f.read(1 << 20 if remaining is None else min(1 << 20, remaining))
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return digest
+
+
+def _text_column(chunk, col):
+    if col not in chunk:
+        return np.full(len(chunk), b"", dtype="S1")
+    return chunk[col].to_numpy(dtype=object).astype("S")
+
+
+class FeatureCache:
+    # Rows are stored labelled first, then the "none" rows awaiting
+    # prediction, so each mode gets a contiguous zero-copy slice.
+    def __init__(self, cache_dir, meta):
+        self.cache_dir = cache_dir
+        self.meta = meta
+        self.feature_cols = meta["features"]
+        self.num_labelled = meta["num_labelled"]
+        self.label2idx = {label: i for i, label in enumerate(meta["labels"])}
+        self.idx2label = {i: label for i, label in enumerate(meta["labels"])}
+        # Mean/variance of the labelled rows' features
+        self.feature_stats = RunningStats.from_dict(meta["feature_stats"])
+
+        # Copy-on-write maps keep the arrays writable for torch.from_numpy
+        # without ever touching the files.
+        self.features = np.load(os.path.join(cache_dir, "features.npy"), mmap_mode="c")
+        self.labels = np.load(os.path.join(cache_dir, "labels.npy"), mmap_mode="c")
+        self.ids = np.load(os.path.join(cache_dir, "ids.npy"), mmap_mode="r")
+        self.timestamps = np.load(os.path.join(cache_dir, "timestamps.npy"), mmap_mode="r")
+        # The feature columns' original text, for output only
+        self.texts = np.load(os.path.join(cache_dir, "texts.npy"), mmap_mode="r")
+
+    def _split(self, mode):
+        if mode == "train":
+            return slice(0, self.num_labelled)
+        elif mode == "predict":
+            return slice(self.num_labelled, len(self.features))
+        return slice(0, len(self.features))
+
+    def features_for(self, mode):
+        return self.features[self._split(mode)]
+
+    def rows_for(self, mode, start=0, stop=None):
+        # Rebuild the text columns of the original rows for output. Features
+        # are the CSV's own text, not the float32 model input, so the output
+        # matches the uncached path byte for byte.
+        split = self._split(mode)
+        stop = split.stop if stop is None else split.start + stop
+        rows = slice(split.start + start, stop)
+        frame = {
+            "@timestamp": self.timestamps[rows].astype(str),
+            "_id": self.ids[rows].astype(str),
+        }
+        if mode == "predict":
+            frame["surfaceType"] = "none"
+        for j, col in enumerate(self.feature_cols):
+            frame[col] = self.texts[rows, j].astype(str)
+        return pd.DataFrame(frame)
+
+    def trained_rows_marker(self, num_rows=None):
+        # Checkpoint entries recording that a model was trained on the first
+        # num_rows labelled rows (all by default), so MODE=continue can tell
+        # which rows are new since
+        num_rows = self.num_labelled if num_rows is None else num_rows
+        digest = hashlib.sha256(b"\n".join(self.ids[:num_rows].tolist())).hexdigest()
+        return {"trained_rows": int(num_rows), "trained_ids_sha256": digest}
+
+    def iter_predict_batches(self, batch_size):
+        features = self.features_for("predict")
+        for start in range(0, len(features), batch_size):
+            stop = min(start + batch_size, len(features))
+            yield torch.from_numpy(features[start:stop]), self.rows_for("predict", start, stop)
+
+
+def _read_meta(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, META_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(cache_dir, meta):
+    tmp_path = os.path.join(cache_dir, META_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, os.path.join(cache_dir, META_FILE))
+
+
+def _save_array(cache_dir, name, array):
+    # Replace rather than overwrite, so open memory maps of the old file
+    # stay valid
+    tmp_path = os.path.join(cache_dir, name + ".tmp.npy")
+    np.save(tmp_path, array)
+    os.replace(tmp_path, os.path.join(cache_dir, name + ".npy"))
+
+
+def _is_fresh(meta, csv_file, feature_cols):
+    # Size and feature list must match. A matching mtime is trusted as is;
+    # otherwise (e.g. the file was cp'd in again) fall back to the hash.
+    if meta is None or meta.get("version") != CACHE_VERSION:
+        return False
+    if meta["features"] != list(feature_cols):
+        return False
+    stat = os.stat(csv_file)
+    if meta["source_size"] != stat.st_size:
+        return False
+    if meta["source_mtime_ns"] == stat.st_mtime_ns:
+        return True
+    return meta["source_sha256"] == _file_sha256(csv_file).hexdigest()
+
+
+def _appended_digest(meta, csv_file, feature_cols):
+    # If csv_file is the cached file with rows appended (as an incremental
+    # fetch does), return the digest of the cached prefix, else None.
+    if meta is None or meta.get("version") != CACHE_VERSION:
+        return None
+    if meta["features"] != list(feature_cols) or meta["source_size"] >= os.stat(csv_file).st_size:
+        return None
+    digest = _file_sha256(csv_file, limit=meta["source_size"])
+    return digest if digest.hexdigest() == meta["source_sha256"] else None
+
+
+def build_feature_cache(csv_file, feature_cols, chunk_size=CSV_CHUNK_SIZE, base=None, base_digest=None):
+    # Parse csv_file into the cache. With base (the FeatureCache of a prefix
+    # of csv_file) only the rows after that prefix are parsed and merged in.
+    cache_dir = cache_dir_for(csv_file)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    start = time.time()
+    stat = os.stat(csv_file)
+    label2idx = {}
+    idx2label = {}
+    parts = {"labelled": ([], [], [], [], []), "predict": ([], [], [], [], [])}
+    stats = RunningStats(len(feature_cols))
+    start_offset = 0
+    if base is not None:
+        # Start from the rows already in the cache
+        label2idx.update(base.label2idx)
+        idx2label.update(base.idx2label)
+        stats = base.feature_stats
+        for name in ("labelled", "predict"):
+            rows = base._split("train" if name == "labelled" else "predict")
+            parts[name][0].append(np.array(base.features[rows]))
+            parts[name][2].append(np.array(base.ids[rows]))
+            parts[name][3].append(np.array(base.timestamps[rows]))
+            parts[name][4].append(np.array(base.texts[rows]))
+        parts["labelled"][1].append(np.array(base.labels))
+        start_offset = base.meta["source_size"]
+
+    # Invalidate first so a crash mid-build never leaves a "fresh" cache
+    meta_path = os.path.join(cache_dir, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    for chunk, keep, features in read_filtered_chunks(csv_file, feature_cols, None, chunk_size, start_offset):
+        st = chunk["surfaceType"].to_numpy()
+        for name, mask in (("labelled", keep & (st != "none")), ("predict", keep & (st == "none"))):
+            features_part, labels_part, ids_part, timestamps_part, texts_part = parts[name]
+            rows = chunk[mask]
+            features_part.append(features[mask])
+            ids_part.append(_text_column(rows, "_id"))
+            timestamps_part.append(_text_column(rows, "@timestamp"))
+            texts_part.append(np.stack([_text_column(rows, col) for col in feature_cols], axis=1))
+            if name == "labelled":
+                labels_part.append(encode_labels(rows["surfaceType"], label2idx, idx2label))
+                stats.update(features[mask])
+
+    features_all = parts["labelled"][0] + parts["predict"][0]
+    features = np.concatenate(features_all) if features_all else np.empty((0, len(feature_cols)), dtype=np.float32)
+    labels = np.concatenate(parts["labelled"][1]) if parts["labelled"][1] else np.empty(0, dtype=np.int64)
+    ids = np.concatenate(parts["labelled"][2] + parts["predict"][2]) if features_all else np.empty(0, dtype="S1")
+    timestamps = np.concatenate(parts["labelled"][3] + parts["predict"][3]) if features_all else np.empty(0, dtype="S1")
+    texts = np.concatenate(parts["labelled"][4] + parts["predict"][4]) if features_all \
+        else np.empty((0, len(feature_cols)), dtype="S1")
+
+    _save_array(cache_dir, "features", np.ascontiguousarray(features, dtype=np.float32))
+    _save_array(cache_dir, "labels", labels)
+    _save_array(cache_dir, "ids", ids)
+    _save_array(cache_dir, "timestamps", timestamps)
+    _save_array(cache_dir, "texts", texts)
+
+    meta = {
+        "version": CACHE_VERSION,
+        "features": list(feature_cols),
+        "labels": [idx2label[i] for i in range(len(idx2label))],
+        "num_labelled": int(len(labels)),
+        "num_rows": int(len(features)),
+        "feature_stats": stats.to_dict(),
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "source_sha256": _file_sha256(csv_file, digest=base_digest, start=start_offset).hexdigest(),
+        "build_seconds": round(time.time() - start, 3) if base is None else base.meta["build_seconds"],
+    }
+    _write_meta(cache_dir, meta)
+    return meta
+
+
+def load_feature_cache(csv_file, feature_cols, chunk_size=CSV_CHUNK_SIZE):
+    # Open the binary cache for csv_file, (re)building it from the CSV first
+    # if it is missing or stale, or parsing only the new rows if the CSV was
+    # appended to. Prints cold versus warm load times.
+    cache_dir = cache_dir_for(csv_file)
+    start = time.time()
+    meta = _read_meta(cache_dir)
+    if _is_fresh(meta, csv_file, feature_cols):
+        if meta["source_mtime_ns"] != os.stat(csv_file).st_mtime_ns:
+            meta["source_mtime_ns"] = os.stat(csv_file).st_mtime_ns
+            _write_meta(cache_dir, meta)
+        cache = FeatureCache(cache_dir, meta)
+        print(f"Loaded feature cache {cache_dir} in {time.time() - start:.2f}s "
+              f"(cold parse took {meta['build_seconds']:.2f}s, {meta['num_rows']} rows)")
+        return cache
+
+    base_digest = _appended_digest(meta, csv_file, feature_cols)
+    if base_digest is not None:
+        base = FeatureCache(cache_dir, meta)
+        meta = build_feature_cache(csv_file, feature_cols, chunk_size, base=base, base_digest=base_digest)
+        cache = FeatureCache(cache_dir, meta)
+        print(f"Extended feature cache {cache_dir} with {meta['num_rows'] - base.meta['num_rows']} appended rows "
+              f"in {time.time() - start:.2f}s ({meta['num_rows']} rows)")
+    else:
+        meta = build_feature_cache(csv_file, feature_cols, chunk_size)
+        cache = FeatureCache(cache_dir, meta)
+        print(f"Built feature cache {cache_dir} in {time.time() - start:.2f}s ({meta['num_rows']} rows)")
+    return cache
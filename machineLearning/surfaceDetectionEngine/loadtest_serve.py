@@ -0,0 +1,102 @@
+# loadtest_serve.py
+#
+# Load test for MODE=serve: --concurrency clients, each on its own keep-alive
+# connection, send POST /predict back to back for --duration seconds. Prints
+# the client-side latency percentiles and throughput, then the server's
+# /metrics (which shows how well requests were batched), e.g.
+#   python loadtest_serve.py --url http://localhost:8000 --concurrency 64 --duration 10
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from urllib.parse import urlsplit
+import numpy as np
+
+
+def random_sample(rng):
+    # A sample in the layout the app sends
+    return {
+        "rmsAcceleration": rng.uniform(0, 5),
+        "location": {"lat": rng.uniform(56.9, 57.1), "lon": rng.uniform(9.8, 10.1)},
+        "accelerometer": {"x": rng.gauss(0, 1), "y": rng.gauss(0, 1), "z": rng.gauss(0, 1)},
+        "gyroscope": {"x": rng.gauss(0, 0.5), "y": rng.gauss(0, 0.5), "z": rng.gauss(0, 0.5)},
+    }
+
+
+async def request(reader, writer, host, method, path, body=b""):
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def client(host, port, payloads, deadline, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        i = 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            status, _ = await request(reader, writer, host, "POST", "/predict", payloads[i % len(payloads)])
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(status)
+            i += 1
+    finally:
+        writer.close()
+
+
+async def run(args):
+    url = urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+    rng = random.Random(args.seed)
+    payloads = []
+    for _ in range(256):
+        samples = [random_sample(rng) for _ in range(args.samples_per_request)]
+        payloads.append(json.dumps(samples[0] if args.samples_per_request == 1 else samples).encode("utf-8"))
+
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    deadline = start + args.duration
+    await asyncio.gather(*(client(host, port, payloads[i:] + payloads[:i], deadline, latencies, errors)
+                           for i in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    ms = np.array(latencies) * 1000
+    print(f"{len(latencies)} requests ({len(errors)} errors) from {args.concurrency} clients in {elapsed:.1f}s: "
+          f"{len(latencies) / elapsed:.0f} requests/s, {len(latencies) * args.samples_per_request / elapsed:.0f} "
+          f"samples/s")
+    if len(ms):
+        p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+        print(f"latency p50 {p50:.2f} ms  p95 {p95:.2f} ms  p99 {p99:.2f} ms  max {ms.max():.2f} ms")
+
+    reader, writer = await asyncio.open_connection(host, port)
+    _, body = await request(reader, writer, host, "GET", "/metrics")
+    writer.close()
+    print("server metrics:", json.dumps(json.loads(body), indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the prediction service")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--samples-per-request", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
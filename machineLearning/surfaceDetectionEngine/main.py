@@ -1,21 +1,32 @@
 # main.py
 
+import argparse
 import torch
-import csv
-from dataset import RoadSurfaceDataset
+from dataset import RoadSurfaceDataset, iter_predict_batches
+from feature_cache import load_feature_cache
 from model import SimpleClassifier
 from train import train_and_evaluate
+from predict import predict_and_save
+from export import load_backend
 from config import (DATA_FILE, FEATURES, NUM_EPOCHS, BATCH_SIZE, LEARNING_RATE, 
                     VALIDATION_SPLIT, TEST_SPLIT, SEED, MODEL_SAVE_PATH, NUM_FEATURES, 
-                    MODE, PREDICTION_OUTPUT_FILE, PREDICTION_STAT_FILE)
-import os
-import collections
+                    MODE, PREDICTION_OUTPUT_FILE, PREDICTION_STAT_FILE, PREDICT_BATCH_SIZE,
+                    USE_FEATURE_CACHE, SWEEP_WORKERS, SWEEP_RESULTS_FILE, INFERENCE_BACKEND, TRAIN_RESUME,
+                    UPDATE_TILES)
+# The sweep, windows, continual, enrich, daemon, serve and tiles modules are
+# imported in their branches below, so each mode only pays for the imports it needs
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or run the road surface classifier (see MODE)")
+    parser.add_argument("--resume", action="store_true",
+                        help="train: carry on from the last epoch checkpoint of an interrupted run")
+    args = parser.parse_args()
+
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
     if MODE == "train":
-        dataset = RoadSurfaceDataset(csv_file=DATA_FILE, feature_cols=FEATURES, mode="train")
+        cache = load_feature_cache(DATA_FILE, FEATURES) if USE_FEATURE_CACHE else None
+        dataset = RoadSurfaceDataset(csv_file=DATA_FILE, feature_cols=FEATURES, mode="train", cache=cache)
         num_classes = dataset.num_classes
         model = SimpleClassifier(num_features=NUM_FEATURES, num_classes=num_classes).to(device)
 
@@ -29,75 +40,121 @@ if __name__ == "__main__":
             test_split=TEST_SPLIT,
             seed=SEED,
             device=device,
-            model_save_path=MODEL_SAVE_PATH
+            model_save_path=MODEL_SAVE_PATH,
+            # Lets MODE=continue pick up from this model later
+            checkpoint_extra=cache.trained_rows_marker() if cache is not None else None,
+            resume=args.resume or TRAIN_RESUME
         )
         print(f"Training finished. Best test accuracy: {best_test_acc:.4f}")
 
     elif MODE == "predict":
-        dataset = RoadSurfaceDataset(csv_file=DATA_FILE, feature_cols=FEATURES, mode="predict")
+        # Load model and label maps; the exported backends run on the CPU
+        if INFERENCE_BACKEND != "eager":
+            device = torch.device("cpu")
+        model, idx2label = load_backend(INFERENCE_BACKEND, device)
+        print(f"Using the {INFERENCE_BACKEND} inference backend")
 
-        # Load model and label maps
-        checkpoint = torch.load(MODEL_SAVE_PATH, map_location=device)
-        label2idx = checkpoint['label2idx']
-        idx2label = checkpoint['idx2label']
-        num_classes = len(label2idx)
+        if USE_FEATURE_CACHE:
+            batches = load_feature_cache(DATA_FILE, FEATURES).iter_predict_batches(PREDICT_BATCH_SIZE)
+        else:
+            batches = iter_predict_batches(DATA_FILE, FEATURES, PREDICT_BATCH_SIZE)
 
-        model = SimpleClassifier(num_features=NUM_FEATURES, num_classes=num_classes).to(device)
-        model.load_state_dict(checkpoint['model_state_dict'])
-        model.eval()
-
-        predictions = []
-        predicted_classes = []
-        total_samples = len(dataset)
-
-        with torch.no_grad():
-            for i in range(len(dataset)):
-                features, original_row = dataset[i]
-                features = features.unsqueeze(0).to(device)
-                outputs = model(features)
-                _, preds = torch.max(outputs, 1)
-                pred_label = idx2label[preds.item()]
-                new_row = dict(original_row)
-                new_row["predicted_surfaceType"] = pred_label
-                predictions.append(new_row)
-                predicted_classes.append(pred_label)
-
-        # Write predictions to CSV
-        fieldnames = [
-            "@timestamp",
-            "rmsAcceleration",
-            "surfaceType",
-            "_id",
-            "location_lat",
-            "location_lon",
-            "accelerometer_x",
-            "accelerometer_y",
-            "accelerometer_z",
-            "gyroscope_x",
-            "gyroscope_y",
-            "gyroscope_z",
-            "predicted_surfaceType"
-        ]
-
-        with open(PREDICTION_OUTPUT_FILE, "w", newline="", encoding="utf-8") as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            for row in predictions:
-                writer.writerow(row)
-
-        # Create prediction stats
-        pred_count = len(predictions)
-        class_counter = collections.Counter(predicted_classes)
-
-        with open(PREDICTION_STAT_FILE, "w", encoding="utf-8") as f:
-            f.write(f"Total documents for prediction: {total_samples}\n")
-            f.write(f"Total documents predicted: {pred_count}\n")
-            f.write("Predicted class distribution:\n")
-            for cls, cnt in class_counter.items():
-                f.write(f"{cls}: {cnt}\n")
+        pred_count, total_samples = predict_and_save(
+            model=model,
+            batches=batches,
+            idx2label=idx2label,
+            device=device,
+            output_file=PREDICTION_OUTPUT_FILE,
+            stat_file=PREDICTION_STAT_FILE
+        )
 
         print(f"Prediction finished. {pred_count}/{total_samples} documents predicted.")
         print(f"Prediction stats saved to {PREDICTION_STAT_FILE}")
+        if UPDATE_TILES:
+            from tiles import update_tiles
+            update_tiles()
+
+    elif MODE == "sweep":
+        from sweep import load_sweep_spec, run_sweep, write_sweep_summary
+
+        # The workers share the memory-mapped feature cache
+        cache = load_feature_cache(DATA_FILE, FEATURES)
+        ranked = run_sweep(cache, load_sweep_spec(), SWEEP_WORKERS)
+        write_sweep_summary(ranked)
+        best = ranked[0]
+        print(f"Best trial {best['trial']}: batch_size={best['batch_size']} lr={best['lr']} "
+              f"num_epochs={best['num_epochs']}, mean val acc {best['mean_acc']:.4f} (+/- {best['std_acc']:.4f})")
+        print(f"Sweep results saved to {SWEEP_RESULTS_FILE}")
+
+        # Retrain the winner on the usual split and save it as the model
+        dataset = RoadSurfaceDataset(csv_file=DATA_FILE, feature_cols=FEATURES, mode="train", cache=cache)
+        model = SimpleClassifier(num_features=NUM_FEATURES, num_classes=dataset.num_classes).to(device)
+        best_test_acc = train_and_evaluate(
+            model=model,
+            dataset=dataset,
+            num_epochs=best['num_epochs'],
+            batch_size=best['batch_size'],
+            lr=best['lr'],
+            val_split=VALIDATION_SPLIT,
+            test_split=TEST_SPLIT,
+            seed=SEED,
+            device=device,
+            model_save_path=MODEL_SAVE_PATH,
+            checkpoint_extra=cache.trained_rows_marker()
+        )
+        print(f"Sweep finished. Best model saved to {MODEL_SAVE_PATH}, test accuracy: {best_test_acc:.4f}")
+
+    elif MODE == "windows":
+        from windows import build_windowed_csv
+
+        # Add the rolling-window trip features, for USE_WINDOW_FEATURES=true
+        build_windowed_csv()
+
+    elif MODE == "continue":
+        from continual import run_continual
+
+        # Fine-tune the saved model on the rows labelled since it was trained
+        test_acc = run_continual(load_feature_cache(DATA_FILE, FEATURES), device)
+        if test_acc is not None:
+            print(f"Continued training finished. Test accuracy: {test_acc:.4f}")
+
+    elif MODE == "enrich":
+        from enrich import connect, run_enrich, source_paths
+
+        # Fetch -> predict -> update straight from and to Elasticsearch.
+        # Checked before loading anything: every feature must be a document field.
+        source_paths(FEATURES)
+        # Load model and label maps; the exported backends run on the CPU
+        if INFERENCE_BACKEND != "eager":
+            device = torch.device("cpu")
+        model, idx2label = load_backend(INFERENCE_BACKEND, device)
+        print(f"Using the {INFERENCE_BACKEND} inference backend")
+        run_enrich(connect(), model, idx2label, FEATURES, device)
+
+    elif MODE == "daemon":
+        from daemon import run_daemon
+
+        # Keep the model warm and predict every CSV dropped into the input directory
+        if INFERENCE_BACKEND != "eager":
+            device = torch.device("cpu")
+        run_daemon(INFERENCE_BACKEND, device)
+
+    elif MODE == "serve":
+        from serve import run_server
+
+        # Answer prediction requests over HTTP, batching concurrent requests
+        if INFERENCE_BACKEND != "eager":
+            device = torch.device("cpu")
+        model, idx2label = load_backend(INFERENCE_BACKEND, device)
+        print(f"Using the {INFERENCE_BACKEND} inference backend")
+        run_server(model, idx2label, device)
+
+    elif MODE == "tiles":
+        from tiles import update_tiles
+
+        # Aggregate the predictions into map tiles for the app and Kibana
+        update_tiles()
 
     else:
-        raise ValueError("MODE must be either 'train' or 'predict'.")
+        raise ValueError("MODE must be either 'train', 'predict', 'sweep', 'windows', 'continue', 'enrich', 'daemon', "
+                         "'serve' or 'tiles'.")
@@ -7,10 +7,28 @@ import torch.nn.functional as F
 class SimpleClassifier(nn.Module):
     def __init__(self, num_features, num_classes):
         super(SimpleClassifier, self).__init__()
+        # The raw features are normalized inside the model, so the statistics
+        # are saved with the weights and every exported copy applies them too.
+        # The defaults leave the features unchanged.
+        self.register_buffer("feature_mean", torch.zeros(num_features))
+        self.register_buffer("feature_scale", torch.ones(num_features))
         self.fc1 = nn.Linear(num_features, 64)
         self.fc2 = nn.Linear(64, num_classes)
 
+    def set_normalization(self, mean, std):
+        with torch.no_grad():
+            self.feature_mean.copy_(torch.as_tensor(mean, dtype=torch.float32))
+            self.feature_scale.copy_(1 / torch.as_tensor(std, dtype=torch.float32))
+
     def forward(self, x):
+        x = (x - self.feature_mean) * self.feature_scale
         x = F.relu(self.fc1(x))
         x = self.fc2(x)
         return x
+
+def load_classifier(checkpoint, num_features):
+    # Rebuild the model saved in a checkpoint. Checkpoints from before the
+    # normalization buffers keep the unchanged features.
+    model = SimpleClassifier(num_features=num_features, num_classes=len(checkpoint['label2idx']))
+    model.load_state_dict({**model.state_dict(), **checkpoint['model_state_dict']})
+    return model
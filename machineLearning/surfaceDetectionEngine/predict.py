@@ -0,0 +1,53 @@
+# predict.py
+
+import numpy as np
+import torch
+
+OUTPUT_FIELDNAMES = [
+    "@timestamp",
+    "rmsAcceleration",
+    "surfaceType",
+    "_id",
+    "location_lat",
+    "location_lon",
+    "accelerometer_x",
+    "accelerometer_y",
+    "accelerometer_z",
+    "gyroscope_x",
+    "gyroscope_y",
+    "gyroscope_z",
+    "predicted_surfaceType"
+]
+
+
+def predict_and_save(model, batches, idx2label, device, output_file, stat_file):
+    # batches yields (features, rows) pairs. Run one forward pass per batch, append the chunk to the
+    # output CSV and move on. Only the per-class counts outlive a batch.
+    model.eval()
+    label_names = np.array([idx2label[i] for i in range(len(idx2label))], dtype=object)
+    class_counts = np.zeros(len(label_names), dtype=np.int64)
+    total_samples = 0
+
+    with open(output_file, "w", newline="", encoding="utf-8") as f:
+        f.write(",".join(OUTPUT_FIELDNAMES) + "\r\n")
+        with torch.no_grad():
+            for features, rows in batches:
+                outputs = model(features.to(device))
+                preds = torch.argmax(outputs, 1).cpu().numpy()
+                class_counts += np.bincount(preds, minlength=len(label_names))
+                total_samples += len(preds)
+
+                rows = rows.assign(predicted_surfaceType=label_names[preds])
+                rows.reindex(columns=OUTPUT_FIELDNAMES, fill_value="").to_csv(
+                    f, header=False, index=False, lineterminator="\r\n")
+
+    pred_count = int(class_counts.sum())
+    with open(stat_file, "w", encoding="utf-8") as f:
+        f.write(f"Total documents for prediction: {total_samples}\n")
+        f.write(f"Total documents predicted: {pred_count}\n")
+        f.write("Predicted class distribution:\n")
+        for idx, cnt in enumerate(class_counts):
+            if cnt:
+                f.write(f"{label_names[idx]}: {cnt}\n")
+
+    return pred_count, total_samples
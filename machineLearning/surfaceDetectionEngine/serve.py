@@ -0,0 +1,299 @@
+# serve.py
+#
+# A small asyncio HTTP service around the classifier:
+#   POST /predict   one sample, or a list of samples, in the app's layout, e.g.
+#                   {"rmsAcceleration": 1.2, "location": {"lat": 57.0, "lon": 9.9},
+#                    "accelerometer": {"x": 0.1, "y": 0.2, "z": 9.8},
+#                    "gyroscope": {"x": 0.0, "y": 0.0, "z": 0.1}}
+#                   The flattened CSV names (location_lat, ...) work as well.
+#                   Answers {"predicted_surfaceType": label} for one sample and
+#                   {"predicted_surfaceType": [labels]} for a list.
+#   GET  /metrics   latency percentiles and throughput counters
+#   GET  /health
+#   GET  /tiles/<zoom>/<x>/<y>
+#                   the MODE=tiles aggregate of one map tile
+#   GET  /tiles/<zoom>?bbox=<lat_min>,<lon_min>,<lat_max>,<lon_max>
+#                   the aggregates of the tiles overlapping a bounding box
+
+import asyncio
+import collections
+import json
+import math
+import time
+from urllib.parse import parse_qs
+import numpy as np
+import torch
+from tiles import TileSet
+from config import (FEATURES, SERVE_HOST, SERVE_PORT, SERVE_MAX_BATCH, SERVE_MAX_WAIT_MS,
+                    SERVE_MAX_REQUEST_SAMPLES, SERVE_LATENCY_WINDOW, TILES_DIR)
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+# Largest request body accepted, well above SERVE_MAX_REQUEST_SAMPLES samples
+MAX_BODY_BYTES = 1024 * 1024
+# Most tiles one bounding box query returns
+MAX_QUERY_TILES = 10000
+
+
+class RequestError(Exception):
+    # Turned into an error response with the given status
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _feature_value(sample, col):
+    # location_lat is read from {"location": {"lat": ...}} or {"location_lat": ...}
+    if col in sample:
+        return sample[col]
+    value = sample
+    for part in col.split("_"):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def sample_features(samples, feature_cols=FEATURES):
+    # One float32 row per sample; a missing, non-numeric or non-finite feature
+    # rejects the request, as it would drop the row from the dataset
+    rows = np.empty((len(samples), len(feature_cols)), dtype=np.float32)
+    for i, sample in enumerate(samples):
+        if not isinstance(sample, dict):
+            raise RequestError(400, f"sample {i} is not an object")
+        for j, col in enumerate(feature_cols):
+            value = _feature_value(sample, col)
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                raise RequestError(400, f"sample {i} has no numeric {col}")
+            if not math.isfinite(value):
+                raise RequestError(400, f"sample {i} has no finite numeric {col}")
+            rows[i, j] = value
+    return rows
+
+
+class ServeMetrics:
+    # Counters plus the latencies of the last SERVE_LATENCY_WINDOW requests.
+    # Only touched from the event loop, so no locking.
+    def __init__(self, window=SERVE_LATENCY_WINDOW):
+        self.start = time.time()
+        self.latencies = collections.deque(maxlen=window)
+        self.counts = {"requests": 0, "samples": 0, "errors": 0, "batches": 0, "batched_samples": 0}
+
+    def request(self, seconds, samples):
+        self.latencies.append(seconds)
+        self.counts["requests"] += 1
+        self.counts["samples"] += samples
+
+    def batch(self, samples):
+        self.counts["batches"] += 1
+        self.counts["batched_samples"] += samples
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        summary = {
+            "uptime_seconds": round(elapsed, 1),
+            **self.counts,
+            "requests_per_second": round(self.counts["requests"] / elapsed, 1) if elapsed > 0 else 0.0,
+            "samples_per_second": round(self.counts["samples"] / elapsed, 1) if elapsed > 0 else 0.0,
+            "mean_batch_size": round(self.counts["batched_samples"] / self.counts["batches"], 2)
+            if self.counts["batches"] else 0.0,
+        }
+        if self.latencies:
+            ms = np.array(self.latencies) * 1000
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            summary["latency_ms"] = {"window": len(ms), "p50": round(float(p50), 3), "p95": round(float(p95), 3),
+                                     "p99": round(float(p99), 3), "max": round(float(ms.max()), 3)}
+        return summary
+
+
+class MicroBatcher:
+    # Requests put their rows on a queue and await a future. One task takes
+    # the first waiting request, adds whatever else arrives within max_wait
+    # up to max_batch rows, and runs a single forward pass for all of them on
+    # a worker thread, so the event loop keeps accepting requests meanwhile.
+    def __init__(self, model, idx2label, device, metrics, max_batch=SERVE_MAX_BATCH,
+                 max_wait=SERVE_MAX_WAIT_MS / 1000):
+        self.model = model
+        self.label_names = np.array([idx2label[i] for i in range(len(idx2label))], dtype=object)
+        self.device = device
+        self.metrics = metrics
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.pending = asyncio.Queue()
+        # A request that did not fit into the previous batch starts the next one
+        self.carry = None
+
+    async def predict(self, rows):
+        future = asyncio.get_running_loop().create_future()
+        await self.pending.put((rows, future))
+        return await future
+
+    def _forward(self, features):
+        with torch.no_grad():
+            outputs = self.model(torch.from_numpy(features).to(self.device))
+            return torch.argmax(outputs, 1).cpu().numpy()
+
+    async def _next_batch(self):
+        first = self.carry or await self.pending.get()
+        self.carry = None
+        batch = [first]
+        size = len(first[0])
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - asyncio.get_running_loop().time()
+            try:
+                item = self.pending.get_nowait() if timeout <= 0 else \
+                    await asyncio.wait_for(self.pending.get(), timeout)
+            except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                break
+            if size + len(item[0]) > self.max_batch:
+                self.carry = item
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            features = np.concatenate([rows for rows, _ in batch])
+            try:
+                preds = await loop.run_in_executor(None, self._forward, features)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.metrics.batch(len(features))
+            labels = self.label_names[preds]
+            start = 0
+            for rows, future in batch:
+                # A client that went away cancelled its future
+                if not future.done():
+                    future.set_result(labels[start:start + len(rows)].tolist())
+                start += len(rows)
+
+
+class InferenceServer:
+    def __init__(self, model, idx2label, device, max_batch=SERVE_MAX_BATCH, max_wait_ms=SERVE_MAX_WAIT_MS):
+        model.eval()
+        self.metrics = ServeMetrics()
+        self.batcher = MicroBatcher(model, idx2label, device, self.metrics, max_batch, max_wait_ms / 1000)
+        self.tiles_dir = TILES_DIR
+        self.tile_set = None
+
+    def _tiles(self, parts, query):
+        # Opened on first use and reopened when MODE=tiles rewrote them
+        if self.tile_set is None or self.tile_set.changed():
+            try:
+                self.tile_set = TileSet(self.tiles_dir)
+            except FileNotFoundError as e:
+                raise RequestError(404, str(e))
+        try:
+            numbers = [int(part) for part in parts]
+            if not self.tile_set.has_zoom(numbers[0]):
+                raise RequestError(404, f"no tiles at zoom {numbers[0]}, built zooms: "
+                                        f"{', '.join(str(zoom) for zoom in self.tile_set.index['zooms'])}")
+            if len(numbers) == 3:
+                tile = self.tile_set.tile(*numbers)
+                if tile is None:
+                    raise RequestError(404, "no predictions in this tile")
+                return tile
+            lat_min, lon_min, lat_max, lon_max = (float(v) for v in parse_qs(query)["bbox"][0].split(","))
+        except (ValueError, KeyError, TypeError):
+            raise RequestError(400, "use /tiles/<zoom>/<x>/<y> or /tiles/<zoom>?bbox=<lat_min>,<lon_min>,<lat_max>,<lon_max>")
+        return {"tiles": self.tile_set.query(numbers[0], lat_min, lon_min, lat_max, lon_max, MAX_QUERY_TILES)}
+
+    async def _predict(self, body):
+        start = time.perf_counter()
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            raise RequestError(400, "body is not JSON")
+        single = isinstance(payload, dict)
+        samples = [payload] if single else payload
+        if not isinstance(samples, list) or not samples:
+            raise RequestError(400, "expected a sample object or a non-empty list of samples")
+        if len(samples) > SERVE_MAX_REQUEST_SAMPLES:
+            raise RequestError(413, f"at most {SERVE_MAX_REQUEST_SAMPLES} samples per request")
+        labels = await self.batcher.predict(sample_features(samples))
+        self.metrics.request(time.perf_counter() - start, len(samples))
+        return {"predicted_surfaceType": labels[0] if single else labels}
+
+    async def handle(self, method, path, body):
+        # Returns (status, response object)
+        path, _, query = path.partition("?")
+        if path == "/predict":
+            if method != "POST":
+                raise RequestError(405, "use POST")
+            return 200, await self._predict(body)
+        if path == "/metrics" and method == "GET":
+            return 200, self.metrics.summary()
+        if path == "/health" and method == "GET":
+            return 200, {"status": "ok"}
+        parts = path.strip("/").split("/")
+        if parts[0] == "tiles" and len(parts) in (2, 4) and method == "GET":
+            return 200, self._tiles(parts[1:], query)
+        raise RequestError(404, f"no route for {method} {path}")
+
+    async def serve_connection(self, reader, writer):
+        # HTTP/1.1 with keep-alive, one request at a time per connection
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                keep_alive = headers.get("connection", "").lower() != "close" and version.strip() == "HTTP/1.1"
+
+                try:
+                    if length > MAX_BODY_BYTES:
+                        keep_alive = False
+                        raise RequestError(413, f"body larger than {MAX_BODY_BYTES} bytes")
+                    body = await reader.readexactly(length) if length else b""
+                    status, response = await self.handle(method, path, body)
+                except RequestError as e:
+                    self.metrics.counts["errors"] += 1
+                    status, response = e.status, {"error": str(e)}
+                except Exception as e:
+                    self.metrics.counts["errors"] += 1
+                    status, response = 500, {"error": str(e)}
+
+                data = json.dumps(response).encode("utf-8")
+                writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\n"
+                             f"Content-Length: {len(data)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                             + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=SERVE_HOST, port=SERVE_PORT):
+        batcher_task = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.serve_connection, host, port)
+        print(f"Serving predictions on http://{host}:{port}/predict (max batch {self.batcher.max_batch}, "
+              f"max wait {self.batcher.max_wait * 1000:g} ms)")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+
+
+def run_server(model, idx2label, device, host=SERVE_HOST, port=SERVE_PORT):
+    asyncio.run(InferenceServer(model, idx2label, device).serve(host, port))
@@ -0,0 +1,114 @@
+# smoke_test.py
+#
+# End-to-end runs of the training modes on a small synthetic CSV in a
+# temporary directory, to catch a broken mode before it reaches /data, e.g.
+#   python smoke_test.py
+# (pytest collects the same checks.)
+
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import torch
+import train
+from continual import run_continual
+from dataset import RoadSurfaceDataset, iter_predict_batches
+from feature_cache import load_feature_cache
+from model import SimpleClassifier
+from predict import predict_and_save
+from config import FEATURES, NUM_FEATURES, VALIDATION_SPLIT, TEST_SPLIT, SEED, PREDICT_BATCH_SIZE
+
+SURFACES = ["asphalt", "gravel", "cobblestone"]
+
+
+def synthetic_rows(num_rows, start=0, seed=SEED, predict_fraction=0.2):
+    # Rows in the fetched CSV's layout. The surface follows from the
+    # accelerometer's z spread, so there is something to learn.
+    rng = np.random.default_rng(seed + start)
+    surface = rng.integers(len(SURFACES), size=num_rows)
+    rows = {
+        "@timestamp": pd.date_range("2024-11-22", periods=num_rows, freq="s").shift(start)
+                        .strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        "rmsAcceleration": rng.gamma(2.0, 0.5, num_rows),
+        "surfaceType": np.where(rng.random(num_rows) < predict_fraction, "none", np.array(SURFACES)[surface]),
+        "_id": [f"smoke{i}" for i in range(start, start + num_rows)],
+        "location_lat": rng.uniform(55.0, 57.5, num_rows),
+        "location_lon": rng.uniform(8.0, 12.5, num_rows),
+    }
+    for col in FEATURES:
+        if col not in rows:
+            rows[col] = rng.normal(0.0, 1.0, num_rows)
+    rows["accelerometer_z"] = rng.normal(9.8, 0.2 + surface, num_rows)
+    return pd.DataFrame(rows)
+
+
+def write_csv(path, frame, append=False):
+    frame.to_csv(path, mode="a" if append else "w", header=not append, index=False, lineterminator="\r\n")
+
+
+def train_base_model(tmp, csv_file, num_epochs=1):
+    # MODE=train on csv_file, saving to tmp/best_model.pth without exports
+    train.EXPORT_MODELS = False
+    train.TRAIN_STAT_FILE = os.path.join(tmp, "train_stat.txt")
+    cache = load_feature_cache(csv_file, FEATURES)
+    dataset = RoadSurfaceDataset(csv_file=csv_file, feature_cols=FEATURES, mode="train", cache=cache)
+    model = SimpleClassifier(num_features=NUM_FEATURES, num_classes=dataset.num_classes)
+    model_save_path = os.path.join(tmp, "best_model.pth")
+    train.train_and_evaluate(model, dataset, num_epochs, 64, 0.001, VALIDATION_SPLIT, TEST_SPLIT, SEED,
+                             torch.device("cpu"), model_save_path, checkpoint_extra=cache.trained_rows_marker(),
+                             epoch_checkpoint_path=os.path.join(tmp, "train_checkpoint.pth"))
+    return model_save_path
+
+
+def test_predict_cache():
+    # Predicting from the feature cache writes the same predictions.csv as
+    # reading the CSV, byte for byte, also for cells that to_numeric or a
+    # float round trip would change and after the cache was extended
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_file = os.path.join(tmp, "training_data.csv")
+        frame = synthetic_rows(3000, predict_fraction=0.5).astype({col: object for col in FEATURES})
+        odd_cells = ["-0.36249558968465145", "1.50", "1e-05", " 2", "abc", "", "nan", "inf"]
+        for i, cell in enumerate(odd_cells):
+            frame.loc[frame.index[10 + i * 7], [FEATURES[i % len(FEATURES)], "surfaceType"]] = [cell, "none"]
+        write_csv(csv_file, frame.iloc[:2000])
+        load_feature_cache(csv_file, FEATURES)
+        write_csv(csv_file, frame.iloc[2000:], append=True)
+        cache = load_feature_cache(csv_file, FEATURES)
+
+        torch.manual_seed(SEED)
+        model = SimpleClassifier(num_features=NUM_FEATURES, num_classes=len(cache.idx2label))
+        outputs = []
+        for name, batches in (("cached", cache.iter_predict_batches(PREDICT_BATCH_SIZE)),
+                              ("uncached", iter_predict_batches(csv_file, FEATURES, PREDICT_BATCH_SIZE))):
+            output_file = os.path.join(tmp, f"predictions.{name}.csv")
+            predict_and_save(model, batches, cache.idx2label, torch.device("cpu"), output_file,
+                             os.path.join(tmp, f"prediction_stat.{name}.txt"))
+            with open(output_file, "rb") as f:
+                outputs.append(f.read())
+        assert outputs[0] == outputs[1], "cached and uncached predictions.csv differ"
+        assert b"-0.36249558968465145" in outputs[0] and b",abc," not in outputs[0]
+
+
+def test_continue():
+    # MODE=continue fine-tunes the base model on appended rows
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_file = os.path.join(tmp, "training_data.csv")
+        write_csv(csv_file, synthetic_rows(3000))
+        model_save_path = train_base_model(tmp, csv_file)
+
+        write_csv(csv_file, synthetic_rows(1000, start=3000), append=True)
+        cache = load_feature_cache(csv_file, FEATURES)
+        test_acc = run_continual(cache, torch.device("cpu"), model_save_path, epochs=1, batch_size=64)
+        assert test_acc is not None, "continue found no new rows to train on"
+        checkpoint = torch.load(model_save_path, map_location="cpu")
+        assert checkpoint["trained_rows"] == cache.num_labelled
+
+        # Nothing new on a second run
+        assert run_continual(cache, torch.device("cpu"), model_save_path, epochs=1, batch_size=64) is None
+
+
+if __name__ == "__main__":
+    for name, check in list(globals().items()):
+        if name.startswith("test_"):
+            check()
+            print(f"{name}: ok")
@@ -0,0 +1,145 @@
+# sweep.py
+
+import csv
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+from dataset import RunningStats
+from feature_cache import FeatureCache
+from model import SimpleClassifier
+from train import fit
+from config import (SEED, NUM_FEATURES, SWEEP_SPEC_FILE, DEFAULT_SWEEP_SPEC, SWEEP_RESULTS_FILE,
+                    SWEEP_SUMMARY_FILE, CSV_CHUNK_SIZE)
+
+PARAM_NAMES = ["batch_size", "lr", "num_epochs"]
+
+# Set in each worker by _init_worker
+_worker_data = {}
+
+
+def load_sweep_spec(path=SWEEP_SPEC_FILE):
+    if not os.path.exists(path):
+        return DEFAULT_SWEEP_SPEC
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _sample(values, rng):
+    # A list is sampled from, {"min", "max", "log"} is a continuous range
+    if isinstance(values, list):
+        return rng.choice(values)
+    low, high = values["min"], values["max"]
+    if values.get("log"):
+        return math.exp(rng.uniform(math.log(low), math.log(high)))
+    value = rng.uniform(low, high)
+    return round(value) if isinstance(low, int) and isinstance(high, int) else value
+
+
+def expand_trials(spec, seed=SEED):
+    # The parameter sets to try: every combination for a grid search, or
+    # spec["trials"] random draws
+    params = spec["params"]
+    if spec.get("search", "grid") == "grid":
+        lists = [params[name] for name in PARAM_NAMES]
+        return [dict(zip(PARAM_NAMES, values)) for values in itertools.product(*lists)]
+    rng = random.Random(seed)
+    return [{name: _sample(params[name], rng) for name in PARAM_NAMES} for _ in range(spec["trials"])]
+
+
+def kfold_indices(num_rows, folds, seed=SEED):
+    # (train, validation) index arrays of each fold over a seeded shuffle
+    indices = np.random.RandomState(seed).permutation(num_rows)
+    parts = np.array_split(indices, folds)
+    return [(np.concatenate(parts[:k] + parts[k + 1:]), parts[k]) for k in range(folds)]
+
+
+def fold_stats(features, folds, chunk_size=CSV_CHUNK_SIZE):
+    # The normalization statistics of each fold's training rows only, so no
+    # fold is normalized with its own validation rows
+    all_stats = []
+    for train_idx, _ in folds:
+        stats = RunningStats(features.shape[1])
+        for start in range(0, len(train_idx), chunk_size):
+            stats.update(features[train_idx[start:start + chunk_size]])
+        all_stats.append(stats)
+    return all_stats
+
+
+def _init_worker(cache_dir, meta, threads, folds, seed, stats):
+    # Each worker maps the feature cache itself, so the dataset is shared
+    # through the page cache instead of pickled into every process. Torch
+    # threads are capped so the workers together fill the cores once.
+    torch.set_num_threads(threads)
+    cache = FeatureCache(cache_dir, meta)
+    _worker_data["features"] = torch.from_numpy(cache.features_for("train"))
+    _worker_data["labels"] = torch.from_numpy(cache.labels)
+    _worker_data["num_classes"] = len(cache.label2idx)
+    _worker_data["fold_stats"] = stats
+    _worker_data["folds"] = [(torch.from_numpy(train_idx), torch.from_numpy(val_idx))
+                             for train_idx, val_idx in kfold_indices(cache.num_labelled, folds, seed)]
+
+
+def _run_fold(trial_id, fold, params, seed):
+    torch.manual_seed(seed + trial_id)
+    start = time.time()
+    model = SimpleClassifier(num_features=NUM_FEATURES, num_classes=_worker_data["num_classes"])
+    stats = _worker_data["fold_stats"][fold]
+    model.set_normalization(stats.mean, stats.std())
+    train_idx, val_idx = _worker_data["folds"][fold]
+    val_acc, _ = fit(model, _worker_data["features"], _worker_data["labels"], train_idx, val_idx,
+                     num_epochs=params["num_epochs"], batch_size=params["batch_size"], lr=params["lr"],
+                     device=torch.device("cpu"))
+    return trial_id, fold, val_acc, time.time() - start
+
+
+def run_sweep(cache, spec, workers, seed=SEED):
+    # Run every trial on every fold in a process pool and return the trials
+    # ranked by mean validation accuracy
+    trials = expand_trials(spec, seed)
+    num_folds = spec.get("folds", 5)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f"Sweeping {len(trials)} trials x {num_folds} folds on {workers} workers ({threads} torch threads each)")
+
+    results = [{"trial": i, **params, "fold_acc": [None] * num_folds, "seconds": 0.0}
+               for i, params in enumerate(trials)]
+    start = time.time()
+    stats = fold_stats(cache.features_for("train"), kfold_indices(cache.num_labelled, num_folds, seed))
+    # spawn rather than fork, so no torch thread pool state is inherited
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(cache.cache_dir, cache.meta, threads, num_folds, seed, stats)) as executor:
+        futures = [executor.submit(_run_fold, i, k, params, seed)
+                   for i, params in enumerate(trials) for k in range(num_folds)]
+        for done, future in enumerate(futures, start=1):
+            trial_id, fold, val_acc, seconds = future.result()
+            results[trial_id]["fold_acc"][fold] = val_acc
+            results[trial_id]["seconds"] += seconds
+            print(f"[{done}/{len(futures)}] trial {trial_id} fold {fold}: val acc {val_acc:.4f}")
+
+    for result in results:
+        result["mean_acc"] = float(np.mean(result["fold_acc"]))
+        result["std_acc"] = float(np.std(result["fold_acc"]))
+        result["seconds"] = round(result["seconds"], 2)
+    ranked = sorted(results, key=lambda r: r["mean_acc"], reverse=True)
+    for rank, result in enumerate(ranked, start=1):
+        result["rank"] = rank
+    print(f"Sweep finished in {time.time() - start:.1f}s")
+    return ranked
+
+
+def write_sweep_summary(ranked, json_path=SWEEP_RESULTS_FILE, csv_path=SWEEP_SUMMARY_FILE):
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(ranked, f, indent=2)
+    fieldnames = ["rank", "trial"] + PARAM_NAMES + ["mean_acc", "std_acc", "fold_acc", "seconds"]
+    with open(csv_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        for result in ranked:
+            writer.writerow({**result, "fold_acc": " ".join(f"{acc:.4f}" for acc in result["fold_acc"])})
@@ -0,0 +1,304 @@
+# tiles.py
+
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+from config import PREDICTION_OUTPUT_FILE, DAEMON_OUTPUT_DIR, TILES_DIR, TILE_ZOOMS, CSV_CHUNK_SIZE
+
+# Bump when the on-disk layout changes so old tile sets are rebuilt
+TILES_VERSION = 1
+TILES_FILE = "tiles.npy"
+INDEX_FILE = "index.json"
+PARTS_DIR = "parts"
+# A tile's zoom, x and y are packed into one int64 key, so sorting by key
+# sorts by zoom, then x, then y. x and y take KEY_BITS bits each.
+KEY_BITS = 29
+MAX_ZOOM = KEY_BITS
+# Web Mercator stops here
+MAX_LATITUDE = 85.05112878
+
+
+def tile_dtype(num_labels):
+    # One record per tile: samples, the mean rmsAcceleration as a sum over
+    # the samples that had one, and the samples per predicted label
+    return np.dtype([
+        ("key", "<i8"),
+        ("samples", "<u4"),
+        ("rms_samples", "<u4"),
+        ("rms_sum", "<f8"),
+        ("class_counts", "<u4", (num_labels,)),
+    ])
+
+
+def tile_xy(lat, lon, zoom):
+    # Slippy-map tile column and row of each point, as OpenStreetMap and
+    # flutter_map number them
+    n = 1 << zoom
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    x = np.floor((lon + 180.0) / 360.0 * n)
+    y = np.floor((1.0 - np.arcsinh(np.tan(lat)) / np.pi) / 2.0 * n)
+    return np.clip(x, 0, n - 1).astype(np.int64), np.clip(y, 0, n - 1).astype(np.int64)
+
+
+def tile_key(zoom, x, y):
+    return (np.int64(zoom) << (2 * KEY_BITS)) | (np.asarray(x, dtype=np.int64) << KEY_BITS) | y
+
+
+def split_key(key):
+    mask = (1 << KEY_BITS) - 1
+    return int(key >> (2 * KEY_BITS)), int((key >> KEY_BITS) & mask), int(key & mask)
+
+
+def aggregate(lat, lon, rms, labels, num_labels, zooms=TILE_ZOOMS):
+    # Tiles of the points (lat, lon, rmsAcceleration, label index) at every
+    # zoom, sorted by key. One np.unique and a few bincounts, no loop per point.
+    keys = np.concatenate([tile_key(zoom, *tile_xy(lat, lon, zoom)) for zoom in zooms])
+    labels = np.tile(labels, len(zooms))
+    rms = np.tile(rms, len(zooms))
+    has_rms = np.isfinite(rms)
+
+    unique, inverse = np.unique(keys, return_inverse=True)
+    tiles = np.zeros(len(unique), dtype=tile_dtype(num_labels))
+    tiles["key"] = unique
+    tiles["samples"] = np.bincount(inverse, minlength=len(unique))
+    tiles["rms_samples"] = np.bincount(inverse, weights=has_rms, minlength=len(unique))
+    tiles["rms_sum"] = np.bincount(inverse, weights=np.where(has_rms, rms, 0.0), minlength=len(unique))
+    tiles["class_counts"] = np.bincount(inverse * num_labels + labels,
+                                        minlength=len(unique) * num_labels).reshape(len(unique), num_labels)
+    return tiles
+
+
+def widen(tiles, num_labels):
+    # The same tiles with room for labels added since they were aggregated
+    if tiles.dtype["class_counts"].shape[0] == num_labels:
+        return tiles
+    wider = np.zeros(len(tiles), dtype=tile_dtype(num_labels))
+    for name in ("key", "samples", "rms_samples", "rms_sum"):
+        wider[name] = tiles[name]
+    wider["class_counts"][:, :tiles.dtype["class_counts"].shape[0]] = tiles["class_counts"]
+    return wider
+
+
+def merge_tiles(parts, num_labels):
+    # Add up tile sets; tiles with the same key are summed
+    tiles = np.concatenate([widen(part, num_labels) for part in parts]) if parts \
+        else np.zeros(0, dtype=tile_dtype(num_labels))
+    tiles = tiles[np.argsort(tiles["key"], kind="stable")]
+    unique, starts = np.unique(tiles["key"], return_index=True)
+    if len(unique) == len(tiles):
+        return tiles
+    merged = np.zeros(len(unique), dtype=tiles.dtype)
+    merged["key"] = unique
+    for name in ("samples", "rms_samples", "rms_sum", "class_counts"):
+        merged[name] = np.add.reduceat(tiles[name], starts, axis=0)
+    return merged
+
+
+def aggregate_file(path, labels, zooms=TILE_ZOOMS, chunk_size=CSV_CHUNK_SIZE):
+    # Tiles of the predicted rows of one predictions CSV. Labels not in
+    # `labels` yet are appended to it. Rows without a usable location or
+    # prediction are skipped.
+    label_index = {label: i for i, label in enumerate(labels)}
+    parts = []
+    rows = 0
+    columns = ["location_lat", "location_lon", "rmsAcceleration", "predicted_surfaceType"]
+    for chunk in pd.read_csv(path, usecols=lambda col: col in columns, dtype=str, keep_default_na=False,
+                             chunksize=chunk_size, encoding="utf-8"):
+        if "predicted_surfaceType" not in chunk or "location_lat" not in chunk or "location_lon" not in chunk:
+            return None, 0
+        lat = pd.to_numeric(chunk["location_lat"], errors="coerce").to_numpy(dtype=np.float64)
+        lon = pd.to_numeric(chunk["location_lon"], errors="coerce").to_numpy(dtype=np.float64)
+        rms = pd.to_numeric(chunk.get("rmsAcceleration", pd.Series(index=chunk.index, dtype=str)),
+                            errors="coerce").to_numpy(dtype=np.float64)
+        predicted = chunk["predicted_surfaceType"].to_numpy(dtype=object)
+        usable = np.isfinite(lat) & np.isfinite(lon) & (predicted != "")
+        for label in pd.unique(predicted[usable]):
+            if label not in label_index:
+                label_index[label] = len(labels)
+                labels.append(label)
+        codes = np.array([label_index[label] for label in predicted[usable]], dtype=np.int64)
+        parts.append(aggregate(lat[usable], lon[usable], rms[usable], codes, len(labels), zooms))
+        rows += int(usable.sum())
+    return merge_tiles(parts, len(labels)), rows
+
+
+def prediction_sources():
+    # The batch predictions file and the daemon's per-file predictions
+    sources = [PREDICTION_OUTPUT_FILE] if os.path.exists(PREDICTION_OUTPUT_FILE) else []
+    if os.path.isdir(DAEMON_OUTPUT_DIR):
+        sources += sorted(entry.path for entry in os.scandir(DAEMON_OUTPUT_DIR)
+                          if entry.is_file() and entry.name.endswith(".csv"))
+    return sources
+
+
+def _fingerprint(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _part_name(path):
+    return f"{os.path.splitext(os.path.basename(path))[0]}-{hashlib.sha1(path.encode()).hexdigest()[:8]}.npy"
+
+
+def _save_array(path, array):
+    # Written next to path and renamed, so readers never see half a file
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(path + ".tmp", path)
+
+
+def load_index(tiles_dir=TILES_DIR):
+    path = os.path.join(tiles_dir, INDEX_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def update_tiles(sources=None, tiles_dir=TILES_DIR, zooms=TILE_ZOOMS):
+    # Bring the tile set in tiles_dir up to date with the prediction CSVs.
+    # Each source's tiles are kept as a part, so only new or changed sources
+    # are read again; merging the parts is O(tiles). Returns the index.
+    start = time.time()
+    sources = [os.path.abspath(path) for path in (prediction_sources() if sources is None else sources)]
+    zooms = sorted(set(zooms))
+    if zooms[-1] > MAX_ZOOM:
+        raise ValueError(f"TILE_ZOOMS may go up to {MAX_ZOOM}")
+    parts_dir = os.path.join(tiles_dir, PARTS_DIR)
+    os.makedirs(parts_dir, exist_ok=True)
+
+    old = load_index(tiles_dir)
+    if old is not None and (old.get("version") != TILES_VERSION or old.get("zooms") != zooms):
+        print("Tile settings changed, rebuilding the tiles")
+        old = None
+    old_sources = old["sources"] if old is not None else {}
+    labels = list(old["labels"]) if old is not None else []
+
+    index_sources = {}
+    parts = []
+    read = 0
+    for path in sources:
+        fingerprint = _fingerprint(path)
+        entry = old_sources.get(path)
+        part_path = os.path.join(parts_dir, _part_name(path))
+        if entry is not None and entry["fingerprint"] == fingerprint and os.path.exists(part_path):
+            part = np.load(part_path)
+        else:
+            part, rows = aggregate_file(path, labels, zooms)
+            if part is None:
+                print(f"Skipping {path}: no predicted_surfaceType or location columns")
+                continue
+            _save_array(part_path, part)
+            entry = {"fingerprint": fingerprint, "part": os.path.basename(part_path), "rows": rows}
+            read += 1
+        index_sources[path] = entry
+        parts.append(part)
+
+    tiles_path = os.path.join(tiles_dir, TILES_FILE)
+    if old is not None and read == 0 and index_sources.keys() == old_sources.keys() and os.path.exists(tiles_path):
+        print(f"Tiles are up to date ({old['num_tiles']} tiles from {len(index_sources)} prediction files)")
+        return old
+
+    tiles = merge_tiles(parts, len(labels))
+    _save_array(tiles_path, tiles)
+    # The zoom ranges are the index: each zoom's tiles are one sorted slice
+    zoom_of = tiles["key"] >> (2 * KEY_BITS)
+    ranges = {str(zoom): [int(np.searchsorted(zoom_of, zoom)), int(np.searchsorted(zoom_of, zoom, side="right"))]
+              for zoom in zooms}
+    index = {
+        "version": TILES_VERSION,
+        "zooms": zooms,
+        "labels": labels,
+        "num_tiles": len(tiles),
+        "zoom_ranges": ranges,
+        "sources": index_sources,
+    }
+    index_path = os.path.join(tiles_dir, INDEX_FILE)
+    with open(index_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2)
+    os.replace(index_path + ".tmp", index_path)
+
+    # Parts of sources that are gone
+    kept = {entry["part"] for entry in index_sources.values()}
+    for entry in os.scandir(parts_dir):
+        if entry.name.endswith(".npy") and entry.name not in kept:
+            os.remove(entry.path)
+
+    samples = sum(entry["rows"] for entry in index_sources.values())
+    print(f"Wrote {len(tiles)} tiles ({', '.join(f'zoom {z}: {r[1] - r[0]}' for z, r in ranges.items())}) "
+          f"of {samples} predictions from {len(index_sources)} files ({read} read) to {tiles_dir} "
+          f"in {time.time() - start:.2f}s")
+    return index
+
+
+class TileSet:
+    # Read-only view of a tile set. The tiles are memory-mapped and sorted by
+    # key, so a tile is a binary search and a bounding box a few slices.
+    def __init__(self, tiles_dir=TILES_DIR):
+        self.tiles_dir = tiles_dir
+        self.index = load_index(tiles_dir)
+        if self.index is None:
+            raise FileNotFoundError(f"No tiles in {tiles_dir}, run MODE=tiles first")
+        self.tiles = np.load(os.path.join(tiles_dir, TILES_FILE), mmap_mode="r")
+        self.labels = self.index["labels"]
+        self.mtime_ns = os.stat(os.path.join(tiles_dir, INDEX_FILE)).st_mtime_ns
+
+    def changed(self):
+        try:
+            return os.stat(os.path.join(self.tiles_dir, INDEX_FILE)).st_mtime_ns != self.mtime_ns
+        except FileNotFoundError:
+            return False
+
+    def record(self, i):
+        tile = self.tiles[i]
+        zoom, x, y = split_key(tile["key"])
+        counts = {label: int(count) for label, count in zip(self.labels, tile["class_counts"]) if count}
+        return {
+            "zoom": zoom,
+            "x": x,
+            "y": y,
+            "samples": int(tile["samples"]),
+            "mean_rmsAcceleration": float(tile["rms_sum"] / tile["rms_samples"]) if tile["rms_samples"] else None,
+            "predicted_surfaceType": max(counts, key=counts.get) if counts else None,
+            "class_counts": counts,
+        }
+
+    def has_zoom(self, zoom):
+        return zoom in self.index["zooms"]
+
+    def tile(self, zoom, x, y):
+        # The tile's record, or None if no prediction fell into it. Zooms that
+        # were not built and x/y outside the zoom's grid have no tiles (and
+        # would not fit the key's fields).
+        if not self.has_zoom(zoom) or not (0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom):
+            return None
+        key = tile_key(zoom, x, y)
+        i = int(np.searchsorted(self.tiles["key"], key))
+        if i < len(self.tiles) and self.tiles["key"][i] == key:
+            return self.record(i)
+        return None
+
+    def query(self, zoom, lat_min, lon_min, lat_max, lon_max, limit=None):
+        # Records of the tiles at zoom overlapping the bounding box
+        if not self.has_zoom(zoom):
+            return []
+        start, stop = self.index["zoom_ranges"].get(str(zoom), (0, 0))
+        x0, y0 = (int(v) for v in tile_xy(np.float64(lat_max), np.float64(lon_min), zoom))
+        x1, y1 = (int(v) for v in tile_xy(np.float64(lat_min), np.float64(lon_max), zoom))
+        keys = self.tiles["key"]
+        if x1 - x0 + 1 < stop - start:
+            # One slice per tile column
+            hits = []
+            for x in range(x0, x1 + 1):
+                lo = int(np.searchsorted(keys, tile_key(zoom, x, y0)))
+                hi = int(np.searchsorted(keys, tile_key(zoom, x, y1), side="right"))
+                hits.extend(range(lo, hi))
+        else:
+            mask = (1 << KEY_BITS) - 1
+            zoom_keys = np.asarray(keys[start:stop])
+            x, y = (zoom_keys >> KEY_BITS) & mask, zoom_keys & mask
+            hits = (start + np.flatnonzero((x >= x0) & (x <= x1) & (y >= y0) & (y <= y1))).tolist()
+        return [self.record(i) for i in hits[:limit]]
@@ -5,48 +5,249 @@ import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import DataLoader, Subset
 import numpy as np
-import copy
-from sklearn.metrics import classification_report, confusion_matrix
-from config import TRAIN_STAT_FILE
+import math
+import os
+from dataset import hash_splits, TRAIN, VALIDATION, TEST
+from export import export_models
+from config import (TRAIN_STAT_FILE, TRAIN_ON_TENSORS, EVAL_BATCH_SIZE, EXPORT_MODELS, TRAIN_CHECKPOINT_PATH,
+                    EARLY_STOPPING_PATIENCE)
 
-def train_and_evaluate(model, dataset, num_epochs, batch_size, lr, val_split, test_split, seed, device, model_save_path, log_interval=10):
+def tensor_batches(features, labels, batch_size, shuffle):
+    # Batches sliced straight out of preloaded tensors, one randperm per epoch
+    # instead of per-sample __getitem__ calls and collate
+    order = torch.randperm(features.shape[0], device=features.device) if shuffle else None
+    for start in range(0, features.shape[0], batch_size):
+        if order is None:
+            yield features[start:start + batch_size], labels[start:start + batch_size]
+        else:
+            idx = order[start:start + batch_size]
+            yield features.index_select(0, idx), labels.index_select(0, idx)
+
+def predict_all(model, batches, device):
+    # Concatenated predictions and targets over all batches
+    model.eval()
+    all_preds = []
+    all_targets = []
+    with torch.no_grad():
+        for inputs, labels in batches:
+            outputs = model(inputs.to(device))
+            all_preds.append(torch.argmax(outputs, 1))
+            all_targets.append(labels.to(device))
+    return torch.cat(all_preds), torch.cat(all_targets)
+
+class BestWeights:
+    # The weights of the best epoch so far, copied in place into buffers
+    # allocated once instead of deep-copying the state dict on every improvement
+    def __init__(self, model):
+        self.state = {name: tensor.detach().clone() for name, tensor in model.state_dict().items()}
+        self.acc = 0.0
+        self.epoch = 0
+
+    def update(self, model, acc, epoch):
+        # Returns True if acc is an improvement
+        if acc <= self.acc:
+            return False
+        self.restore(model.state_dict(), acc, epoch)
+        return True
+
+    def restore(self, state_dict, acc, epoch):
+        with torch.no_grad():
+            for name, tensor in state_dict.items():
+                self.state[name].copy_(tensor)
+        self.acc = acc
+        self.epoch = epoch
+
+def save_epoch_checkpoint(path, epoch, model, optimizer, best, stale_epochs, run):
+    # Everything needed to carry on after `epoch` (1-based) as if uninterrupted.
+    # Written next to path and renamed, so a crash never leaves half a file.
+    torch.save({
+        'epoch': epoch,
+        'run': run,
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'best_state_dict': best.state,
+        'best_acc': best.acc,
+        'best_epoch': best.epoch,
+        'stale_epochs': stale_epochs,
+        'torch_rng_state': torch.get_rng_state(),
+        'cuda_rng_state': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        'numpy_rng_state': np.random.get_state(),
+    }, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def load_epoch_checkpoint(path, model, optimizer, best, run):
+    # Restore a checkpoint written by save_epoch_checkpoint for the same run.
+    # Returns (epochs done, stale epochs).
+    checkpoint = torch.load(path, map_location="cpu", weights_only=False)
+    if checkpoint['run'] != run:
+        raise ValueError(f"{path} belongs to a different training run ({checkpoint['run']}), "
+                         f"not this one ({run}). Start without --resume to train from scratch.")
+    model.load_state_dict(checkpoint['model_state_dict'])
+    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    best.restore(checkpoint['best_state_dict'], checkpoint['best_acc'], checkpoint['best_epoch'])
+    torch.set_rng_state(checkpoint['torch_rng_state'])
+    if checkpoint['cuda_rng_state'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(checkpoint['cuda_rng_state'])
+    np.random.set_state(checkpoint['numpy_rng_state'])
+    return checkpoint['epoch'], checkpoint['stale_epochs']
+
+def fit(model, features, labels, train_idx, val_idx, num_epochs, batch_size, lr, device,
+        eval_batch_size=EVAL_BATCH_SIZE, history=None):
+    # Train on rows train_idx of features/labels, gathering every batch
+    # straight from them (they may be memory-mapped and shared), and keep the
+    # weights with the best accuracy on rows val_idx. The validation accuracy
+    # of each epoch is appended to history if given.
+    # Returns (best validation accuracy, best state dict).
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(model.parameters(), lr=lr)
+    val_features = features.index_select(0, val_idx).to(device)
+    val_labels = labels.index_select(0, val_idx).to(device)
+
+    best = BestWeights(model)
+    for epoch in range(num_epochs):
+        model.train()
+        order = train_idx[torch.randperm(len(train_idx))]
+        for start in range(0, len(order), batch_size):
+            idx = order[start:start + batch_size]
+            inputs = features.index_select(0, idx).to(device)
+            targets = labels.index_select(0, idx).to(device)
+            optimizer.zero_grad()
+            loss = criterion(model(inputs), targets)
+            loss.backward()
+            optimizer.step()
+
+        val_preds, val_targets = predict_all(model, tensor_batches(val_features, val_labels, eval_batch_size,
+                                                                   shuffle=False), device)
+        val_acc = torch.sum(val_preds == val_targets).item() / val_targets.numel()
+        if history is not None:
+            history.append(val_acc)
+        best.update(model, val_acc, epoch + 1)
+    return best.acc, best.state
+
+def save_and_report(model, test_preds, test_targets, label2idx, idx2label, model_save_path, extra=None):
+    # Save the model with its label maps (plus any extra checkpoint entries),
+    # export it, and write the test report to TRAIN_STAT_FILE. Returns the
+    # test accuracy.
+    test_acc = np.mean(test_preds == test_targets)
+    print(f"Test Accuracy with best model: {test_acc:.4f}")
+
+    # Save best model and label mappings. Written next to it and renamed, so
+    # a running daemon never loads a half-written checkpoint.
+    torch.save({
+        'model_state_dict': model.state_dict(),
+        'label2idx': label2idx,
+        'idx2label': idx2label,
+        # Also in the state dict as the model's normalization buffers
+        'feature_mean': model.feature_mean.tolist(),
+        'feature_std': (1 / model.feature_scale).tolist(),
+        **(extra or {})
+    }, model_save_path + ".tmp")
+    os.replace(model_save_path + ".tmp", model_save_path)
+    if EXPORT_MODELS:
+        export_models(model, idx2label)
+
+    # Produce classification report and confusion matrix. sklearn is only
+    # imported here, so the other modes don't pay for it at startup.
+    from sklearn.metrics import classification_report, confusion_matrix
+    # Classes missing from the test split (e.g. one that just appeared) still get a row
+    class_ids = list(range(len(idx2label)))
+    report = classification_report(test_targets, test_preds, labels=class_ids,
+                                   target_names=[idx2label[i] for i in class_ids], zero_division=0)
+    cm = confusion_matrix(test_targets, test_preds, labels=class_ids)
+
+    # Print classes identified
+    print("Classes identified:", idx2label)
+    print("Classification Report:\n", report)
+    print("Confusion Matrix:\n", cm)
+
+    # Save to train_stat.txt
+    with open(TRAIN_STAT_FILE, "w", encoding="utf-8") as f:
+        f.write("Classes identified:\n")
+        for k,v in idx2label.items():
+            f.write(f"{k}: {v}\n")
+        f.write("\nClassification Report:\n")
+        f.write(report)
+        f.write("\nConfusion Matrix:\n")
+        f.write(str(cm))
+        f.write("\n")
+
+    return test_acc
+
+def train_and_evaluate(model, dataset, num_epochs, batch_size, lr, val_split, test_split, seed, device, model_save_path,
+                       log_interval=10, on_tensors=TRAIN_ON_TENSORS, eval_batch_size=EVAL_BATCH_SIZE,
+                       checkpoint_extra=None, resume=False, patience=EARLY_STOPPING_PATIENCE,
+                       epoch_checkpoint_path=TRAIN_CHECKPOINT_PATH):
+    # on_tensors keeps the three splits as tensors on the device and batches
+    # them by index slicing; otherwise they go through DataLoaders.
+    # checkpoint_extra is saved into the checkpoint next to the label maps.
+    # After every epoch the training state is saved to epoch_checkpoint_path,
+    # and resume carries on from there. Training stops early after patience
+    # epochs without a better validation accuracy (0 never stops early).
     # Set seed
     torch.manual_seed(seed)
     np.random.seed(seed)
 
-    dataset_size = len(dataset)
-    indices = list(range(dataset_size))
-    np.random.shuffle(indices)
-    
-    val_size = int(val_split * dataset_size)
-    test_size = int(test_split * dataset_size)
-    train_size = dataset_size - val_size - test_size
+    # Normalize the features inside the model with the training data's statistics
+    model.set_normalization(dataset.feature_stats.mean, dataset.feature_stats.std())
 
-    train_indices = indices[:train_size]
-    val_indices = indices[train_size:train_size+val_size]
-    test_indices = indices[train_size+val_size:]
+    # The same _id-hash split as MODE=continue, so a row the model trained
+    # on never lands in the evaluation sets of a later continue run
+    splits = hash_splits(dataset.ids, val_split, test_split)
+    train_indices = np.flatnonzero(splits == TRAIN).tolist()
+    val_indices = np.flatnonzero(splits == VALIDATION).tolist()
+    test_indices = np.flatnonzero(splits == TEST).tolist()
+    train_size = len(train_indices)
 
-    train_subset = Subset(dataset, train_indices)
-    val_subset = Subset(dataset, val_indices)
-    test_subset = Subset(dataset, test_indices)
+    if on_tensors:
+        splits = {}
+        for name, split_indices in (("train", train_indices), ("val", val_indices), ("test", test_indices)):
+            split_indices = torch.as_tensor(split_indices, dtype=torch.long)
+            splits[name] = (dataset.features.index_select(0, split_indices).to(device),
+                            dataset.labels.index_select(0, split_indices).to(device))
+        train_batches = lambda: tensor_batches(*splits["train"], batch_size, shuffle=True)
+        val_batches = lambda: tensor_batches(*splits["val"], eval_batch_size, shuffle=False)
+        test_batches = lambda: tensor_batches(*splits["test"], eval_batch_size, shuffle=False)
+        num_train_batches = math.ceil(train_size / batch_size)
+    else:
+        train_subset = Subset(dataset, train_indices)
+        val_subset = Subset(dataset, val_indices)
+        test_subset = Subset(dataset, test_indices)
 
-    train_loader = DataLoader(train_subset, batch_size=batch_size, shuffle=True)
-    val_loader = DataLoader(val_subset, batch_size=batch_size, shuffle=False)
-    test_loader = DataLoader(test_subset, batch_size=batch_size, shuffle=False)
+        train_loader = DataLoader(train_subset, batch_size=batch_size, shuffle=True)
+        val_loader = DataLoader(val_subset, batch_size=batch_size, shuffle=False)
+        test_loader = DataLoader(test_subset, batch_size=batch_size, shuffle=False)
+        train_batches = lambda: train_loader
+        val_batches = lambda: val_loader
+        test_batches = lambda: test_loader
+        num_train_batches = len(train_loader)
 
     criterion = nn.CrossEntropyLoss()
     optimizer = optim.Adam(model.parameters(), lr=lr)
 
-    best_model_wts = copy.deepcopy(model.state_dict())
-    best_acc = 0.0
+    best = BestWeights(model)
+    # Identifies the run, so only a checkpoint of the same run is resumed
+    run = {"num_epochs": num_epochs, "batch_size": batch_size, "lr": lr, "val_split": val_split,
+           "test_split": test_split, "seed": seed, "dataset_size": len(dataset), "on_tensors": on_tensors,
+           "labels": [dataset.idx2label[i] for i in range(len(dataset.idx2label))]}
+    start_epoch = 0
+    stale_epochs = 0
+    if resume and os.path.exists(epoch_checkpoint_path):
+        start_epoch, stale_epochs = load_epoch_checkpoint(epoch_checkpoint_path, model, optimizer, best, run)
+        print(f"Resuming after epoch {start_epoch}/{num_epochs} from {epoch_checkpoint_path} "
+              f"(best validation acc {best.acc:.4f} in epoch {best.epoch})")
+    elif resume:
+        print(f"No checkpoint at {epoch_checkpoint_path}, training from the start")
 
-    for epoch in range(num_epochs):
+    for epoch in range(start_epoch, num_epochs):
+        if patience and stale_epochs >= patience:
+            break
         model.train()
-        running_loss = 0.0
-        running_corrects = 0
+        # Accumulated on the device, read once per epoch
+        running_loss = torch.zeros((), device=device)
+        running_corrects = torch.zeros((), dtype=torch.long, device=device)
         train_total = 0
 
-        for i, (inputs, labels) in enumerate(train_loader):
+        for i, (inputs, labels) in enumerate(train_batches()):
             inputs, labels = inputs.to(device), labels.to(device)
             optimizer.zero_grad()
 
@@ -57,80 +258,41 @@ def train_and_evaluate(model, dataset, num_epochs, batch_size, lr, val_split, te
             loss.backward()
             optimizer.step()
 
-            running_loss += loss.item() * inputs.size(0)
-            running_corrects += torch.sum(preds == labels).item()
+            running_loss += loss.detach() * inputs.size(0)
+            running_corrects += torch.sum(preds == labels)
             train_total += labels.size(0)
 
             if (i % log_interval == 0) and (i > 0):
-                print(f"Epoch [{epoch+1}/{num_epochs}], Step [{i}/{len(train_loader)}], Loss: {loss.item():.4f}")
+                print(f"Epoch [{epoch+1}/{num_epochs}], Step [{i}/{num_train_batches}], Loss: {loss.item():.4f}")
 
-        epoch_loss = running_loss / train_total
-        epoch_acc = running_corrects / train_total
+        epoch_loss = running_loss.item() / train_total
+        epoch_acc = running_corrects.item() / train_total
         print(f"Train Epoch [{epoch+1}/{num_epochs}] Loss: {epoch_loss:.4f} Acc: {epoch_acc:.4f}")
 
         # Validation
-        model.eval()
-        val_running_corrects = 0
-        val_total = 0
-        with torch.no_grad():
-            for inputs, labels in val_loader:
-                inputs, labels = inputs.to(device), labels.to(device)
-                outputs = model(inputs)
-                _, preds = torch.max(outputs, 1)
-                val_running_corrects += torch.sum(preds == labels).item()
-                val_total += labels.size(0)
-
-        val_acc = val_running_corrects / val_total
+        val_preds, val_targets = predict_all(model, val_batches(), device)
+        val_acc = torch.sum(val_preds == val_targets).item() / val_targets.numel()
         print(f"Validation Acc: {val_acc:.4f}")
 
         # save best model
-        if val_acc > best_acc:
-            best_acc = val_acc
-            best_model_wts = copy.deepcopy(model.state_dict())
+        stale_epochs = 0 if best.update(model, val_acc, epoch + 1) else stale_epochs + 1
+        save_epoch_checkpoint(epoch_checkpoint_path, epoch + 1, model, optimizer, best, stale_epochs, run)
+        if patience and stale_epochs >= patience:
+            print(f"Stopping early: no improvement for {patience} epochs, best was epoch {best.epoch}")
 
     # load best model weights
-    model.load_state_dict(best_model_wts)
+    model.load_state_dict(best.state)
 
     # Test evaluation with the best model
-    model.eval()
-    test_preds = []
-    test_targets = []
-    with torch.no_grad():
-        for inputs, labels in test_loader:
-            inputs, labels = inputs.to(device), labels.to(device)
-            outputs = model(inputs)
-            _, preds = torch.max(outputs, 1)
-            test_preds.extend(preds.cpu().numpy())
-            test_targets.extend(labels.cpu().numpy())
-
-    test_acc = np.mean(np.array(test_preds) == np.array(test_targets))
-    print(f"Test Accuracy with best model: {test_acc:.4f}")
+    test_preds, test_targets = predict_all(model, test_batches(), device)
+    test_preds = test_preds.cpu().numpy()
+    test_targets = test_targets.cpu().numpy()
 
-    # Save best model and label mappings
-    torch.save({
-        'model_state_dict': model.state_dict(),
-        'label2idx': dataset.label2idx,
-        'idx2label': dataset.idx2label
-    }, model_save_path)
-
-    # Produce classification report and confusion matrix
-    report = classification_report(test_targets, test_preds, target_names=[dataset.idx2label[i] for i in range(len(dataset.idx2label))])
-    cm = confusion_matrix(test_targets, test_preds)
-
-    # Print classes identified
-    print("Classes identified:", dataset.idx2label)
-    print("Classification Report:\n", report)
-    print("Confusion Matrix:\n", cm)
-
-    # Save to train_stat.txt
-    with open(TRAIN_STAT_FILE, "w", encoding="utf-8") as f:
-        f.write("Classes identified:\n")
-        for k,v in dataset.idx2label.items():
-            f.write(f"{k}: {v}\n")
-        f.write("\nClassification Report:\n")
-        f.write(report)
-        f.write("\nConfusion Matrix:\n")
-        f.write(str(cm))
-        f.write("\n")
+    test_acc = save_and_report(model, test_preds, test_targets, dataset.label2idx, dataset.idx2label,
+                               model_save_path, extra=checkpoint_extra)
+    # The finished run is in model_save_path, nothing left to resume. No
+    # checkpoint exists if no epoch ran (num_epochs=0 or nothing left to resume).
+    if os.path.exists(epoch_checkpoint_path):
+        os.remove(epoch_checkpoint_path)
 
     return test_acc
@@ -0,0 +1,132 @@
+# windows.py
+
+import os
+import time
+import numpy as np
+import pandas as pd
+from dataset import _parse_feature_column
+from config import (FETCHED_DATA_FILE, WINDOWED_DATA_FILE, TRIP_GAP_SECONDS, TRIP_DEVICE_COLUMN, WINDOW_SIZE,
+                    WINDOW_BANDS, WINDOW_SIGNALS)
+
+# Windows transformed per FFT call, bounding the (rows x WINDOW_SIZE) scratch arrays
+FFT_CHUNK_ROWS = 65536
+
+
+def trip_order(timestamps_ns, devices=None, gap_seconds=TRIP_GAP_SECONDS):
+    # Return (order, trips): the row order sorted by device and time, and the
+    # trip number of each sorted row. A trip ends at a gap longer than
+    # gap_seconds or where the device changes.
+    keys = (timestamps_ns,) if devices is None else (timestamps_ns, devices)
+    order = np.lexsort(keys)
+    new_trip = np.ones(len(order), dtype=bool)
+    new_trip[1:] = np.diff(timestamps_ns[order]) > gap_seconds * 1e9
+    if devices is not None:
+        sorted_devices = devices[order]
+        new_trip[1:] |= sorted_devices[1:] != sorted_devices[:-1]
+    return order, np.cumsum(new_trip) - 1
+
+
+def window_starts(trips, window):
+    # First row of each row's window: the last `window` rows of its trip up
+    # to and including it, fewer at the start of a trip
+    positions = np.arange(len(trips))
+    trip_first = np.flatnonzero(np.r_[True, trips[1:] != trips[:-1]])
+    return np.maximum(positions - window + 1, trip_first[trips])
+
+
+def window_features(signal, trips, window=WINDOW_SIZE, bands=WINDOW_BANDS):
+    # Rolling-window statistics of signal (rows sorted by trip and time) as a
+    # dict of WINDOW_STATS arrays. Sums come from cumulative sums, maxima and
+    # minima from pandas' O(n) rolling/cumulative kernels, and the band
+    # energies from one real FFT over a block of windows at a time; there is
+    # no Python loop per window.
+    signal = signal.astype(np.float64)
+    positions = np.arange(len(signal))
+    starts = window_starts(trips, window)
+    counts = positions - starts + 1
+
+    sums = np.concatenate([[0.0], np.cumsum(signal)])
+    squares = np.concatenate([[0.0], np.cumsum(signal ** 2)])
+    mean = (sums[positions + 1] - sums[starts]) / counts
+    mean_square = (squares[positions + 1] - squares[starts]) / counts
+
+    # A window that is cut off by the trip start covers the trip so far
+    series = pd.Series(signal)
+    at_trip_start = counts < window
+    by_trip = series.groupby(trips)
+    maxima = np.where(at_trip_start, by_trip.cummax().to_numpy(),
+                      series.rolling(window, min_periods=1).max().to_numpy())
+    minima = np.where(at_trip_start, by_trip.cummin().to_numpy(),
+                      series.rolling(window, min_periods=1).min().to_numpy())
+
+    features = {
+        "rms": np.sqrt(mean_square),
+        "var": np.maximum(mean_square - mean ** 2, 0.0),
+        "p2p": maxima - minima,
+    }
+
+    # Power of the mean-free window, DC left out, summed over `bands`
+    # contiguous frequency ranges and divided by the window length
+    band_bins = np.array_split(np.arange(1, window // 2 + 1), bands)
+    energies = np.empty((bands, len(signal)))
+    offsets = np.arange(window) - (window - 1)
+    for start in range(0, len(signal), FFT_CHUNK_ROWS):
+        stop = min(start + FFT_CHUNK_ROWS, len(signal))
+        rows = positions[start:stop, None] + offsets
+        valid = rows >= starts[start:stop, None]
+        values = np.where(valid, signal[np.maximum(rows, 0)] - mean[start:stop, None], 0.0)
+        power = np.abs(np.fft.rfft(values, axis=1)) ** 2
+        for band, bins in enumerate(band_bins):
+            energies[band, start:stop] = power[:, bins].sum(axis=1) / counts[start:stop]
+    for band in range(bands):
+        features[f"band{band}"] = energies[band]
+    return features
+
+
+def add_window_features(frame, signals=WINDOW_SIGNALS, window=WINDOW_SIZE, bands=WINDOW_BANDS,
+                        gap_seconds=TRIP_GAP_SECONDS, device_column=TRIP_DEVICE_COLUMN):
+    # Sort the rows of frame (text columns, as read from the CSV) into trips
+    # and add the window features as float32 columns. Rows without a usable
+    # timestamp or signal are dropped, as training and predict would skip
+    # them anyway. Returns (frame, number of trips).
+    columns = {col: _parse_feature_column(frame[col]) for cols in signals.values() for col in cols}
+    timestamps = pd.to_datetime(frame["@timestamp"], utc=True, errors="coerce", format="ISO8601")
+    usable = timestamps.notna().to_numpy(copy=True)
+    for _, valid in columns.values():
+        usable &= valid
+    frame = frame[usable]
+    timestamps_ns = timestamps[usable].to_numpy(dtype="datetime64[ns]").view(np.int64)
+    devices = frame[device_column].to_numpy(dtype=str) if device_column in frame else None
+
+    order, trips = trip_order(timestamps_ns, devices, gap_seconds)
+    frame = frame.iloc[order].reset_index(drop=True)
+    new_columns = {}
+    for name, cols in signals.items():
+        magnitude = np.sqrt(sum(columns[col][0][usable][order] ** 2 for col in cols))
+        for stat, values in window_features(magnitude, trips, window, bands).items():
+            new_columns[f"{name}_window_{stat}"] = values.astype(np.float32)
+    return pd.concat([frame, pd.DataFrame(new_columns)], axis=1), int(trips[-1]) + 1 if len(trips) else 0
+
+
+def build_windowed_csv(source=FETCHED_DATA_FILE, dest=WINDOWED_DATA_FILE):
+    # Write source with the window features added, sorted by trip and time.
+    # Written next to dest and renamed, so readers never see half a file.
+    start = time.time()
+    frame = pd.read_csv(source, dtype=str, keep_default_na=False, encoding="utf-8")
+    read_seconds = time.time() - start
+
+    start = time.time()
+    windowed, num_trips = add_window_features(frame)
+    compute_seconds = time.time() - start
+
+    start = time.time()
+    windowed.to_csv(dest + ".tmp", index=False, lineterminator="\r\n", float_format="%.7g", encoding="utf-8")
+    os.replace(dest + ".tmp", dest)
+    write_seconds = time.time() - start
+
+    dropped = len(frame) - len(windowed)
+    print(f"Wrote {len(windowed)} rows in {num_trips} trips to {dest} ({dropped} rows without a usable "
+          f"timestamp or signal dropped)")
+    print(f"Read {read_seconds:.2f}s, window features {compute_seconds:.2f}s "
+          f"({len(windowed) / max(compute_seconds, 1e-9):.0f} rows/s), write {write_seconds:.2f}s")
+    return len(windowed)
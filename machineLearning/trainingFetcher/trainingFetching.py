@@ -1,88 +1,383 @@
-from elasticsearch import Elasticsearch
+from elasticsearch import ApiError, Elasticsearch
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import argparse
+import json
 import os
 import csv
+import random
+import re
+import shutil
+import threading
+import time
 
 # Get API key from .env file
 load_dotenv()
 api_key=os.getenv("ELASTIC_API_KEY")
-host="https://elastic.mcmogens.dk"
-training_data_path="/data/training_data.csv"
+host=os.getenv("ELASTIC_HOST", "https://elastic.mcmogens.dk")
+training_data_path=os.getenv("TRAINING_DATA_PATH", "/data/training_data.csv")
 index_name=".ds-bikehero-data-stream-2024.11.22-000001"
+# High-water mark of the last fetch, used by incremental runs
+checkpoint_path=os.getenv("FETCH_CHECKPOINT_PATH", os.path.join(os.path.dirname(training_data_path), "fetch_checkpoint.json"))
 
-def fetch_data(host, api_key, index_name, scroll='2m', batch_size=1000):
+# FETCH_WORKERS > 1 splits the index into that many slices and drains them concurrently
+fetch_workers=int(os.getenv("FETCH_WORKERS", "4"))
+page_size=int(os.getenv("FETCH_PAGE_SIZE", "1000"))
+# "all", "labelled" (training) or "unpredicted" (prediction), see QUERY_MODES
+fetch_mode=os.getenv("FETCH_MODE", "all")
+# Requests rejected with 429 are resent after about initial_backoff, 2x, 4x, ... seconds
+fetch_max_retries=int(os.getenv("FETCH_MAX_RETRIES", "5"))
+fetch_initial_backoff=float(os.getenv("FETCH_INITIAL_BACKOFF", "1"))
+
+def connect(host, api_key):
+    return Elasticsearch(
+        hosts=[host],
+        api_key=api_key,
+        # 429 is left to with_backoff; the client would resend it immediately
+        retry_on_status=(502, 503, 504)
+    )
+
+def with_backoff(call, *args, max_retries=None, initial_backoff=None, **kwargs):
+    # Call an Elasticsearch API, waiting and retrying while the cluster
+    # rejects it with 429 (a full search or write queue). A rejected request
+    # was not executed, so resending a scroll or search_after page is safe.
+    max_retries = fetch_max_retries if max_retries is None else max_retries
+    initial_backoff = fetch_initial_backoff if initial_backoff is None else initial_backoff
+    for attempt in range(max_retries + 1):
+        try:
+            return call(*args, **kwargs)
+        except ApiError as e:
+            if e.status_code != 429 or attempt == max_retries:
+                raise
+            # Jitter keeps concurrent slice workers from retrying in lockstep
+            delay = initial_backoff * 2 ** attempt * random.uniform(0.5, 1.0)
+            print(f"Elasticsearch rejected the request (429), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+# Fixed column order of training_data.csv
+CSV_FIELDNAMES = [
+    "@timestamp",
+    "rmsAcceleration",
+    "surfaceType",
+    "_id",
+    "location_lat",
+    "location_lon",
+    "accelerometer_x",
+    "accelerometer_y",
+    "accelerometer_z",
+    "gyroscope_x",
+    "gyroscope_y",
+    "gyroscope_z"
+]
+
+# Only the fields behind CSV_FIELDNAMES are requested (_id always comes along).
+# Keep in sync with FEATURES in surfaceDetectionEngine/config.py.
+SOURCE_FIELDS = [
+    "@timestamp",
+    "rmsAcceleration",
+    "surfaceType",
+    "location.lat",
+    "location.lon",
+    "accelerometer.x",
+    "accelerometer.y",
+    "accelerometer.z",
+    "gyroscope.x",
+    "gyroscope.y",
+    "gyroscope.z"
+]
+
+QUERY_MODES = {
+    "all": {"match_all": {}},
+    # Training only uses documents with a real surface type
+    "labelled": {
+        "bool": {
+            "filter": [{"exists": {"field": "surfaceType"}}],
+            "must_not": [{"term": {"surfaceType": "none"}}]
+        }
+    },
+    # Prediction only needs the "none" documents nobody predicted yet
+    "unpredicted": {
+        "bool": {
+            "filter": [{"term": {"surfaceType": "none"}}],
+            "must_not": [{"exists": {"field": "predicted_surfaceType"}}]
+        }
+    }
+}
+
+def flatten_hit(hit):
+    record = {**hit['_source'], '_id': hit['_id']}
+    if 'location' in record and isinstance(record['location'], dict):
+        loc = record.pop('location')
+        record['location_lat'] = loc.get('lat', '')
+        record['location_lon'] = loc.get('lon', '')
+    if 'accelerometer' in record and isinstance(record['accelerometer'], dict):
+        accel = record.pop('accelerometer')
+        record['accelerometer_x'] = accel.get('x', '')
+        record['accelerometer_y'] = accel.get('y', '')
+        record['accelerometer_z'] = accel.get('z', '')
+    if 'gyroscope' in record and isinstance(record['gyroscope'], dict):
+        gyro = record.pop('gyroscope')
+        record['gyroscope_x'] = gyro.get('x', '')
+        record['gyroscope_y'] = gyro.get('y', '')
+        record['gyroscope_z'] = gyro.get('z', '')
+    return record
+
+_TIMESTAMP_RE = re.compile(r"^(?P<base>\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(?P<fraction>\d+))?"
+                           r"(?P<tz>Z|[+-]\d\d:\d\d)?$")
+
+def parse_timestamp(value):
+    # @timestamp strings carry anywhere from 0 to 9 fraction digits, so they
+    # can't be compared as text. Python 3.9's fromisoformat wants exactly 6.
+    # Returns None for a value that is not such a timestamp.
+    match = _TIMESTAMP_RE.match(value)
+    if match is None:
+        return None
+    fraction = (match.group('fraction') or '').ljust(6, '0')[:6]
+    tz = match.group('tz')
+    tz = '+00:00' if tz in (None, 'Z') else tz
+    try:
+        return datetime.fromisoformat(f"{match.group('base')}.{fraction}{tz}")
+    except ValueError:
+        return None
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_checkpoint(path, checkpoint):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+def build_query(mode, checkpoint=None):
+    # The mode's query, limited to everything at or after the high-water mark
+    # when fetching incrementally. Documents sharing the mark's timestamp that
+    # were already fetched are dropped again by the sink.
+    query = QUERY_MODES[mode]
+    if checkpoint is None:
+        return query
+    return {
+        "bool": {
+            "filter": [
+                query,
+                {"range": {"@timestamp": {"gte": checkpoint['timestamp']}}}
+            ]
+        }
+    }
+
+class CsvSink:
+    # Appends flattened pages to a temp file next to file_name. A full fetch
+    # renames it into place once it completed, an incremental one (append=True)
+    # appends it to the existing CSV, so readers never see a partial fetch.
+    # Also tracks the high-water mark: the newest @timestamp written and the
+    # _ids sharing it.
+    def __init__(self, file_name, fieldnames=CSV_FIELDNAMES, append=False, checkpoint=None):
+        self.file_name = file_name
+        self.tmp_name = file_name + ".tmp"
+        self.append = append
+        self.lock = threading.Lock()
+        self.count = 0
+        self.skipped = 0
+        self.mark = None
+        self.mark_timestamp = None
+        self.mark_ids = set()
+        if checkpoint:
+            self.mark = parse_timestamp(checkpoint['timestamp'])
+            self.mark_timestamp = checkpoint['timestamp']
+            self.mark_ids = set(checkpoint['ids'])
+        # _ids already fetched at the checkpoint's timestamp
+        self.fetched_ids = frozenset(self.mark_ids)
+        self.file = open(self.tmp_name, mode='w', newline='', encoding='utf-8')
+        # Fields outside the schema, e.g. predicted_*, are dropped
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames, extrasaction='ignore')
+        if not append:
+            self.writer.writeheader()
+
+    def write_page(self, hits):
+        rows = [flatten_hit(hit) for hit in hits]
+        with self.lock:
+            if self.fetched_ids:
+                rows = [row for row in rows if row['_id'] not in self.fetched_ids]
+                self.skipped += len(hits) - len(rows)
+            self._advance_mark(rows)
+            self.writer.writerows(rows)
+            self.count += len(rows)
+
+    def _advance_mark(self, rows):
+        for row in rows:
+            timestamp = row.get('@timestamp')
+            if not timestamp:
+                continue
+            parsed = parse_timestamp(timestamp)
+            if parsed is None:
+                # Unparseable, so it can't move the high-water mark
+                continue
+            if self.mark is None or parsed > self.mark:
+                self.mark = parsed
+                self.mark_timestamp = timestamp
+                self.mark_ids = {row['_id']}
+            elif parsed == self.mark:
+                self.mark_ids.add(row['_id'])
+
+    def checkpoint(self, mode):
+        if self.mark_timestamp is None:
+            return None
+        return {
+            "mode": mode,
+            "timestamp": self.mark_timestamp,
+            "ids": sorted(self.mark_ids),
+            "csv_size": os.path.getsize(self.file_name)
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is not None:
+            os.remove(self.tmp_name)
+        elif self.append:
+            with open(self.tmp_name, 'rb') as src, open(self.file_name, 'ab') as dst:
+                shutil.copyfileobj(src, dst)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.remove(self.tmp_name)
+            print(f"Appended {self.count} new documents to {self.file_name}")
+        else:
+            os.replace(self.tmp_name, self.file_name)
+            print(f"Data successfully written to {self.file_name}")
+        return False
+
+def fetch_data(host, api_key, index_name, sink, scroll='2m', batch_size=1000, query=None):
     query = {
-    "query": {
+    "query": query or {
         "match_all": {}
-        }
+        },
+    "_source": SOURCE_FIELDS
     }
-    elastic=Elasticsearch(
-        hosts=[host],
-        api_key=api_key
-    )
-    data = []
-    response = elastic.search(index=index_name, body=query, scroll=scroll, size=batch_size)
+    elastic=connect(host, api_key)
+    response = with_backoff(elastic.search, index=index_name, body=query, scroll=scroll, size=batch_size)
     scroll_id = response.get('_scroll_id')
     hits = response['hits']['hits']
 
-    data.extend([{**hit['_source'], '_id': hit['_id']} for hit in hits])
+    sink.write_page(hits)
     print(f"Fetched {len(hits)} documents in the first batch...")
     while hits:
-        response = elastic.scroll(scroll_id=scroll_id, scroll=scroll)
+        response = with_backoff(elastic.scroll, scroll_id=scroll_id, scroll=scroll)
         scroll_id=response.get('_scroll_id')
         hits = response['hits']['hits']
-        if not hits: 
+        if not hits:
             break
-        data.extend([{**hit['_source'], '_id': hit['_id']} for hit in hits])
-        if(len(data)%10000 == 0):
-            print(f"Fetched {len(hits)} more documents, total: {len(data)}")
-    
+        sink.write_page(hits)
+        if(sink.count%10000 == 0):
+            print(f"Fetched {len(hits)} more documents, total: {sink.count}")
+
     elastic.clear_scroll(scroll_id=scroll_id)
-    print(f"Finished fetchin {len(data)} documents.")
-
-    return data
-
-def prepare_for_csv(data):
-    new_data = []
-    for record in data:
-        new_record = record.copy()
-        if 'location' in new_record and isinstance(new_record['location'], dict):
-            loc = new_record.pop('location')
-            new_record['location_lat'] = loc.get('lat', '')
-            new_record['location_lon'] = loc.get('lon', '')
-        if 'accelerometer' in new_record and isinstance(new_record['accelerometer'], dict):
-            accel = new_record.pop('accelerometer')
-            new_record['accelerometer_x'] = accel.get('x', '')
-            new_record['accelerometer_y'] = accel.get('y', '')
-            new_record['accelerometer_z'] = accel.get('z', '')
-        if 'gyroscope' in new_record and isinstance(new_record['gyroscope'], dict):
-            gyro = new_record.pop('gyroscope')
-            new_record['gyroscope_x'] = gyro.get('x', '')
-            new_record['gyroscope_y'] = gyro.get('y', '')
-            new_record['gyroscope_z'] = gyro.get('z', '')
-        new_data.append(new_record)
-    return new_data
-
-def save_to_csv(data, file_name):
-    if not data:
-        print("No data to write to CSV.")
-        return
-    
-    keys = {key for row in data for key in row.keys()}
-    headers = [key for key in keys if not key.startswith('predicted_')]
-
-    with open(file_name, mode='w', newline='', encoding='utf-8') as file:
-        writer = csv.DictWriter(file, fieldnames=headers)
-        writer.writeheader()
-        filtered_data = [
-            {key: value for key, value in row.items() if key in headers}
-            for row in data
-        ]
-        writer.writerows(filtered_data)
-
-    print(f"Data successfully written to {file_name}")
-
-
-data = fetch_data(host, api_key, index_name)
-data = prepare_for_csv(data)
-save_to_csv(data, training_data_path)
\ No newline at end of file
+    print(f"Finished fetchin {sink.count} documents.")
+
+    return sink.count
+
+class FetchProgress:
+    # Thread-safe document counter shared by the slice workers
+    def __init__(self, report_every=10000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.total = 0
+        self.report_every = report_every
+        self.next_report = report_every
+
+    def add(self, count):
+        with self.lock:
+            self.total += count
+            if self.total >= self.next_report:
+                self.next_report += self.report_every
+                self.report()
+
+    def rate(self):
+        elapsed = time.time() - self.start
+        return self.total / elapsed if elapsed > 0 else 0.0
+
+    def report(self, prefix="Fetched"):
+        print(f"{prefix} {self.total} documents in {time.time() - self.start:.1f}s ({self.rate():.0f} docs/s)")
+
+def fetch_slice(elastic, pit_id, slice_id, num_slices, keep_alive, batch_size, sink, progress, query):
+    # Page through one slice of the point in time with search_after
+    search_after = None
+    while True:
+        body = {
+            "query": query,
+            "_source": SOURCE_FIELDS,
+            "pit": {"id": pit_id, "keep_alive": keep_alive},
+            "sort": ["_shard_doc"],
+            "size": batch_size
+        }
+        if num_slices > 1:
+            body["slice"] = {"id": slice_id, "max": num_slices}
+        if search_after is not None:
+            body["search_after"] = search_after
+        response = with_backoff(elastic.search, body=body)
+        hits = response['hits']['hits']
+        if not hits:
+            break
+        sink.write_page(hits)
+        progress.add(len(hits))
+        search_after = hits[-1]['sort']
+
+def fetch_data_parallel(host, api_key, index_name, sink, workers, keep_alive='2m', batch_size=1000, query=None):
+    # Open one point in time and drain `workers` slices of it concurrently
+    elastic=connect(host, api_key)
+    pit_id = with_backoff(elastic.open_point_in_time, index=index_name, keep_alive=keep_alive)['id']
+    progress = FetchProgress()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(fetch_slice, elastic, pit_id, slice_id, workers, keep_alive, batch_size, sink, progress,
+                                query or {"match_all": {}})
+                for slice_id in range(workers)
+            ]
+            for future in futures:
+                future.result()
+    finally:
+        elastic.close_point_in_time(id=pit_id)
+    progress.report(prefix=f"Finished fetching with {workers} workers:")
+
+    return sink.count
+
+
+def run_fetch(full=False, mode=fetch_mode):
+    # Incremental unless asked for a full rebuild or there is nothing to append to
+    checkpoint = None if full else load_checkpoint(checkpoint_path)
+    if checkpoint and (not os.path.exists(training_data_path) or checkpoint.get('mode', 'all') != mode):
+        checkpoint = None
+    if checkpoint:
+        # Drop whatever a previous run may have half-appended after its checkpoint
+        if os.path.getsize(training_data_path) > checkpoint['csv_size']:
+            with open(training_data_path, 'r+b') as f:
+                f.truncate(checkpoint['csv_size'])
+        print(f"Fetching {mode} documents since {checkpoint['timestamp']}")
+    else:
+        print(f"Fetching {mode} documents")
+    query = build_query(mode, checkpoint)
+
+    with CsvSink(training_data_path, append=checkpoint is not None, checkpoint=checkpoint) as sink:
+        if fetch_workers > 1:
+            fetch_data_parallel(host, api_key, index_name, sink, fetch_workers, batch_size=page_size, query=query)
+        else:
+            fetch_data(host, api_key, index_name, sink, batch_size=page_size, query=query)
+
+    new_checkpoint = sink.checkpoint(mode)
+    if new_checkpoint:
+        save_checkpoint(checkpoint_path, new_checkpoint)
+    return sink.count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the BikeHero data stream to training_data.csv")
+    parser.add_argument("--full", action="store_true", help="ignore the checkpoint and rebuild the CSV from scratch")
+    parser.add_argument("--mode", choices=sorted(QUERY_MODES), default=fetch_mode, help="which documents to fetch")
+    args = parser.parse_args()
+    run_fetch(full=args.full or os.getenv("FETCH_FULL", "false").lower() == "true", mode=args.mode)
@@ -1,25 +1,134 @@
 # updater.py
+import argparse
 import os
 import csv
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from elasticsearch import Elasticsearch, helpers
 
 # Load environment variables
 load_dotenv()
 api_key = os.getenv("ELASTIC_API_KEY")
-host = "https://elastic.mcmogens.dk"
+host = os.getenv("ELASTIC_HOST", "https://elastic.mcmogens.dk")
 index_name = ".ds-bikehero-data-stream-2024.11.22-000001"
-predictions_dir = "./data/predictions"
+predictions_dir = os.getenv("PREDICTIONS_DIR", "./data/predictions")
+# Last predicted_* values pushed per _id, so unchanged predictions are not sent again
+pushed_index_path = os.getenv("PUSHED_INDEX_PATH", "./data/pushed_predictions.db")
+# Position of the last acknowledged batch, so an interrupted run can resume
+checkpoint_path = os.getenv("UPDATE_CHECKPOINT_PATH", "./data/update_checkpoint.json")
+# Documents Elasticsearch rejected in the last run, in the predictions CSV format
+dead_letter_path = os.getenv("UPDATE_DEAD_LETTER_PATH", "./data/dead_letter.csv")
+# Version of the model behind the predictions; a checkpoint of another version is not resumed
+model_version = os.getenv("MODEL_VERSION", "")
+
+# Bulk request sizing and concurrency
+update_chunk_size = int(os.getenv("UPDATE_CHUNK_SIZE", "1000"))
+update_threads = int(os.getenv("UPDATE_THREADS", "4"))
+update_max_bytes = int(os.getenv("UPDATE_MAX_BYTES", str(10 * 1024 * 1024)))
+# Documents (or whole bulk requests) rejected with 429 are resent after
+# initial_backoff, 2x, 4x, ... seconds
+update_max_retries = int(os.getenv("UPDATE_MAX_RETRIES", "5"))
+update_initial_backoff = float(os.getenv("UPDATE_INITIAL_BACKOFF", "1"))
 
 # Connect to Elasticsearch
 elastic = Elasticsearch(
     hosts=[host],
-    api_key=api_key
+    api_key=api_key,
+    # 429 is left to streaming_bulk's backoff; the client would resend it immediately
+    retry_on_status=(502, 503, 504)
 )
 
-def bulk_update_documents(elastic, index_name, docs, batch_size=1000):
-    # docs is a list of dicts, each containing '_id' and some predicted_* fields.
-    actions = []
+class UpdateProgress:
+    # Thread-safe success/failure counters shared by the bulk workers
+    def __init__(self, report_every=10000, max_logged_failures=10):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.report_every = report_every
+        self.next_report = report_every
+        self.max_logged_failures = max_logged_failures
+
+    def add(self, succeeded, failures):
+        with self.lock:
+            for info in failures[:max(0, self.max_logged_failures - self.failed)]:
+                item = info.get("update", info)
+                print(f"Failed to update {item.get('_id')}: status {item.get('status')}, {str(item.get('error'))[:200]}")
+            self.succeeded += succeeded
+            self.failed += len(failures)
+            if self.succeeded + self.failed >= self.next_report:
+                self.next_report += self.report_every
+                self.report()
+
+    def skip(self, count):
+        with self.lock:
+            self.skipped += count
+
+    def rate(self):
+        elapsed = time.time() - self.start
+        return (self.succeeded + self.failed) / elapsed if elapsed > 0 else 0.0
+
+    def report(self, prefix="Updated"):
+        print(f"{prefix} {self.succeeded} documents, {self.failed} failed, {self.skipped} unchanged skipped, "
+              f"in {time.time() - self.start:.1f}s ({self.rate():.0f} docs/s)")
+
+class PushedIndex:
+    # On-disk map of _id -> predicted_* fields last acknowledged by Elasticsearch.
+    # Shared by the bulk workers, hence the lock.
+    # Older SQLite builds allow at most 999 parameters per statement
+    QUERY_BATCH = 900
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS pushed (id TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID")
+
+    @staticmethod
+    def encode(fields):
+        return json.dumps(fields, sort_keys=True, separators=(",", ":"))
+
+    def changed(self, actions):
+        # Return the actions whose fields differ from what was last pushed.
+        # Looked up QUERY_BATCH ids at a time, below SQLite's bound-parameter limit.
+        ids = [action["_id"] for action in actions]
+        pushed = {}
+        with self.lock:
+            for start in range(0, len(ids), self.QUERY_BATCH):
+                batch = ids[start:start + self.QUERY_BATCH]
+                pushed.update(self.connection.execute(
+                    f"SELECT id, value FROM pushed WHERE id IN ({','.join('?' * len(batch))})", batch))
+        return [action for action in actions if pushed.get(action["_id"]) != self.encode(action["doc"])]
+
+    def record(self, actions):
+        with self.lock:
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO pushed (id, value) VALUES (?, ?)",
+                    [(action["_id"], self.encode(action["doc"])) for action in actions])
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM pushed").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def update_actions(index_name, docs):
+    # docs is an iterable of dicts, each containing '_id' and some predicted_* fields.
     for doc in docs:
         if '_id' not in doc:
             continue
@@ -34,55 +143,314 @@ def bulk_update_documents(elastic, index_name, docs, batch_size=1000):
             "_id": doc['_id'],
             "doc": predicted_fields
         }
-        actions.append(action)
-        if len(actions) == batch_size:
-            helpers.bulk(elastic, actions)
-            actions = []
-    # Final flush
-    if actions:
-        helpers.bulk(elastic, actions)
-
-def process_predictions_file(file_path):
-    docs = []
-    with open(file_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
+        if '_position' in doc:
+            action['_position'] = doc['_position']
+        yield action
+
+def skip_unchanged(actions, pushed, progress, lookup_size=1000):
+    # Drop the actions whose prediction is already in Elasticsearch, looking
+    # them up lookup_size at a time
+    batch = []
+    for action in actions:
+        batch.append(action)
+        if len(batch) == lookup_size:
+            yield from _changed(batch, pushed, progress)
+            batch = []
+    if batch:
+        yield from _changed(batch, pushed, progress)
+
+def _changed(batch, pushed, progress):
+    changed = pushed.changed(batch)
+    progress.skip(len(batch) - len(changed))
+    return changed
+
+def _expand_action(action):
+    # _position is the updater's own bookkeeping, not part of the request
+    action = dict(action)
+    action.pop("_position", None)
+    return helpers.expand_action(action)
+
+def send_chunk(elastic, actions, max_bytes, max_retries, initial_backoff):
+    # Send one chunk of actions (split further if it exceeds max_bytes),
+    # retrying 429 rejections, of single items or of the whole request, with
+    # exponential backoff.
+    # Returns ([acknowledged actions], [(failed action, error info)]).
+    succeeded = []
+    failures = []
+    results = helpers.streaming_bulk(elastic, actions, chunk_size=len(actions), max_chunk_bytes=max_bytes,
+                                     expand_action_callback=_expand_action,
+                                     max_retries=max_retries, initial_backoff=initial_backoff,
+                                     raise_on_error=False, raise_on_exception=False, yield_ok=True)
+    # Retried actions come back out of order, so match the results by _id
+    by_id = {action["_id"]: action for action in actions}
+    for ok, info in results:
+        action = by_id[info["update"]["_id"]]
+        if ok:
+            succeeded.append(action)
+        else:
+            failures.append((action, info))
+    return succeeded, failures
+
+class UpdateCheckpoint:
+    # Saves the position after the last acknowledged batch. Batches finish out
+    # of order, so the position only moves past a batch once every batch
+    # submitted before it has been acknowledged as well.
+    def __init__(self, path, model_version, files):
+        self.path = path
+        self.model_version = model_version
+        self.files = files
+        self.lock = threading.Lock()
+        self.positions = {}
+        self.acknowledged = set()
+        self.next_seq = 0
+
+    def submitted(self, seq, position):
+        with self.lock:
+            self.positions[seq] = position
+
+    def acknowledge(self, seq):
+        with self.lock:
+            self.acknowledged.add(seq)
+            position = None
+            while self.next_seq in self.acknowledged:
+                self.acknowledged.discard(self.next_seq)
+                position = self.positions.pop(self.next_seq) or position
+                self.next_seq += 1
+            if position is not None:
+                file_name, row, offset = position
+                save_checkpoint(self.path, {
+                    "model_version": self.model_version,
+                    "files": self.files,
+                    "file": file_name,
+                    "row": row,
+                    "offset": offset
+                })
+
+    def complete(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class DeadLetter:
+    # Appends the documents Elasticsearch rejected to a CSV that can be fed
+    # back to the updater (--retry-dead-letter), with the error alongside
+    def __init__(self, path, append=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.count = 0
+        self.fieldnames = None
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'r', newline='', encoding='utf-8') as f:
+                self.fieldnames = next(csv.reader(f))
+        self.file = open(path, 'a' if self.fieldnames else 'w', newline='', encoding='utf-8')
+        self.writer = None
+
+    def write(self, failures):
+        if not failures:
+            return
+        with self.lock:
+            if self.writer is None:
+                if self.fieldnames is None:
+                    # Columns of the first failure; later ones share them
+                    self.fieldnames = ['_id'] + sorted(failures[0][0]['doc']) + ['status', 'error']
+                    csv.writer(self.file).writerow(self.fieldnames)
+                self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames, extrasaction='ignore', restval='')
+            for action, info in failures:
+                item = info.get("update", info)
+                error = item.get("error")
+                if isinstance(error, dict):
+                    error = f"{error.get('type')}: {error.get('reason')}"
+                self.writer.writerow({'_id': action['_id'], **action['doc'], 'status': item.get('status'),
+                                      'error': error})
+            self.file.flush()
+            self.count += len(failures)
+
+    def close(self):
+        self.file.close()
+        # Leave no empty dead letter behind
+        if self.count == 0 and self.writer is None and os.path.getsize(self.path) == 0:
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def bulk_update_documents(elastic, index_name, docs, batch_size=update_chunk_size, threads=update_threads,
+                          max_bytes=update_max_bytes, max_retries=update_max_retries,
+                          initial_backoff=update_initial_backoff, progress=None, pushed=None,
+                          checkpoint=None, dead_letter=None):
+    # Stream the update actions to `threads` concurrent bulk requests of up to
+    # batch_size actions. At most 2 * threads chunks are held in memory.
+    # With a PushedIndex only changed predictions are sent, and acknowledged
+    # ones are recorded in it. An UpdateCheckpoint is advanced as batches are
+    # acknowledged, and rejected documents go to the DeadLetter.
+    progress = progress or UpdateProgress()
+    in_flight = threading.BoundedSemaphore(2 * threads)
+
+    def worker(seq, chunk):
+        try:
+            succeeded, failures = send_chunk(elastic, chunk, max_bytes, max_retries, initial_backoff)
+            if pushed is not None:
+                pushed.record(succeeded)
+            if dead_letter is not None:
+                dead_letter.write(failures)
+            progress.add(len(succeeded), [info for _, info in failures])
+            if checkpoint is not None:
+                checkpoint.acknowledge(seq)
+        finally:
+            in_flight.release()
+
+    def submit(chunk):
+        seq = len(futures)
+        if checkpoint is not None:
+            checkpoint.submitted(seq, chunk[-1].get("_position"))
+        in_flight.acquire()
+        futures.append(executor.submit(worker, seq, chunk))
+
+    actions = update_actions(index_name, docs)
+    if pushed is not None:
+        actions = skip_unchanged(actions, pushed, progress, batch_size)
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        chunk = []
+        for action in actions:
+            chunk.append(action)
+            if len(chunk) == batch_size:
+                submit(chunk)
+                chunk = []
+        # Final flush
+        if chunk:
+            submit(chunk)
+    for future in futures:
+        # Surface connection errors and the like from the workers
+        future.result()
+    return progress
+
+def _tracked_lines(f, position):
+    # Decode the lines of binary file f, keeping position[0] at the byte
+    # offset just past the last line handed out
+    for line in f:
+        position[0] += len(line)
+        yield line.decode('utf-8')
+
+def process_predictions_file(file_path, start_row=0, start_offset=0):
+    # Each doc carries its _position, (file name, rows read, byte offset after
+    # the row), so a run can be resumed from there with start_row and start_offset.
+    file_name = os.path.basename(file_path)
+    with open(file_path, 'rb') as f:
+        fieldnames = next(csv.reader([f.readline().decode('utf-8-sig')]))
+        if start_offset:
+            f.seek(start_offset)
+        position = [f.tell()]
+        reader = csv.DictReader(_tracked_lines(f, position), fieldnames=fieldnames)
+        for row_number, row in enumerate(reader, start=start_row + 1):
             # Extract all fields including _id and any predicted_*
             # We assume _id exists; if not, we skip.
             if '_id' not in row:
                 continue
-            doc = {'_id': row['_id']}
+            doc = {'_id': row['_id'], '_position': (file_name, row_number, position[0])}
             # Include all predicted_* fields
             for key, val in row.items():
                 if key.startswith('predicted_'):
                     doc[key] = val
-            docs.append(doc)
-    return docs
+            yield doc
 
-def main():
+def process_predictions_files(file_paths, resume=None):
+    # All files feed one stream of documents, so the bulk workers stay busy across file boundaries.
+    # resume is a checkpoint to continue from.
+    for file_path in file_paths:
+        file_name = os.path.basename(file_path)
+        if resume and file_name < resume["file"]:
+            continue
+        if resume and file_name == resume["file"]:
+            print(f"Resuming {file_path} after row {resume['row']}...")
+            yield from process_predictions_file(file_path, resume["row"], resume["offset"])
+        else:
+            print(f"Processing {file_path}...")
+            yield from process_predictions_file(file_path)
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def save_checkpoint(path, checkpoint):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+def file_fingerprints(file_paths):
+    # Size and mtime per file; a regenerated predictions file does not match
+    fingerprints = {}
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        fingerprints[os.path.basename(file_path)] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprints
+
+def run_update(file_paths, full=False, checkpoint_file=checkpoint_path, dead_letter_file=dead_letter_path):
+    if full:
+        # Forget what was pushed, so every prediction is sent again
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(pushed_index_path + suffix):
+                os.remove(pushed_index_path + suffix)
+
+    fingerprints = file_fingerprints(file_paths)
+    resume = load_checkpoint(checkpoint_file)
+    if resume and (resume.get("model_version") != model_version or resume.get("files") != fingerprints):
+        print("Predictions changed since the last checkpoint, starting from the beginning.")
+        resume = None
+    checkpoint = UpdateCheckpoint(checkpoint_file, model_version, fingerprints)
+
+    with PushedIndex(pushed_index_path) as pushed, DeadLetter(dead_letter_file, append=resume is not None) as dead_letter:
+        progress = bulk_update_documents(elastic, index_name, process_predictions_files(file_paths, resume),
+                                         pushed=pushed, checkpoint=checkpoint, dead_letter=dead_letter)
+    checkpoint.complete()
+    progress.report(prefix=f"Finished updating with {update_threads} threads:")
+    if dead_letter.count:
+        print(f"{dead_letter.count} rejected documents written to {dead_letter_file}, "
+              f"resend them with --retry-dead-letter")
+    return progress
+
+def retry_dead_letter():
+    # Resend only the documents the last run wrote to the dead letter. Those
+    # that fail again end up in a new dead letter.
+    retry_path = os.path.splitext(dead_letter_path)[0] + ".retry.csv"
+    if os.path.exists(retry_path):
+        # An interrupted retry; its checkpoint picks it up where it stopped
+        print(f"Continuing the retry of {retry_path}")
+    elif os.path.exists(dead_letter_path):
+        os.replace(dead_letter_path, retry_path)
+    else:
+        print(f"No dead letter file {dead_letter_path}.")
+        return
+    progress = run_update([retry_path], checkpoint_file=os.path.splitext(checkpoint_path)[0] + ".retry.json")
+    os.remove(retry_path)
+    return progress
+
+def main(full=False):
     if not os.path.exists(predictions_dir):
         print(f"Predictions directory {predictions_dir} not found.")
         return
-    
+
     files = [f for f in os.listdir(predictions_dir) if f.endswith(".csv")]
     if not files:
         print("No prediction CSV files found in /data/predictions.")
         return
 
-    total_updated = 0
-    for file_name in files:
-        file_path = os.path.join(predictions_dir, file_name)
-        print(f"Processing {file_path}...")
-        docs = process_predictions_file(file_path)
-        if docs:
-            # Update all documents with any predicted_* fields found
-            bulk_update_documents(elastic, index_name, docs)
-            total_updated += len(docs)
-            print(f"Updated {len(docs)} documents from {file_name}.")
-        else:
-            print(f"No valid documents to update from {file_name}.")
-
-    print(f"Finished updating. Total documents updated: {total_updated}")
+    file_paths = [os.path.join(predictions_dir, file_name) for file_name in sorted(files)]
+    return run_update(file_paths, full=full)
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Write the predictions in the prediction CSVs to Elasticsearch")
+    parser.add_argument("--full", action="store_true", help="send every prediction, not only the changed ones")
+    parser.add_argument("--retry-dead-letter", action="store_true",
+                        help="only resend the documents rejected in the last run")
+    args = parser.parse_args()
+    if args.retry_dead_letter:
+        retry_dead_letter()
+    else:
+        main(full=args.full or os.getenv("UPDATE_FULL", "false").lower() == "true")
@@ -1,22 +1,99 @@
 """Phone Limit Tester module.
 
 This module simulates multiple phones sending batches of fake documents to Elasticsearch.
+
+All requests share one aiohttp connection pool, so connections (and TLS
+sessions) are reused. Four load shapes are supported:
+
+- phones: NUMBER_OF_PHONES phones each send BATCHES_PER_PHONE batches back to
+  back (closed loop, the original test)
+- constant: open loop, batches are started at --rate per second for
+  --duration seconds, whether or not earlier ones have been answered
+- ramp: open loop, the rate steps from --rate to --ramp-to over --steps phases
+- replay: recorded data (--trace, a CSV like training_data_temp.csv or a
+  fetched training_data.csv) is split into trips, one phone each, and every
+  trip sends its documents in BATCH_SIZE batches as the app's sendInBatches
+  does, each batch when its last document was recorded, --speedup times
+  faster than real time. The documents have the app's nested layout.
+
+Latencies go into a log-bucketed histogram per phase. In the open-loop modes
+they are measured from the time a batch was due, so a server that falls
+behind shows up in the percentiles instead of slowing the test down. The
+p50/p95/p99/max latency, throughput and error rates of every phase are
+written to --output as JSON. Requests and documents Elasticsearch rejects
+with 429 (a full write queue) are resent with exponential backoff, as the
+app should; the latency includes those retries.
+
+Payloads are generated (and with --gzip compressed) before the test starts.
+How long that took, per batch and compared with building the same batch
+document by document, and how many bytes gzip saves, are reported under
+"payloads"; every phase reports the bandwidth it used.
+
+To test capacity offline, --stand-in starts the local Elasticsearch stand-in
+(testing/elasticStandIn) and sends the batches to it, e.g.
+
+    python phoneLimitTester.py --stand-in --mode ramp --rate 5 --ramp-to 50 --duration 60
+
+--stand-in-args passes its load settings on, e.g. '--workers 4 --queue-size 8'
+to have it reject what a small cluster would.
 """
 
-import concurrent.futures
-import requests
+import argparse
+import asyncio
+import csv
+import gzip
 import json
+import math
+import os
 import random
+import shlex
+import socket
+import subprocess
+import sys
 import time
 from datetime import datetime, timezone
+from urllib.parse import urlparse
 import logging
 
+import aiohttp
+import numpy as np
+
 # Configuration Parameters
 ELASTICSEARCH_URL = 'https://elastic.mcmogens.dk/testinglimits/_bulk?pretty'
 API_KEY = 'MUF6TzFKTUJKeGlHZ2pkM1RfeUo6bHlVUl8xZnlSREs2REotbVZ4ZzA0Zw=='
 NUMBER_OF_PHONES = 100
 BATCH_SIZE = 1000
 BATCHES_PER_PHONE = 50
+# Connections shared by all phones
+POOL_SIZE = 100
+# Distinct batches generated before the test and sent in rotation, so
+# generating documents does not compete with sending them
+PAYLOAD_POOL = 16
+# --gzip sends the bodies with Content-Encoding: gzip, compressed up front
+GZIP_LEVEL = 6
+REQUEST_TIMEOUT_SECONDS = 60
+# Requests and documents rejected with 429 are resent after INITIAL_BACKOFF, 2x, 4x, ... seconds
+MAX_RETRIES = 3
+INITIAL_BACKOFF = 0.5
+
+STAND_IN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'elasticStandIn',
+                               'elasticStandIn.py')
+RESULTS_FILE = "phone_limit_results.json"
+
+# Replay mode
+TRACE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'machineLearning',
+                          'surfaceDetectionEngine', 'training_data_temp.csv')
+SPEEDUP = 10.0
+# A pause longer than this, or another device, starts a new trip
+TRIP_GAP_SECONDS = 30
+TRIP_DEVICE_COLUMN = 'deviceId'
+# Nested fields of the app's documents; the CSV columns are "location.lat"
+# (recorded data) or "location_lat" (fetched exports)
+TRACE_FIELDS = {
+    'location': ('lat', 'lon'),
+    'accelerometer': ('x', 'y', 'z'),
+    'gyroscope': ('x', 'y', 'z'),
+}
 
 LOG_FILE = "phone_limit_tester.log"
 logging.basicConfig(
@@ -26,6 +103,8 @@ logging.basicConfig(
     level=logging.INFO,
 )
 
+SURFACE_TYPES = ['asphalt', 'gravel', 'dirt', 'sand', 'concrete']
+
 def generate_fake_document():
     """Generates a single fake document matching the specified structure."""
     return {
@@ -37,7 +116,7 @@ def generate_fake_document():
         'accelerometer': f"x={round(random.uniform(-10, 10), 3)}, y={round(random.uniform(-10, 10), 3)}, z={round(random.uniform(-10, 10), 3)}",
         'gyroscope': f"x={round(random.uniform(-500, 500), 3)}, y={round(random.uniform(-500, 500), 3)}, z={round(random.uniform(-500, 500), 3)}",
         'rmsAcceleration': round(random.uniform(0, 15), 3),
-        'surfaceType': random.choice(['asphalt', 'gravel', 'dirt', 'sand', 'concrete']),
+        'surfaceType': random.choice(SURFACE_TYPES),
     }
 
 def prepare_bulk_payload(documents):
@@ -53,52 +132,480 @@ def prepare_bulk_payload(documents):
     bulk_payload = '\n'.join(actions) + '\n'
     return bulk_payload
 
-def send_batch(bulk_payload, phone_id, batch_number):
+# One action and document of generate_fake_document's structure, rounded the same way
+BULK_ITEM_TEMPLATE = (
+    '{"create": {}}\n'
+    '{"@timestamp": "%s", "location": {"lat": %.6f, "lon": %.6f}, '
+    '"accelerometer": "x=%.3f, y=%.3f, z=%.3f", "gyroscope": "x=%.3f, y=%.3f, z=%.3f", '
+    '"rmsAcceleration": %.3f, "surfaceType": "%s"}\n'
+)
+
+def generate_bulk_payload(rng, batch_size=BATCH_SIZE):
+    """
+    Generates a whole batch of fake documents as a bulk payload at once: the
+    random values and timestamps come from NumPy in one call per field, and
+    each item is rendered with a single % of BULK_ITEM_TEMPLATE instead of
+    two json.dumps calls.
+    """
+    now = np.datetime64(datetime.now(timezone.utc).replace(tzinfo=None), 'us')
+    timestamps = np.datetime_as_string(now + np.arange(batch_size).astype('timedelta64[us]'), timezone='UTC')
+    columns = [
+        timestamps.tolist(),
+        rng.uniform(-90, 90, batch_size).tolist(),
+        rng.uniform(-180, 180, batch_size).tolist(),
+        *rng.uniform(-10, 10, (3, batch_size)).tolist(),
+        *rng.uniform(-500, 500, (3, batch_size)).tolist(),
+        rng.uniform(0, 15, batch_size).tolist(),
+        [SURFACE_TYPES[i] for i in rng.integers(len(SURFACE_TYPES), size=batch_size).tolist()],
+    ]
+    return ''.join([BULK_ITEM_TEMPLATE % item for item in zip(*columns)])
+
+class BulkPayload:
+    """A bulk payload encoded, and gzipped if asked to, before it is sent."""
+
+    def __init__(self, text, compress=False):
+        self.text = text
+        self.documents = text.count('\n') // 2
+        self.raw = text.encode('utf-8')
+        self.compressed = compress
+        self.body = gzip.compress(self.raw, GZIP_LEVEL) if compress else self.raw
+
+def payload_report(payloads, seconds, sample=PAYLOAD_POOL):
+    """
+    Generation cost of the payloads and, on a sample of them, how much gzip
+    would save (or saves) on the wire and what it costs.
+    """
+    sample = payloads[:sample]
+    # The same batch document by document, for comparison
+    start = time.perf_counter()
+    prepare_bulk_payload([generate_fake_document() for _ in range(BATCH_SIZE)])
+    per_document_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    compressed = [len(gzip.compress(payload.raw, GZIP_LEVEL)) for payload in sample]
+    gzip_seconds = time.perf_counter() - start
+    raw = [len(payload.raw) for payload in sample]
+    return {
+        'batches': len(payloads),
+        'generation_seconds': round(seconds, 3),
+        'generation_ms_per_batch': round(seconds / len(payloads) * 1000, 3),
+        'per_document_generation_ms_per_batch': round(per_document_seconds * 1000, 3),
+        'bytes_per_batch': round(sum(raw) / len(raw)),
+        'gzip_bytes_per_batch': round(sum(compressed) / len(compressed)),
+        'gzip_ratio': round(sum(raw) / sum(compressed), 2),
+        'gzip_ms_per_batch': round(gzip_seconds / len(sample) * 1000, 3),
+        'sent_gzipped': payloads[0].compressed,
+    }
+
+def _trace_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def trace_document(row):
+    """Builds a document in the app's prepareData() layout from one CSV row."""
+    document = {'@timestamp': row.get('@timestamp') or row.get('timestamp')}
+    for name, axes in TRACE_FIELDS.items():
+        document[name] = {axis: _trace_number(row.get(f"{name}.{axis}", row.get(f"{name}_{axis}"))) for axis in axes}
+    document['rmsAcceleration'] = _trace_number(row.get('rmsAcceleration'))
+    document['surfaceType'] = row.get('surfaceType') or 'none'
+    return document
+
+def load_trips(path, gap_seconds=TRIP_GAP_SECONDS, device_column=TRIP_DEVICE_COLUMN):
+    """
+    Reads a recorded CSV and returns its trips, each a time-ordered list of
+    (seconds since the epoch, document). Rows without a timestamp are skipped.
+    """
+    rows = []
+    with open(path, 'r', newline='', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            document = trace_document(row)
+            try:
+                recorded = datetime.fromisoformat(document['@timestamp'].replace('Z', '+00:00'))
+            except (AttributeError, ValueError):
+                continue
+            if recorded.tzinfo is None:
+                recorded = recorded.replace(tzinfo=timezone.utc)
+            rows.append((row.get(device_column, ''), recorded.timestamp(), document))
+    rows.sort(key=lambda row: row[:2])
+    trips = []
+    previous = None
+    for device, recorded, document in rows:
+        if previous is None or device != previous[0] or recorded - previous[1] > gap_seconds:
+            trips.append([])
+        trips[-1].append((recorded, document))
+        previous = (device, recorded)
+    return trips
+
+def replay_schedule(trips, speedup=SPEEDUP, batch_size=BATCH_SIZE, start_together=False, compress=False):
+    """
+    Serializes every batch of every trip up front and returns them as a
+    time-ordered list of (seconds after the start, phone id, BulkPayload).
+    A batch is due when its last document was recorded; trips keep their
+    recorded start times unless start_together is set.
+    """
+    first = min(trip[0][0] for trip in trips)
+    schedule = []
+    for phone_id, trip in enumerate(trips, start=1):
+        start = trip[0][0] if start_together else first
+        for i in range(0, len(trip), batch_size):
+            batch = trip[i:i + batch_size]
+            # Compact like the app's jsonEncode
+            lines = []
+            for _, document in batch:
+                lines.append('{"create":{}}')
+                lines.append(json.dumps(document, separators=(',', ':')))
+            schedule.append(((batch[-1][0] - start) / speedup, phone_id, BulkPayload('\n'.join(lines) + '\n', compress)))
+    schedule.sort(key=lambda batch: batch[0])
+    return schedule
+
+class LatencyHistogram:
     """
-    Sends a single batch of documents to Elasticsearch.
+    HDR-style latency histogram: buckets grow by 1% each, so any percentile
+    is exact to within 1% in constant memory, however many requests are
+    recorded. The maximum is kept exactly.
+    """
+
+    # Values below one microsecond share the first bucket
+    MIN_SECONDS = 1e-6
+    GROWTH = 1.01
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.max = 0.0
+
+    def record(self, seconds):
+        bucket = max(0, int(math.log(max(seconds, self.MIN_SECONDS) / self.MIN_SECONDS, self.GROWTH)))
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        self.max = max(self.max, seconds)
+
+    def bucket_upper(self, bucket):
+        return self.MIN_SECONDS * self.GROWTH ** (bucket + 1)
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the given percentile, in seconds."""
+        if not self.total:
+            return None
+        rank = math.ceil(percent / 100 * self.total)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.bucket_upper(bucket), self.max)
+        return self.max
+
+    def to_dict(self):
+        """Percentiles in milliseconds plus the non-empty buckets as [upper ms, count] pairs."""
+        ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+        return {
+            'count': self.total,
+            'p50_ms': ms(self.percentile(50)),
+            'p95_ms': ms(self.percentile(95)),
+            'p99_ms': ms(self.percentile(99)),
+            'max_ms': ms(self.max) if self.total else None,
+            'buckets': [[ms(self.bucket_upper(bucket)), self.counts[bucket]] for bucket in sorted(self.counts)],
+        }
+
+class PhaseStats:
+    """Latency histogram and counters of one load phase."""
+
+    def __init__(self, name, target_rate=None):
+        self.name = name
+        self.target_rate = target_rate
+        self.latency = LatencyHistogram()
+        self.requests = 0
+        self.http_errors = 0
+        self.exceptions = 0
+        self.documents = 0
+        self.failed_documents = 0
+        self.rejections = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.started = time.perf_counter()
+        self.last_response = self.started
+        self.finished = None
+
+    def to_dict(self):
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        errors = self.http_errors + self.exceptions
+        return {
+            'phase': self.name,
+            'target_batches_per_second': self.target_rate,
+            'seconds': round(elapsed, 3),
+            'batches': self.requests,
+            'batches_per_second': round(self.requests / elapsed, 2) if elapsed > 0 else 0.0,
+            'documents_per_second': round((self.documents - self.failed_documents) / elapsed, 1)
+            if elapsed > 0 else 0.0,
+            'error_rate': round(errors / self.requests, 4) if self.requests else 0.0,
+            'http_errors': self.http_errors,
+            'exceptions': self.exceptions,
+            'document_error_rate': round(self.failed_documents / self.documents, 4) if self.documents else 0.0,
+            'rejected_documents': self.rejections,
+            'retries': self.retries,
+            'megabytes_sent': round(self.bytes_sent / 1e6, 3),
+            'megabits_per_second': round(self.bytes_sent * 8 / 1e6 / elapsed, 2) if elapsed > 0 else 0.0,
+            'latency': self.latency.to_dict(),
+        }
+
+def rejected_actions(payload, items):
+    """
+    Returns the part of a bulk payload whose items were rejected with 429, or
+    None if there are none. Items line up with the payload's action/document line pairs.
+    """
+    lines = payload.splitlines()
+    rejected = [f"{lines[2 * i]}\n{lines[2 * i + 1]}\n" for i, item in enumerate(items)
+                if next(iter(item.values())).get('status') == 429]
+    return ''.join(rejected) or None
+
+async def send_batch(session, url, bulk_payload, phone_id, batch_number, stats, due=None, max_retries=MAX_RETRIES):
+    """
+    Sends a single batch of documents and records it in stats. A request or
+    documents rejected with 429 are resent after INITIAL_BACKOFF, 2x, 4x, ...
+    seconds. Latency counts from due (the time the batch should have started)
+    if given, and includes the retries.
     """
     headers = {
         'Content-Type': 'application/json',
         'Authorization': f'ApiKey {API_KEY}'
     }
+    if bulk_payload.compressed:
+        headers['Content-Encoding'] = 'gzip'
+    start_time = time.perf_counter()
+    stats.requests += 1
+    stats.documents += bulk_payload.documents
+    payload = bulk_payload.text
+    body = bulk_payload.body
     try:
-        start_time = time.time()
-        response = requests.post(ELASTICSEARCH_URL, headers=headers, data=bulk_payload)
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        status = response.status_code
-        response_text = response.text
-        if status == 200:
-            logging.info(f"Phone {phone_id}: Batch {batch_number} sent successfully in {elapsed_time:.2f} seconds. Status {response.status_code}")
-        else:
-            logging.error(f"Phone {phone_id}: Batch {batch_number} failed in {elapsed_time:.2f} seconds. Status: {status}, Response: {response_text}")
+        for attempt in range(max_retries + 1):
+            stats.bytes_sent += len(body)
+            async with session.post(url, data=body, headers=headers) as response:
+                response_text = await response.text()
+                status = response.status
+            retry = None
+            if status == 429:
+                stats.rejections += payload.count('\n') // 2
+                retry = payload
+            elif status == 200:
+                result = json.loads(response_text)
+                if result.get('errors'):
+                    retry = rejected_actions(payload, result['items'])
+                    rejected = retry.count('\n') // 2 if retry else 0
+                    failed = sum(1 for item in result['items'] if next(iter(item.values())).get('error')) - rejected
+                    stats.rejections += rejected
+                    stats.failed_documents += failed
+                    if failed:
+                        logging.warning(f"Phone {phone_id}: Batch {batch_number} had {failed} failed documents")
+            if retry is None or attempt == max_retries:
+                break
+            stats.retries += 1
+            await asyncio.sleep(INITIAL_BACKOFF * 2 ** attempt)
+            payload = retry
+            body = BulkPayload(retry, bulk_payload.compressed).body
+        stats.last_response = time.perf_counter()
+        elapsed_time = stats.last_response - (due if due is not None else start_time)
+        stats.latency.record(elapsed_time)
+        if status not in (200, 429):
+            stats.http_errors += 1
+            stats.failed_documents += payload.count('\n') // 2
+            logging.error(f"Phone {phone_id}: Batch {batch_number} failed in {elapsed_time:.2f} seconds. Status: {status}, Response: {response_text[:500]}")
+        elif retry is not None:
+            # Still rejected after the last retry
+            remaining = retry.count('\n') // 2
+            if status == 429:
+                stats.http_errors += 1
+            stats.failed_documents += remaining
+            logging.error(f"Phone {phone_id}: Batch {batch_number} still had {remaining} rejected documents after {max_retries} retries")
     except Exception as e:
-        end_time = time.time()
-        elapsed_time = end_time - start_time
-        logging.error(f"Phone {phone_id}: Batch {batch_number} encountered an exception after {elapsed_time:.2f} seconds: {e}")
+        stats.last_response = time.perf_counter()
+        elapsed_time = stats.last_response - (due if due is not None else start_time)
+        stats.exceptions += 1
+        stats.failed_documents += payload.count('\n') // 2
+        logging.error(f"Phone {phone_id}: Batch {batch_number} encountered an exception after {elapsed_time:.2f} seconds: {e!r}")
 
-def simulate_phone(phone_id):
+async def simulate_phone(session, url, payloads, phone_id, batches, stats, max_retries=MAX_RETRIES):
     """
-    Simulates a single phone sending batches of documents.
+    Simulates a single phone sending its batches one after the other.
     """
-    for batch_number in range(1, BATCHES_PER_PHONE + 1):
-        # Generate fake documents
-        documents = [generate_fake_document() for _ in range(BATCH_SIZE)]
-        bulk_payload = prepare_bulk_payload(documents)
-        # Send the batch
-        send_batch(bulk_payload, phone_id, batch_number)
+    for batch_number in range(1, batches + 1):
+        payload = payloads[(phone_id + batch_number) % len(payloads)]
+        await send_batch(session, url, payload, phone_id, batch_number, stats, max_retries=max_retries)
+
+async def run_phones(session, url, payloads, phones, batches, max_retries=MAX_RETRIES):
+    stats = PhaseStats(f"{phones} phones x {batches} batches")
+    await asyncio.gather(*(simulate_phone(session, url, payloads, phone_id, batches, stats, max_retries)
+                           for phone_id in range(1, phones + 1)))
+    stats.finished = time.perf_counter()
+    return [stats]
+
+async def run_open_loop(session, url, payloads, rates, phase_seconds, max_retries=MAX_RETRIES):
+    """
+    Starts batches at each rate in turn for phase_seconds, independently of
+    the responses. Returns one PhaseStats per rate.
+    """
+    phases = []
+    pending = set()
+    batch_number = 0
+    for rate in rates:
+        stats = PhaseStats(f"{rate:g} batches/s", target_rate=rate)
+        phases.append(stats)
+        phase_start = time.perf_counter()
+        for i in range(max(1, round(rate * phase_seconds))):
+            due = phase_start + i / rate
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            batch_number += 1
+            task = asyncio.ensure_future(send_batch(session, url, payloads[batch_number % len(payloads)],
+                                                    batch_number % NUMBER_OF_PHONES + 1, batch_number, stats, due,
+                                                    max_retries))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        # Requests still in flight are counted in the phase that started them
+        remaining = phase_start + phase_seconds - time.perf_counter()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+    await asyncio.gather(*pending)
+    # A phase lasts its scheduled time, or until its last response if later
+    for stats in phases:
+        stats.finished = max(stats.started + phase_seconds, stats.last_response)
+    return phases
+
+async def run_replay(session, url, schedule, name, max_retries=MAX_RETRIES):
+    """
+    Sends the batches of a replay schedule when they are due, independently
+    of the responses. Returns a single PhaseStats.
+    """
+    stats = PhaseStats(name)
+    pending = set()
+    start = time.perf_counter()
+    batch_numbers = {}
+    for offset, phone_id, payload in schedule:
+        due = start + offset
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        batch_numbers[phone_id] = batch_numbers.get(phone_id, 0) + 1
+        task = asyncio.ensure_future(send_batch(session, url, payload, phone_id, batch_numbers[phone_id], stats, due,
+                                                max_retries))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+    await asyncio.gather(*pending)
+    stats.finished = time.perf_counter()
+    return [stats]
+
+def start_stand_in(index, options=()):
+    """
+    Starts the Elasticsearch stand-in in its own process (so it does not share
+    this process' GIL) and returns (process, bulk URL) once it answers.
+    options are extra stand-in arguments, e.g. ['--workers', '4'].
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen([sys.executable, STAND_IN_SCRIPT, '--port', str(port), '--index', index,
+                                '--docs', '0', *options], stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            return process, f"http://127.0.0.1:{port}/{index}/_bulk"
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The Elasticsearch stand-in did not start")
+
+async def run(args, payload_stats):
+    """
+    Prepares the payloads (recording how long that took in payload_stats)
+    and runs the test. Returns a list of PhaseStats.
+    """
+    prepare_start = time.perf_counter()
+    if args.mode == 'replay':
+        trips = load_trips(args.trace)
+        if not trips:
+            raise SystemExit(f"{args.trace} has no rows with a usable @timestamp, nothing to replay")
+        schedule = replay_schedule(trips, args.speedup, start_together=args.start_together, compress=args.gzip)
+        payloads = [payload for _, _, payload in schedule]
+        print(f"Prepared {sum(payload.documents for payload in payloads)} documents from {len(trips)} trips, "
+              f"replaying {schedule[-1][0]:.1f}s at {args.speedup:g}x")
+    else:
+        rng = np.random.default_rng()
+        payloads = [BulkPayload(generate_bulk_payload(rng), args.gzip) for _ in range(args.payload_pool)]
+    payload_stats.update(payload_report(payloads, time.perf_counter() - prepare_start))
+    print(f"Generated {len(payloads)} payloads in {payload_stats['generation_seconds']}s "
+          f"({payload_stats['generation_ms_per_batch']} ms per batch, "
+          f"{payload_stats['per_document_generation_ms_per_batch']} ms document by document), "
+          f"{payload_stats['bytes_per_batch']} bytes "
+          f"per batch, {payload_stats['gzip_bytes_per_batch']} gzipped ({payload_stats['gzip_ratio']}x smaller, "
+          f"{payload_stats['gzip_ms_per_batch']} ms per batch)")
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        if args.mode == 'replay':
+            return await run_replay(session, args.url, schedule, f"replay of {os.path.basename(args.trace)} at "
+                                    f"{args.speedup:g}x", args.retries)
+        if args.mode == 'phones':
+            return await run_phones(session, args.url, payloads, args.phones, args.batches, args.retries)
+        if args.mode == 'constant':
+            return await run_open_loop(session, args.url, payloads, [args.rate], args.duration, args.retries)
+        step = (args.ramp_to - args.rate) / max(args.steps - 1, 1)
+        rates = [args.rate + step * i for i in range(args.steps)]
+        return await run_open_loop(session, args.url, payloads, rates, args.duration / args.steps, args.retries)
 
 def main():
+    parser = argparse.ArgumentParser(description="Load test the Elasticsearch _bulk endpoint like many phones")
+    parser.add_argument('--mode', choices=['phones', 'constant', 'ramp', 'replay'], default='phones')
+    parser.add_argument('--url', default=ELASTICSEARCH_URL)
+    parser.add_argument('--stand-in', action='store_true', help="start the local stand-in and test against it")
+    parser.add_argument('--phones', type=int, default=NUMBER_OF_PHONES, help="phones mode")
+    parser.add_argument('--batches', type=int, default=BATCHES_PER_PHONE, help="phones mode: batches per phone")
+    parser.add_argument('--rate', type=float, default=10.0, help="batches per second (ramp: first phase)")
+    parser.add_argument('--ramp-to', type=float, default=100.0, help="ramp: batches per second of the last phase")
+    parser.add_argument('--steps', type=int, default=5, help="ramp: number of phases")
+    parser.add_argument('--duration', type=float, default=30.0, help="seconds (ramp: over all phases)")
+    parser.add_argument('--trace', default=TRACE_FILE, help="replay: recorded CSV")
+    parser.add_argument('--speedup', type=float, default=SPEEDUP, help="replay: times faster than recorded")
+    parser.add_argument('--start-together', action='store_true',
+                        help="replay: start every trip at once instead of at its recorded time")
+    parser.add_argument('--gzip', action='store_true', help="send the bulk bodies gzipped")
+    parser.add_argument('--payload-pool', type=int, default=PAYLOAD_POOL,
+                        help="distinct batches generated up front and sent in rotation")
+    parser.add_argument('--connections', type=int, default=POOL_SIZE, help="size of the shared connection pool")
+    parser.add_argument('--retries', type=int, default=MAX_RETRIES, help="resends of requests rejected with 429")
+    parser.add_argument('--stand-in-args', default='',
+                        help="extra stand-in arguments, e.g. '--workers 4 --queue-size 8 --item-failure-rate 0.01'")
+    parser.add_argument('--output', default=RESULTS_FILE)
+    args = parser.parse_args()
+
+    stand_in = None
+    if args.stand_in:
+        stand_in, args.url = start_stand_in(urlparse(args.url).path.strip('/').split('/')[0] or 'testinglimits',
+                                            shlex.split(args.stand_in_args))
+    payload_stats = {}
     start_time = time.time()
-    with concurrent.futures.ThreadPoolExecutor(max_workers=NUMBER_OF_PHONES) as executor:
-        futures = [
-            executor.submit(simulate_phone, phone_id) 
-            for phone_id in range(1, NUMBER_OF_PHONES + 1)
-        ]
-        concurrent.futures.wait(futures)
-    end_time = time.time()
-    elapsed_time = end_time - start_time
+    try:
+        phases = asyncio.run(run(args, payload_stats))
+    finally:
+        if stand_in is not None:
+            stand_in.terminate()
+    elapsed_time = time.time() - start_time
+
+    results = {'url': args.url, 'mode': args.mode, 'batch_size': BATCH_SIZE, 'connections': args.connections,
+               'seconds': round(elapsed_time, 3), 'payloads': payload_stats,
+               'phases': [stats.to_dict() for stats in phases]}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    for phase in results['phases']:
+        latency = phase['latency']
+        summary = (f"{phase['phase']}: {phase['batches']} batches, {phase['batches_per_second']} batches/s, "
+                   f"{phase['documents_per_second']} docs/s, p50 {latency['p50_ms']} ms, p95 {latency['p95_ms']} ms, "
+                   f"p99 {latency['p99_ms']} ms, max {latency['max_ms']} ms, error rate {phase['error_rate']}, "
+                   f"{phase['megabits_per_second']} Mbit/s sent")
+        logging.info(summary)
+        print(summary)
     logging.info(f"Total execution time: {elapsed_time:.2f} seconds")
+    print(f"Results saved to {args.output}")
 
 if __name__ == '__main__':
     main()
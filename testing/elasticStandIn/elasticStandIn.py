@@ -0,0 +1,545 @@
+"""Elasticsearch stand-in module.
+
+A small localhost HTTP server that implements the parts of the Elasticsearch
+search API the BikeHero tools use, so they can be run and timed without the
+production cluster:
+
+- POST /<index>/_search with ?scroll= (optionally sliced)
+- POST /_search/scroll and DELETE /_search/scroll
+- POST /<index>/_pit and DELETE /_pit
+- POST /_search with a point in time, slice and search_after
+- POST (or PUT) /_bulk and /<index>/_bulk with index, create, update and delete actions
+- POST /<index>/_update/<id> with a partial doc
+
+Request bodies may be gzipped (Content-Encoding: gzip).
+
+Queries may use match_all, term, exists, range and bool (must, filter,
+must_not), and _source may list the fields to return. Documents are generated up front in the same shape the app sends them.
+
+To see how the tools behave under load, every request can take a service
+time (a fixed part plus a part per bulk item or requested hit). With
+--workers set, only that many requests are served at once and at most
+--queue-size more wait; anything beyond is rejected with 429
+es_rejected_execution_exception, like a full thread pool queue on a real
+node. --item-failure-rate rejects that fraction of the bulk items the same
+way, so the clients' retry paths get exercised.
+"""
+
+import argparse
+import bisect
+import gzip
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_INDEX = ".ds-bikehero-data-stream-2024.11.22-000001"
+SURFACE_TYPES = ['asphalt', 'gravel', 'none']
+
+
+def generate_documents(count, seed=42, predicted_fraction=0.0):
+    """Generates count documents shaped like the app's prepareData() output.
+
+    predicted_fraction of the documents also carry a predicted_surfaceType.
+    """
+    rng = random.Random(seed)
+    start = datetime(2024, 11, 22, tzinfo=timezone.utc)
+    documents = []
+    for i in range(count):
+        documents.append({
+            '_id': f"doc{i:09d}",
+            '_source': {
+                '@timestamp': (start + timedelta(milliseconds=100 * i)).isoformat().replace('+00:00', 'Z'),
+                'location': {'lat': 55.65 + rng.uniform(-0.05, 0.05), 'lon': 12.54 + rng.uniform(-0.05, 0.05)},
+                'accelerometer': {'x': rng.gauss(0, 1), 'y': rng.gauss(0, 1), 'z': rng.gauss(0, 1)},
+                'gyroscope': {'x': rng.gauss(0, 0.1), 'y': rng.gauss(0, 0.1), 'z': rng.gauss(0, 0.1)},
+                'rmsAcceleration': abs(rng.gauss(1, 1)),
+                'surfaceType': rng.choice(SURFACE_TYPES),
+            },
+        })
+        if rng.random() < predicted_fraction:
+            documents[-1]['_source']['predicted_surfaceType'] = rng.choice(SURFACE_TYPES[:-1])
+    return documents
+
+
+def _field(source, path):
+    """Looks up a dotted field path in a nested _source."""
+    value = source
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def _comparable(value):
+    """Makes timestamps and numbers comparable, whatever their formatting."""
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            return value
+    return value
+
+
+def query_matches(query, doc):
+    """Evaluates the supported subset of the query DSL against one document."""
+    if not query or 'match_all' in query:
+        return True
+    source = doc['_source']
+    if 'bool' in query:
+        clauses = query['bool']
+        positive = clauses.get('must', []) + clauses.get('filter', [])
+        positive = positive if isinstance(positive, list) else [positive]
+        negative = clauses.get('must_not', [])
+        negative = negative if isinstance(negative, list) else [negative]
+        return (all(query_matches(q, doc) for q in positive)
+                and not any(query_matches(q, doc) for q in negative))
+    if 'exists' in query:
+        return _field(source, query['exists']['field']) is not None
+    if 'term' in query:
+        field, expected = next(iter(query['term'].items()))
+        expected = expected.get('value') if isinstance(expected, dict) else expected
+        actual = doc['_id'] if field == '_id' else _field(source, field)
+        return actual == expected
+    if 'range' in query:
+        field, bounds = next(iter(query['range'].items()))
+        actual = _field(source, field)
+        if actual is None:
+            return False
+        actual = _comparable(actual)
+        checks = {'gt': lambda a, b: a > b, 'gte': lambda a, b: a >= b,
+                  'lt': lambda a, b: a < b, 'lte': lambda a, b: a <= b}
+        return all(checks[op](actual, _comparable(bound)) for op, bound in bounds.items() if op in checks)
+    raise ValueError(f"Unsupported query: {query}")
+
+
+class StandInState:
+    """Holds the documents and the open scroll and point-in-time contexts."""
+
+    def __init__(self, documents, index_name=DEFAULT_INDEX, latency=0.0, item_latency=0.0, workers=None,
+                 queue_size=0, item_failure_rate=0.0, seed=0):
+        self.index_name = index_name
+        self.documents = documents
+        self.latency = latency
+        self.item_latency = item_latency
+        self.workers = workers
+        self.queue_size = queue_size
+        self.item_failure_rate = item_failure_rate
+        self.pending = 0
+        self._executing = threading.BoundedSemaphore(workers) if workers else None
+        self._rng = random.Random(seed)
+        self.scrolls = {}
+        self.pits = set()
+        self.lock = threading.Lock()
+        self.request_counts = {}
+        self._positions = {}
+        self._by_id = None
+
+    def count_request(self, endpoint):
+        with self.lock:
+            self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+
+    def admit(self):
+        """Takes a place among the executing and queued requests.
+
+        Returns False, and counts the rejection, when they are all taken.
+        """
+        with self.lock:
+            if self.workers and self.pending >= self.workers + self.queue_size:
+                self.request_counts['rejected'] = self.request_counts.get('rejected', 0) + 1
+                return False
+            self.pending += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.pending -= 1
+
+    def serve(self, items=0):
+        """Spends the service time of a request on one of the workers."""
+        service_time = self.latency + items * self.item_latency
+        if self._executing is not None:
+            with self._executing:
+                time.sleep(service_time)
+        elif service_time:
+            time.sleep(service_time)
+
+    def reject_item(self):
+        """Decides whether the next bulk item is rejected."""
+        if not self.item_failure_rate:
+            return False
+        with self.lock:
+            return self._rng.random() < self.item_failure_rate
+
+    def add_documents(self, documents):
+        """Appends documents, as if new data had been indexed."""
+        with self.lock:
+            self.documents.extend(documents)
+            self._positions.clear()
+            self._by_id = None
+
+    def apply_bulk_action(self, op, meta, source):
+        """Applies one bulk action and returns its (status, error) pair."""
+        with self.lock:
+            if self._by_id is None:
+                self._by_id = {doc['_id']: pos for pos, doc in enumerate(self.documents)}
+            doc_id = meta.get('_id')
+            position = self._by_id.get(doc_id)
+            if op in ('index', 'create'):
+                if position is not None and op == 'create':
+                    return 409, {'type': 'version_conflict_engine_exception',
+                                 'reason': f"[{doc_id}]: version conflict, document already exists"}
+                if position is None:
+                    doc_id = doc_id or uuid.uuid4().hex
+                    self._by_id[doc_id] = len(self.documents)
+                    self.documents.append({'_id': doc_id, '_source': source})
+                    status = 201
+                else:
+                    self.documents[position]['_source'] = source
+                    status = 200
+            elif position is None:
+                return 404, {'type': 'document_missing_exception', 'reason': f"[{doc_id}]: document missing"}
+            elif op == 'update':
+                self.documents[position]['_source'].update(source.get('doc') or {})
+                status = 200
+            elif op == 'delete':
+                # Keep positions stable for open cursors; drop the document from searches
+                self.documents[position] = {'_id': doc_id, '_source': {}}
+                del self._by_id[doc_id]
+                status = 200
+            else:
+                return 400, {'type': 'illegal_argument_exception', 'reason': f"Unknown action [{op}]"}
+            self._positions.clear()
+            return status, None
+
+    def matching(self, body):
+        """Returns the sorted positions of the documents matching the body.
+
+        Results are memoised per query and slice, so paging with
+        search_after is a bisect instead of a rescan.
+        """
+        key = json.dumps([body.get('query'), body.get('slice')], sort_keys=True)
+        with self.lock:
+            positions = self._positions.get(key)
+        if positions is None:
+            positions = range(len(self.documents))
+            body_slice = body.get('slice')
+            if body_slice:
+                positions = range(body_slice['id'], len(self.documents), body_slice['max'])
+            query = body.get('query')
+            positions = [pos for pos in positions if query_matches(query, self.documents[pos])]
+            with self.lock:
+                self._positions[key] = positions
+        return positions
+
+
+def _filter_source(source, includes):
+    """Applies _source filtering with a list of (dotted) field names."""
+    if includes is None or includes is True:
+        return source
+    if includes is False:
+        return None
+    includes = [includes] if isinstance(includes, str) else includes
+    filtered = {}
+    for path in includes:
+        value = _field(source, path)
+        if value is None:
+            continue
+        target = filtered
+        *parents, leaf = path.split('.')
+        for part in parents:
+            target = target.setdefault(part, {})
+        target[leaf] = value
+    return filtered
+
+
+def _hit(state, position, includes=None):
+    doc = state.documents[position]
+    hit = {
+        '_index': state.index_name,
+        '_id': doc['_id'],
+        '_score': None,
+        'sort': [position],
+    }
+    source = _filter_source(doc['_source'], includes)
+    if source is not None:
+        hit['_source'] = source
+    return hit
+
+
+def _search_response(hits, total, **extra):
+    response = {
+        'took': 1,
+        'timed_out': False,
+        '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+        'hits': {'total': {'value': total, 'relation': 'eq'}, 'max_score': None, 'hits': hits},
+    }
+    response.update(extra)
+    return response
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Routes the supported endpoints onto the shared StandInState."""
+
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_raw(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if raw and self.headers.get('Content-Encoding') == 'gzip':
+            raw = gzip.decompress(raw)
+        return raw
+
+    def _read_body(self):
+        raw = self._read_raw()
+        return json.loads(raw) if raw.strip() else {}
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, error_type, reason):
+        self._send(status, {'error': {'root_cause': [{'type': error_type, 'reason': reason}],
+                                      'type': error_type, 'reason': reason}, 'status': status})
+
+    def _rejected(self):
+        self._error(429, 'es_rejected_execution_exception',
+                    f"rejected execution, queue capacity = {self.state.queue_size}, "
+                    f"active threads = {self.state.workers}")
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/':
+            self._send(200, {'name': 'stand-in', 'cluster_name': 'stand-in',
+                             'version': {'number': '8.15.0'}, 'tagline': 'You Know, for Search'})
+        else:
+            self._error(404, 'not_found', self.path)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        parts = [p for p in url.path.split('/') if p]
+        if not self.state.admit():
+            # The body has to be read anyway to keep the connection usable
+            self._read_raw()
+            return self._rejected()
+        try:
+            self._route(parts, params)
+        finally:
+            self.state.leave()
+
+    def _route(self, parts, params):
+        if parts[-1:] == ['_bulk']:
+            lines = [json.loads(line) for line in self._read_raw().splitlines() if line.strip()]
+            self.state.count_request('bulk')
+            return self._bulk(parts[0] if len(parts) == 2 else None, lines)
+        body = self._read_body()
+        if len(parts) == 3 and parts[1] == '_update':
+            self.state.count_request('update')
+            return self._update(parts[0], parts[2], body)
+        if parts == ['_search', 'scroll']:
+            self.state.count_request('scroll')
+            return self._scroll(body.get('scroll_id') or params.get('scroll_id'))
+        if parts == ['_search']:
+            self.state.count_request('search')
+            return self._pit_search(body, params)
+        if len(parts) == 2 and parts[1] == '_search':
+            self.state.count_request('search')
+            return self._index_search(parts[0], body, params)
+        if len(parts) == 2 and parts[1] == '_pit':
+            self.state.count_request('pit')
+            return self._open_pit(parts[0])
+        self._error(404, 'not_found', self.path)
+
+    def do_PUT(self):
+        # Newer clients send _bulk as PUT
+        parts = [p for p in urlparse(self.path).path.split('/') if p]
+        if parts[-1:] == ['_bulk']:
+            return self.do_POST()
+        self._read_raw()
+        self._error(404, 'not_found', self.path)
+
+    def do_DELETE(self):
+        parts = [p for p in urlparse(self.path).path.split('/') if p]
+        body = self._read_body()
+        if parts == ['_search', 'scroll']:
+            ids = body.get('scroll_id') or []
+            ids = [ids] if isinstance(ids, str) else ids
+            with self.state.lock:
+                freed = sum(1 for i in ids if self.state.scrolls.pop(i, None) is not None)
+            return self._send(200, {'succeeded': True, 'num_freed': freed})
+        if parts == ['_pit']:
+            with self.state.lock:
+                found = body.get('id') in self.state.pits
+                self.state.pits.discard(body.get('id'))
+            return self._send(200, {'succeeded': found, 'num_freed': int(found)})
+        self._error(404, 'not_found', self.path)
+
+    def _check_index(self, index):
+        if index != self.state.index_name:
+            self._error(404, 'index_not_found_exception', f"no such index [{index}]")
+            return False
+        return True
+
+    def _size(self, body, params):
+        return int(body.get('size', params.get('size', 10)))
+
+    def _update(self, index, doc_id, body):
+        self.state.serve(1)
+        if not self._check_index(index):
+            return
+        status, error = self.state.apply_bulk_action('update', {'_id': doc_id}, body)
+        if error:
+            return self._send(status, {'error': {'root_cause': [error], **error}, 'status': status})
+        self._send(200, {'_index': index, '_id': doc_id, 'result': 'updated',
+                         '_shards': {'total': 1, 'successful': 1, 'failed': 0}})
+
+    def _index_search(self, index, body, params):
+        if not self._check_index(index):
+            return
+        matches = self.state.matching(body)
+        size = self._size(body, params)
+        self.state.serve(size)
+        if 'scroll' not in params:
+            hits = [_hit(self.state, pos, body.get('_source')) for pos in matches[:size]]
+            return self._send(200, _search_response(hits, len(matches)))
+        scroll_id = uuid.uuid4().hex
+        cursor = iter(matches)
+        with self.state.lock:
+            self.state.scrolls[scroll_id] = (cursor, size, len(matches), body.get('_source'))
+        hits = [_hit(self.state, pos, body.get('_source')) for pos in itertools.islice(cursor, size)]
+        self._send(200, _search_response(hits, len(matches), _scroll_id=scroll_id))
+
+    def _scroll(self, scroll_id):
+        with self.state.lock:
+            context = self.state.scrolls.get(scroll_id)
+        if context is None:
+            return self._error(404, 'search_context_missing_exception', f"No search context found for id [{scroll_id}]")
+        cursor, size, total, includes = context
+        self.state.serve(size)
+        hits = [_hit(self.state, pos, includes) for pos in itertools.islice(cursor, size)]
+        self._send(200, _search_response(hits, total, _scroll_id=scroll_id))
+
+    def _open_pit(self, index):
+        self.state.serve()
+        if not self._check_index(index):
+            return
+        pit_id = uuid.uuid4().hex
+        with self.state.lock:
+            self.state.pits.add(pit_id)
+        self._send(200, {'id': pit_id})
+
+    def _pit_search(self, body, params):
+        pit = body.get('pit') or {}
+        with self.state.lock:
+            known = pit.get('id') in self.state.pits
+        if not known:
+            return self._error(404, 'search_context_missing_exception', 'No search context found for point in time')
+        size = self._size(body, params)
+        self.state.serve(size)
+        search_after = body.get('search_after')
+        matches = self.state.matching(body)
+        start = bisect.bisect_right(matches, search_after[0]) if search_after else 0
+        hits = [_hit(self.state, pos, body.get('_source')) for pos in matches[start:start + size]]
+        self._send(200, _search_response(hits, len(matches), pit_id=pit['id']))
+
+
+    def _bulk(self, index, lines):
+        items = []
+        errors = False
+        position = 0
+        while position < len(lines):
+            (op, meta), = lines[position].items()
+            position += 1
+            source = None
+            if op != 'delete':
+                source = lines[position]
+                position += 1
+            target = meta.get('_index', index)
+            if target != self.state.index_name:
+                status, error = 404, {'type': 'index_not_found_exception', 'reason': f"no such index [{target}]"}
+            elif self.state.reject_item():
+                status, error = 429, {'type': 'es_rejected_execution_exception',
+                                      'reason': 'rejected execution of primary operation'}
+            else:
+                status, error = self.state.apply_bulk_action(op, meta, source)
+            item = {'_index': target, '_id': meta.get('_id'), 'status': status}
+            if error:
+                item['error'] = error
+                errors = True
+            else:
+                item['result'] = {200: 'updated', 201: 'created'}[status] if op != 'delete' else 'deleted'
+            items.append({op: item})
+        self.state.serve(len(items))
+        self._send(200, {'took': 1, 'errors': errors, 'items': items})
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Load tests open their connections in bursts; the default backlog of 5 resets them
+    request_queue_size = 1024
+
+
+def start_stand_in(documents, index_name=DEFAULT_INDEX, host='127.0.0.1', port=0, latency=0.0, **load):
+    """Starts the stand-in on a background thread and returns the server.
+
+    load takes the other StandInState settings (item_latency, workers,
+    queue_size, item_failure_rate, seed). The URL is available as
+    server.url; call server.shutdown() when done.
+    """
+    server = StandInServer((host, port), StandInHandler)
+    server.state = StandInState(documents, index_name=index_name, latency=latency, **load)
+    server.url = f"http://{host}:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9200)
+    parser.add_argument('--index', default=DEFAULT_INDEX)
+    parser.add_argument('--docs', type=int, default=100000, help='number of generated documents')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='service time added to every request')
+    parser.add_argument('--item-latency-us', type=float, default=0.0,
+                        help='service time per bulk item or requested hit')
+    parser.add_argument('--workers', type=int, default=None, help='requests served at once (default: unlimited)')
+    parser.add_argument('--queue-size', type=int, default=0,
+                        help='requests that may wait for a worker before the rest are rejected with 429')
+    parser.add_argument('--item-failure-rate', type=float, default=0.0,
+                        help='fraction of bulk items rejected with 429')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the item failures')
+    args = parser.parse_args()
+
+    server = start_stand_in(generate_documents(args.docs), index_name=args.index,
+                            host=args.host, port=args.port, latency=args.latency_ms / 1000,
+                            item_latency=args.item_latency_us / 1e6, workers=args.workers,
+                            queue_size=args.queue_size, item_failure_rate=args.item_failure_rate, seed=args.seed)
+    print(f"Elasticsearch stand-in serving {args.docs} documents on {server.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()